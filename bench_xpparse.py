@@ -0,0 +1,421 @@
+""" Benchmarks for xpparse
+
+Run with::
+
+    python bench_xpparse.py
+"""
+from __future__ import print_function, absolute_import
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+import io
+import json
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+from timeit import repeat
+import tracemalloc
+
+import xpparse as xpp
+import xpintern as xpi
+import xpbinary as xpb
+import xpquery as xpq
+import xpjson as xpj
+import xpindex as xpx
+import xpstruct as xps
+import xpbatch
+from xptesting import get_sample
+
+
+def best_time(func, number=20, repeats=5):
+    """ Best time per call of `func` in seconds """
+    return min(repeat(func, number=number, repeat=repeats)) / number
+
+
+def bench_engines():
+    """ Compare LALR and recursive descent parser engines """
+    contents, proto_str = get_sample()
+    symbols = xpp.XProtocolSymbols()
+    lexer = symbols.lexer
+
+    def lex_only():
+        lexer.input(proto_str)
+        token = lexer.token
+        while token():
+            pass
+
+    t_lex = best_time(lex_only)
+    print('Lexing only: {0:.2f} ms'.format(t_lex * 1000))
+    times = {}
+    for engine in ('lalr', 'rd'):
+        times[engine] = best_time(lambda: symbols.parse(proto_str, engine))
+        print('Engine {0}: {1:.2f} ms total, {2:.2f} ms excluding lexing'
+              .format(engine,
+                      times[engine] * 1000,
+                      (times[engine] - t_lex) * 1000))
+    print('Speedup of rd over lalr: {0:.2f} total, {1:.2f} excluding lexing'
+          .format(times['lalr'] / times['rd'],
+                  (times['lalr'] - t_lex) / (times['rd'] - t_lex)))
+
+
+def parse_memory(symbols, in_str):
+    """ Bytes allocated by parse results for `in_str` """
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        res = symbols.parse(in_str)
+        return tracemalloc.get_traced_memory()[0] - start
+    finally:
+        del res
+        tracemalloc.stop()
+
+
+def bench_lazy():
+    """ Compare eager and lazy scalar decoding """
+    contents, proto_str = get_sample()
+    for name, in_str in (('Sample file', contents),
+                         ('Embedded protocol', proto_str)):
+        for lazy in (False, True):
+            symbols = xpp.XProtocolSymbols(lazy_strings=lazy)
+            print('{0}, lazy_strings={1}: {2:.2f} ms, {3} bytes held'.format(
+                name,
+                lazy,
+                best_time(lambda: symbols.parse(in_str)) * 1000,
+                parse_memory(symbols, in_str)))
+
+
+def bench_intern(n_docs=100):
+    """ Memory for a corpus of similar documents, with and without interning
+    """
+    contents, proto_str = get_sample()
+    sources = [proto_str.replace('<ID> 1000001', '<ID> {0}'.format(i))
+               for i in range(n_docs)]
+    for intern in (False, True):
+        interner = xpi.Interner()
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            corpus = [xpp.parse(source) for source in sources]
+            if intern:
+                corpus = xpi.intern_trees(corpus, interner)
+            held = tracemalloc.get_traced_memory()[0] - start
+        finally:
+            del corpus
+            tracemalloc.stop()
+        print('{0} documents, intern={1}: {2} bytes held'.format(
+            n_docs, intern, held))
+
+
+def bench_binary():
+    """ Compare binary format with pickle """
+    contents, proto_str = get_sample()
+    tree = xpp.parse(proto_str)
+    data, pickled = xpb.dumps(tree), pickle.dumps(tree, -1)
+    print('Binary: {0} bytes, pickle: {1} bytes'.format(len(data),
+                                                        len(pickled)))
+    for name, func in (
+            ('Binary dumps', lambda: xpb.dumps(tree)),
+            ('Pickle dumps', lambda: pickle.dumps(tree, -1)),
+            ('Binary read one value',
+             lambda: xpb.loads(data)[0]['cards'][0]['lines'][0][0]),
+            ('Pickle read one value',
+             lambda: pickle.loads(pickled)[0]['cards'][0]['lines'][0][0]),
+            ('Binary read all', lambda: xpb.to_python(xpb.loads(data))),
+            ('Pickle read all', lambda: pickle.loads(pickled))):
+        print('{0}: {1:.3f} ms'.format(name, best_time(func) * 1000))
+
+
+def naive_find(obj, node_type, name):
+    """ Recursive search for dicts with `node_type` and `name` """
+    found = []
+    if isinstance(obj, dict):
+        if obj.get('type') == node_type and obj.get('name') == name:
+            found.append(obj)
+        for value in obj.values():
+            found += naive_find(value, node_type, name)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            found += naive_find(value, node_type, name)
+    return found
+
+
+def bench_query(n_docs=200):
+    """ Compare compiled queries with naive recursive search """
+    contents, proto_str = get_sample()
+    corpus = [xpp.parse(proto_str) for i in range(n_docs)]
+    indices = [xpq.NameIndex(tree) for tree in corpus]
+    query = xpq.compile_query('//ParamBool[name="IsLastStep"]/value')
+    expected = [[n['value'] for n in naive_find(tree, 'param_bool',
+                                                'IsLastStep')]
+                for tree in corpus]
+    assert [query(tree) for tree in corpus] == expected
+    assert [query(index) for index in indices] == expected
+    for name, func in (
+            ('Naive recursive search',
+             lambda: [naive_find(tree, 'param_bool', 'IsLastStep')
+                      for tree in corpus]),
+            ('Compiled query', lambda: [query(tree) for tree in corpus]),
+            ('Compiled query with index',
+             lambda: [query(index) for index in indices])):
+        print('{0}, {1} documents: {2:.2f} ms'.format(
+            name, n_docs, best_time(func, number=3) * 1000))
+
+
+def peak_memory(func):
+    """ Peak bytes allocated while running `func` """
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+
+
+def bench_json(n_docs=200):
+    """ Compare streaming typed JSON with ``json`` on a corpus """
+    contents, proto_str = get_sample()
+    corpus = [xpp.parse(proto_str) for i in range(n_docs)]
+    fd, fname = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+
+    def json_dump():
+        with open(fname, 'wt') as fobj:
+            fobj.write(json.dumps(corpus))
+
+    def json_load():
+        with open(fname, 'rt') as fobj:
+            for tree in json.load(fobj):
+                pass
+
+    def xpj_dump():
+        with open(fname, 'wt') as fobj:
+            xpj.dump_all(corpus, fobj)
+
+    def xpj_load():
+        with open(fname, 'rt') as fobj:
+            for tree in xpj.iter_load(fobj):
+                pass
+
+    try:
+        for name, dumper, loader in (('json', json_dump, json_load),
+                                     ('xpjson', xpj_dump, xpj_load)):
+            dump_time = best_time(dumper, number=1, repeats=3)
+            dump_peak = peak_memory(dumper)
+            size = os.path.getsize(fname)
+            load_time = best_time(loader, number=1, repeats=3)
+            load_peak = peak_memory(loader)
+            print('{0}, {1} documents, {2:.1f} MB: dump {3:.0f} ms, peak '
+                  '{4:.1f} MB; load {5:.0f} ms, peak {6:.1f} MB'.format(
+                      name, n_docs, size / 1e6, dump_time * 1000,
+                      dump_peak / 1e6, load_time * 1000, load_peak / 1e6))
+    finally:
+        os.unlink(fname)
+
+
+def bench_iterparse(n_docs=200):
+    """ Compare ``parse`` and ``iterparse`` on concatenated documents """
+    contents, proto_str = get_sample()
+    fd, fname = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'wt') as fobj:
+        for i in range(n_docs):
+            fobj.write(proto_str + '\n')
+
+    def whole():
+        with open(fname, 'rt') as fobj:
+            for tree in xpp.parse(fobj.read()):
+                pass
+
+    def iterative():
+        with open(fname, 'rt') as fobj:
+            for tree in xpp.iterparse(fobj):
+                pass
+
+    try:
+        for name, func in (('parse', whole), ('iterparse', iterative)):
+            print('{0}, {1} MB of concatenated documents: {2:.0f} ms, peak '
+                  '{3:.1f} MB'.format(
+                      name, round(os.path.getsize(fname) / 1e6, 1),
+                      best_time(func, number=1, repeats=3) * 1000,
+                      peak_memory(func) / 1e6))
+    finally:
+        os.unlink(fname)
+
+
+def bench_struct(n_docs=200):
+    """ Compare NumPy structural index with regex scans and parsing """
+    contents, proto_str = get_sample()
+    text = (proto_str + '\n') * n_docs
+    data = text.encode('utf-8')
+    query = xpq.compile_query('//ParamBool[name="IsLastStep"]')
+
+    def extract():
+        index = xps.StructuralIndex(data)
+        return [index.parse(i) for i in index.find(name='IsLastStep')]
+
+    assert extract() == [node for tree in xpp.iterparse(text)
+                         for node in query(tree)]
+    for name, func in (
+            ('Structural index', lambda: xps.StructuralIndex(data)),
+            ('Regex document scan', lambda: xpx.scan_documents(data)),
+            ('Split documents', lambda: list(xpp.split_documents(text))),
+            ('Extract one parameter by name', extract),
+            ('Parse and query', lambda: [query(tree) for tree in
+                                         xpp.iterparse(text)])):
+        print('{0}, {1:.1f} MB: {2:.1f} ms'.format(
+            name, len(data) / 1e6,
+            best_time(func, number=1, repeats=3) * 1000))
+
+
+def bench_parallel(n_copies=50):
+    """ Compare serial parse with parallel lexing of one large input """
+    contents, proto_str = get_sample()
+    text = '\n'.join([proto_str] * n_copies)
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        # Start the workers
+        xpp.parse(proto_str, executor=executor, segment_size=1000)
+        print('Serial parse, {0:.1f} MB: {1:.0f} ms'.format(
+            len(text) / 1e6,
+            best_time(lambda: xpp.parse(text), number=1, repeats=3) * 1000))
+        for segment_size in (2 ** 18, 2 ** 20):
+            print('Parallel lexing, {0} workers, segments of {1} KB: '
+                  '{2:.0f} ms'.format(
+                      workers, segment_size // 1024,
+                      best_time(lambda: xpp.parse(
+                          text, executor=executor,
+                          segment_size=segment_size),
+                          number=1, repeats=3) * 1000))
+
+
+def _parse_file(path):
+    with open(path, 'rt') as fobj:
+        return xpp.parse(fobj.read())
+
+
+def bench_batch(n_files=100):
+    """ Compare pickled and shared memory results from a process pool """
+    contents, proto_str = get_sample()
+    tmpdir = tempfile.mkdtemp()
+    paths = []
+    for i in range(n_files):
+        paths.append(os.path.join(tmpdir, 'prot{0}.txt'.format(i)))
+        with open(paths[-1], 'wt') as fobj:
+            fobj.write(proto_str)
+    workers = os.cpu_count() or 1
+
+    def pickled():
+        with Pool(workers) as pool:
+            for tree in pool.imap(_parse_file, paths):
+                tree[0]['blocks'][0]['name']
+
+    def shared():
+        for result in xpbatch.parse_files(paths, workers):
+            with result.tree:
+                result.tree.root[0]['blocks'][0]['name']
+
+    try:
+        for name, func in (('Pickled trees', pickled),
+                           ('Shared memory', shared)):
+            print('{0}, {1} files, {2} workers: {3:.0f} ms'.format(
+                name, n_files, workers,
+                best_time(func, number=1, repeats=3) * 1000))
+        # Cost in the parent, for a small and a large tree
+        for n_copies in (1, 50):
+            tree = xpp.parse('\n'.join([proto_str] * n_copies))
+            data = pickle.dumps(tree, -1)
+
+            shared = [xpb.dump_shared(tree) for i in range(5)]
+            start = time.perf_counter()
+            for name, size in shared:
+                with xpb.attach_shared(name, size) as binary:
+                    binary.root[0]['blocks'][0]['name']
+            t_attach = (time.perf_counter() - start) / len(shared)
+            print('Parent cost for {0} documents: unpickle {1:.2f} ms, '
+                  'attach shared memory {2:.2f} ms'.format(
+                      len(tree),
+                      best_time(lambda: pickle.loads(data), number=5) * 1000,
+                      t_attach * 1000))
+    finally:
+        for path in paths:
+            os.unlink(path)
+        os.rmdir(tmpdir)
+
+
+def bench_damaged(n_docs=50, blob_size=2 ** 20):
+    """ Lex clean and damaged input in 'forgiving' mode """
+    contents, proto_str = get_sample()
+    clean = '\n'.join([proto_str] * n_docs)
+    rng = random.Random(42)
+    blob = bytes(rng.getrandbits(8)
+                 for i in range(blob_size)).decode('latin-1')
+    # Corrupted region in the middle of the documents
+    middle = len(clean) // 2
+    damaged = clean[:middle] + blob + clean[middle:]
+    symbols = xpp.XProtocolSymbols(error_mode='forgiving')
+
+    def lex_only(text):
+        lexer = symbols.lexer.clone()
+        lexer.input(text)
+        with redirect_stdout(io.StringIO()):
+            for tok in lexer:
+                pass
+
+    for name, text in (('clean', clean), ('damaged', damaged)):
+        t = best_time(lambda: lex_only(text), number=1, repeats=3)
+        print('Forgiving lex, {0}, {1:.1f} MB: {2:.0f} ms, {3:.1f} MB/s'
+              .format(name, len(text) / 1e6, t * 1000, len(text) / 1e6 / t))
+
+
+def bench_limits():
+    """ Cost of checking parse limits """
+    contents, proto_str = get_sample()
+    limits = xpp.ParseLimits(max_size=2 ** 26, max_tokens=10 ** 7,
+                             max_depth=64, max_string=2 ** 20,
+                             max_list=10 ** 5, timeout=10)
+    for engine in ('lalr', 'rd'):
+        for name, symbols in (('no limits', xpp.XProtocolSymbols()),
+                              ('limits', xpp.XProtocolSymbols(
+                                  limits=limits))):
+            print('{0}, {1}: {2:.1f} ms'.format(
+                engine, name,
+                best_time(lambda: symbols.parse(proto_str, engine)) * 1000))
+
+
+def bench_progress():
+    """ Cost of progress reporting and cancel checks """
+    contents, proto_str = get_sample()
+    cancel = threading.Event()
+    for engine in ('lalr', 'rd'):
+        for name, kwargs in (
+                ('plain', {}),
+                ('progress, cancel', dict(progress=lambda done, total: None,
+                                          cancel=cancel))):
+            print('{0}, {1}: {2:.1f} ms'.format(
+                engine, name,
+                best_time(lambda: xpp.parse(proto_str, engine, **kwargs))
+                * 1000))
+
+
+def main():
+    bench_engines()
+    bench_lazy()
+    bench_intern()
+    bench_binary()
+    bench_query()
+    bench_json()
+    bench_iterparse()
+    bench_struct()
+    bench_parallel()
+    bench_batch()
+    bench_damaged()
+    bench_limits()
+    bench_progress()
+
+
+if __name__ == '__main__':
+    main()
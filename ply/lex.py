@@ -375,7 +375,9 @@ class Lexer:
                 # No match. Call t_error() if defined.
                 if self.lexerrorf:
                     tok = LexToken()
-                    tok.value = self.lexdata[lexpos:]
+                    # Only the first character; copying the rest of the
+                    # input for each error is quadratic on damaged input
+                    tok.value = self.lexdata[lexpos]
                     tok.lineno = self.lineno
                     tok.type = "error"
                     tok.lexer = self
@@ -510,14 +510,13 @@ class LRParser:
                     if errtoken.type == "$end":
                         errtoken = None               # End of file!
                     if self.errorfunc:
-                        global errok,token,restart
-                        errok = self.errok        # Set some special functions available in error recovery
-                        token = get_token
-                        restart = self.restart
+                        # Error functions get errok, token and restart from
+                        # the parser, not from module globals, so parsers can
+                        # recover from errors in several threads at once
+                        self.token = get_token
                         if errtoken and not hasattr(errtoken,'lexer'):
                             errtoken.lexer = lexer
                         tok = self.errorfunc(errtoken)
-                        del errok, token, restart   # Delete special functions
 
                         if self.errorok:
                             # User must have done some kind of panic
@@ -783,14 +782,13 @@ class LRParser:
                     if errtoken.type == '$end':
                         errtoken = None               # End of file!
                     if self.errorfunc:
-                        global errok,token,restart
-                        errok = self.errok        # Set some special functions available in error recovery
-                        token = get_token
-                        restart = self.restart
+                        # Error functions get errok, token and restart from
+                        # the parser, not from module globals, so parsers can
+                        # recover from errors in several threads at once
+                        self.token = get_token
                         if errtoken and not hasattr(errtoken,'lexer'):
                             errtoken.lexer = lexer
                         tok = self.errorfunc(errtoken)
-                        del errok, token, restart   # Delete special functions
 
                         if self.errorok:
                             # User must have done some kind of panic
@@ -1038,14 +1036,13 @@ class LRParser:
                     if errtoken.type == '$end':
                         errtoken = None               # End of file!
                     if self.errorfunc:
-                        global errok,token,restart
-                        errok = self.errok        # Set some special functions available in error recovery
-                        token = get_token
-                        restart = self.restart
+                        # Error functions get errok, token and restart from
+                        # the parser, not from module globals, so parsers can
+                        # recover from errors in several threads at once
+                        self.token = get_token
                         if errtoken and not hasattr(errtoken,'lexer'):
                             errtoken.lexer = lexer
                         tok = self.errorfunc(errtoken)
-                        del errok, token, restart   # Delete special functions
 
                         if self.errorok:
                             # User must have done some kind of panic
@@ -0,0 +1,203 @@
+""" Tests for asyncio interface to parser
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+import time
+
+import xpparse as xpp
+import xpasync as xpa
+from xptesting import EG_PROTO, GOOD_STR, BAD_STR
+
+from nose.tools import assert_equal, assert_raises
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_reader(data, chunk_size=7):
+    # StreamReader fed in small chunks, to split multibyte characters
+    reader = asyncio.StreamReader()
+    for i in range(0, len(data), chunk_size):
+        reader.feed_data(data[i:i + chunk_size])
+    reader.feed_eof()
+    return reader
+
+
+def test_parse():
+    with open(EG_PROTO, 'rt') as fobj:
+        contents = fobj.read()
+    expected = xpp.parse(contents)
+    parser = xpa.AsyncParser()
+    assert_equal(run(parser.parse(contents)), expected)
+    assert_equal(run(parser.parse(contents.encode('utf-8'))), expected)
+    assert_equal(run(xpa.parse(contents)), expected)
+    assert_equal(run(parser.parse_file(Path(EG_PROTO))), expected)
+    assert_equal(run(parser.parse_file(EG_PROTO)), expected)
+    assert_raises(SyntaxError, run, parser.parse(BAD_STR))
+    # Options pass to the symbols
+    forgiving = xpa.AsyncParser(error_mode='forgiving', engine='rd')
+    assert_equal(run(forgiving.parse(BAD_STR)), None)
+    assert_raises(ValueError, xpa.AsyncParser, engine='foo')
+    assert_raises(ValueError, xpa.AsyncParser, max_concurrency=0)
+
+
+def test_parse_stream():
+    # Non-ASCII string split across chunks
+    in_str = GOOD_STR.replace('Good', 'G\xf6\xf6d €')
+    expected = xpp.parse(in_str)
+    assert_equal(expected[0]['name'], 'G\xf6\xf6d €')
+
+    async def read_all():
+        parser = xpa.AsyncParser(chunk_size=3)
+        return [await parser.parse_stream(make_reader(
+            in_str.encode('utf-8'), chunk_size)) for chunk_size in (1, 2, 5)]
+
+    assert_equal(run(read_all()), [expected] * 3)
+    # Several documents, with errors at their line in the stream
+    with open(EG_PROTO, 'rt') as fobj:
+        contents = fobj.read()
+    source = '\n'.join([contents, GOOD_STR, contents])
+
+    async def parse_text(parser, text):
+        return await parser.parse_stream(make_reader(text.encode('utf-8'),
+                                                     1000))
+
+    parser = xpa.AsyncParser(chunk_size=1000)
+    assert_equal(run(parse_text(parser, source)), xpp.parse(source))
+    bad = source + '\n' + BAD_STR
+    try:
+        run(parse_text(parser, bad))
+    except SyntaxError as e:
+        assert_equal(e.lineno, bad.count('\n') + 1)
+    else:
+        raise AssertionError('Expected SyntaxError')
+    # Forgiving mode drops bad documents
+    forgiving = xpa.AsyncParser(error_mode='forgiving', engine='rd')
+    assert_equal(run(parse_text(forgiving, BAD_STR + GOOD_STR)),
+                 xpp.parse(GOOD_STR))
+
+
+def test_parse_many():
+    inputs = [GOOD_STR.replace('Good', 'Good{0}'.format(i))
+              for i in range(10)]
+    expected = [xpp.parse(s) for s in inputs]
+
+    async def collect(parser, sources, **kwargs):
+        return [res async for res in parser.parse_many(sources, **kwargs)]
+
+    async def agen(sources):
+        for source in sources:
+            yield source
+
+    parser = xpa.AsyncParser(max_concurrency=3)
+    assert_equal(run(collect(parser, inputs)), expected)
+    assert_equal(run(collect(parser, agen(inputs))), expected)
+    unordered = run(collect(parser, inputs, ordered=False))
+    assert_equal(sorted(unordered, key=repr), sorted(expected, key=repr))
+
+    # Mixed input types; streams need a running loop
+    async def mixed():
+        sources = [inputs[0],
+                   inputs[1].encode('latin1'),
+                   make_reader(inputs[2].encode('utf-8')),
+                   Path(EG_PROTO)]
+        return await collect(parser, sources)
+
+    results = run(mixed())
+    assert_equal(results[:3], expected[:3])
+    assert_equal(results[3], xpp.parse(open(EG_PROTO, 'rt').read()))
+    assert_raises(TypeError, run, collect(parser, [1]))
+    # Errors raise, or come back as results
+    assert_raises(SyntaxError, run, collect(parser, [GOOD_STR, BAD_STR]))
+    results = run(collect(parser, [GOOD_STR, BAD_STR, GOOD_STR],
+                          return_exceptions=True))
+    assert_equal(results[0], results[2])
+    assert_equal(type(results[1]), SyntaxError)
+
+
+def test_backpressure():
+    # We only pull inputs when there is room for them
+    pulled = []
+
+    def sources():
+        for i in range(8):
+            pulled.append(i)
+            yield GOOD_STR
+
+    async def check():
+        parser = xpa.AsyncParser(max_concurrency=2)
+        consumed = 0
+        async for result in parser.parse_many(sources()):
+            consumed += 1
+            # Up to two in flight, one yielded each time
+            assert len(pulled) <= consumed + 2
+        return consumed
+
+    assert_equal(run(check()), 8)
+
+
+def test_stream_backpressure():
+    # We only read more of a stream when there is room to parse it
+    finished = []
+    fed = []
+
+    class SlowExecutor(ThreadPoolExecutor):
+
+        def submit(self, func, *args):
+            def call():
+                time.sleep(0.01)
+                try:
+                    return func(*args)
+                finally:
+                    finished.append(1)
+            return super(SlowExecutor, self).submit(call)
+
+    class Reader(object):
+        # One document for each read
+
+        def __init__(self, n):
+            self.n = n
+
+        async def read(self, size):
+            assert len(fed) - len(finished) <= 2
+            if len(fed) == self.n:
+                return b''
+            fed.append(1)
+            return GOOD_STR.encode('utf-8')
+
+    with SlowExecutor(1) as executor:
+        parser = xpa.AsyncParser(executor=executor, max_concurrency=2)
+        assert_equal(run(parser.parse_stream(Reader(10))),
+                     xpp.parse(GOOD_STR * 10))
+
+
+def test_reuse_loops():
+    # Parser works in more than one event loop
+    parser = xpa.AsyncParser(max_concurrency=1)
+
+    async def parse_all():
+        return await asyncio.gather(*[parser.parse(GOOD_STR)
+                                      for i in range(5)])
+
+    for i in range(2):
+        assert_equal(run(parse_all()), [xpp.parse(GOOD_STR)] * 5)
+
+
+def test_process_pool():
+    inputs = [GOOD_STR, BAD_STR]
+    with ProcessPoolExecutor(2) as executor:
+        parser = xpa.AsyncParser(executor=executor, spans=True)
+
+        async def collect():
+            return [res async for res in parser.parse_many(
+                inputs, return_exceptions=True)]
+
+        good, bad = run(collect())
+    # Spans survive the trip back from the worker
+    assert_equal(good[0]['name'], 'Good')
+    assert_equal(good[0]['span'].text, GOOD_STR)
+    assert_equal(good[0]['blocks'][0]['span'].text, '<ParamLong."L"> { 3 }')
+    assert_equal(type(bad), SyntaxError)
@@ -0,0 +1,85 @@
+""" Tests for batch parsing with results in shared memory
+"""
+
+from multiprocessing import Pool
+import os
+from os.path import join as pjoin
+
+import xpparse as xpp
+import xpbinary as xpb
+import xpbatch
+from xptesting import (EG_PROTO, GOOD_STR, BAD_STR, write_file,
+                       temp_dir)
+
+from nose.tools import assert_equal, assert_raises
+
+
+def _dump_in_worker(text):
+    return xpb.dump_shared(xpp.parse(text))
+
+
+# Shared memory shows as files here on Linux
+SHM_DIR = '/dev/shm'
+
+
+def shm_names():
+    return set(os.listdir(SHM_DIR)) if os.path.isdir(SHM_DIR) else set()
+
+
+def test_shared():
+    tree = xpp.parse(GOOD_STR)
+    name, size = xpb.dump_shared(tree)
+    shared = xpb.attach_shared(name, size)
+    assert_equal(shared.root, tree)
+    shared.close()
+    # Memory is gone after the close
+    assert_raises(FileNotFoundError, xpb.attach_shared, name, size)
+    # From another process
+    with Pool(2) as pool:
+        results = pool.map(_dump_in_worker, [GOOD_STR] * 4)
+    for name, size in results:
+        with xpb.attach_shared(name, size) as shared:
+            assert_equal(shared.root, tree)
+
+
+def test_parse_files():
+    with temp_dir() as tmpdir:
+        paths = []
+        # Parses, but too big to store
+        big_str = GOOD_STR.replace('3', str(2 ** 64))
+        for i, text in enumerate([GOOD_STR, BAD_STR, GOOD_STR, big_str]):
+            paths.append(pjoin(tmpdir, 'prot{0}.txt'.format(i)))
+            write_file(paths[-1], text)
+        paths = [EG_PROTO] + paths + [pjoin(tmpdir, 'missing.txt')]
+        results = list(xpbatch.parse_files(paths, workers=2))
+        assert_equal([r.path for r in results], paths)
+        with open(EG_PROTO, 'rt') as fobj:
+            assert_equal(results[0].tree.root, xpp.parse(fobj.read()))
+        assert_equal(results[1].tree.root, xpp.parse(GOOD_STR))
+        assert_equal(results[2].tree, None)
+        assert_equal(results[2].error['type'], 'SyntaxError')
+        assert_equal(results[2].error['lineno'], 1)
+        assert_equal(results[4].tree, None)
+        assert_equal(results[4].error['type'], 'ValueError')
+        assert_equal(results[5].error['type'], 'FileNotFoundError')
+        before = shm_names()
+        for result in results:
+            if result.tree is not None:
+                result.tree.close()
+        after = shm_names()
+        if before:
+            assert_equal(len(before - after), 3)
+        # Unordered, with options
+        results = list(xpbatch.parse_files(paths[:2] * 3, workers=2,
+                                           ordered=False, engine='rd'))
+        assert_equal(sorted(r.path for r in results),
+                     sorted(paths[:2] * 3))
+        for result in results:
+            assert_equal(result.error, None)
+            result.tree.close()
+        # Stopping early frees the remaining results
+        results = xpbatch.parse_files(paths[:2] * 3, workers=2)
+        first = next(results)
+        results.close()
+        first.tree.close()
+        assert_equal(shm_names() - after, set())
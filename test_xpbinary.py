@@ -0,0 +1,91 @@
+""" Tests for binary format of parse trees
+"""
+
+import tempfile
+
+import xpparse as xpp
+import xpbinary as xpb
+import xpintern as xpi
+from xptesting import get_sample
+
+from nose.tools import (assert_true, assert_false, assert_equal,
+                        assert_raises)
+
+
+def test_round_trip():
+    for source in get_sample():
+        tree = xpp.parse(source)
+        data = xpb.dumps(tree)
+        root = xpb.loads(data)
+        assert_equal(root, tree)
+        assert_equal(tree, root)
+        plain = xpb.to_python(root)
+        assert_equal(plain, tree)
+        assert_equal(type(plain[0]), dict)
+        # Spans and lazy scalars store as plain values
+        symbols = xpp.XProtocolSymbols(spans=True, lazy_strings=True)
+        assert_equal(xpb.dumps(symbols.parse(source)), data)
+
+
+def test_types():
+    tree = {'none': None, 'bools': [True, False], 'ints': [1, -2 ** 62],
+            'floats': [1.0, 2.5], 'strs': ['a', '', 'a', '\xf6'],
+            'mixed': [1, 1.0, True, 'a', None, [], {}], 'empty': [],
+            'tuple': (1, ('a', [2])), 'bool_int': [True, 1],
+            'float': -0.0}
+    root = xpb.loads(xpb.dumps(tree))
+    assert_equal(root, tree)
+    plain = xpb.to_python(root)
+    assert_equal(plain, tree)
+    for key, value in tree.items():
+        assert_equal([type(v) for v in plain[key]]
+                     if isinstance(value, (list, tuple))
+                     else type(plain[key]),
+                     [type(v) for v in value]
+                     if isinstance(value, (list, tuple))
+                     else type(value))
+    # Typed arrays give zero-copy views of the data
+    assert_true(isinstance(root['ints'], xpb.BinaryArray))
+    assert_equal(root['ints'].values.format, 'q')
+    assert_equal(root['floats'].values.tolist(), [1.0, 2.5])
+    assert_false(isinstance(root['bool_int'], xpb.BinaryArray))
+    # Sequence behavior
+    assert_equal(root['mixed'][-1], {})
+    assert_equal(root['mixed'][1:3], [1.0, True])
+    assert_raises(IndexError, root['mixed'].__getitem__, 7)
+    assert_raises(KeyError, root.__getitem__, 'missing')
+    assert_raises(KeyError, root.__getitem__, 1)
+    assert_equal(root['tuple'], (1, ('a', [2])))
+    assert_equal(sorted(root), sorted(tree))
+    assert_raises(TypeError, xpb.dumps, {'a': object()})
+    # Integers must fit in int64
+    for big in (2 ** 63, -2 ** 63 - 1):
+        assert_raises(ValueError, xpb.dumps, {'a': big})
+        assert_raises(ValueError, xpb.dumps, [1, big])
+    assert_equal(xpb.loads(xpb.dumps([2 ** 63 - 1, -2 ** 63])),
+                 [2 ** 63 - 1, -2 ** 63])
+    assert_raises(ValueError, xpb.loads, b'\x00' * 40)
+
+
+def test_shared_subtrees():
+    # Shared subtrees store once
+    contents, proto_str = get_sample()
+    trees = [xpp.parse(proto_str), xpp.parse(proto_str)]
+    assert_true(len(xpb.dumps(xpi.intern_trees(trees))) <
+                len(xpb.dumps(trees)) * 0.6)
+    assert_equal(xpb.loads(xpb.dumps(xpi.intern_trees(trees))), trees)
+
+
+def test_load():
+    contents, proto_str = get_sample()
+    tree = xpp.parse(proto_str)
+    with tempfile.NamedTemporaryFile(suffix='.xpb') as fobj:
+        xpb.dump(tree, fobj)
+        fobj.flush()
+        with xpb.load(fobj.name) as binary:
+            root = binary.root
+            assert_equal(root[0]['name'], tree[0]['name'])
+            assert_equal(root[0]['cards'][0]['lines'],
+                         tree[0]['cards'][0]['lines'])
+            assert_equal(root, tree)
+        assert_true(binary.mmap.closed)
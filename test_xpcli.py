@@ -0,0 +1,129 @@
+""" Tests for command line tool
+"""
+
+from contextlib import redirect_stdout, redirect_stderr
+import io
+import json
+from os.path import join as pjoin
+import sys
+
+import xpparse as xpp
+import xpcli
+from xptesting import (EG_PROTO, GOOD_STR, BAD_STR, write_file,
+                       temp_dir)
+
+from nose.tools import assert_equal, assert_true
+
+
+def run_main(argv, stdin=''):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    old_stdin = sys.stdin
+    sys.stdin = io.StringIO(stdin)
+    try:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            code = xpcli.main(argv)
+    finally:
+        sys.stdin = old_stdin
+    records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    return code, records, stderr.getvalue()
+
+
+def test_files():
+    with temp_dir() as tmpdir:
+        for i in range(3):
+            write_file(pjoin(tmpdir, 'good{0}.txt'.format(i)),
+                       GOOD_STR.replace('Good', 'Good{0}'.format(i)))
+        write_file(pjoin(tmpdir, 'bad.txt'), BAD_STR)
+        for workers in ('1', '2'):
+            code, records, err = run_main(
+                [pjoin(tmpdir, 'good*.txt'), pjoin(tmpdir, 'bad.txt'),
+                 '-j', workers])
+            assert_equal(code, 1)
+            by_path = dict((r['path'], r) for r in records)
+            assert_equal(len(by_path), 4)
+            good = by_path[pjoin(tmpdir, 'good1.txt')]
+            assert_equal(good['protocols'][0]['name'], 'Good1')
+            assert_equal(good['error'], None)
+            bad = by_path[pjoin(tmpdir, 'bad.txt')]
+            assert_equal(bad['protocols'], None)
+            assert_equal(bad['error']['type'], 'SyntaxError')
+            assert_equal(bad['error']['lineno'], 1)
+        # Only good files
+        code, records, err = run_main([pjoin(tmpdir, 'good0.txt'),
+                                       '--stats'])
+        assert_equal(code, 0)
+        assert_equal(len(records), 1)
+        assert_true('good0.txt: ' in err)
+        assert_true('1 documents, 0 errors' in err)
+        # Missing file
+        code, records, err = run_main([pjoin(tmpdir, 'missing*.txt')])
+        assert_equal(code, 1)
+        assert_equal(records[0]['error']['type'], 'FileNotFoundError')
+
+
+def test_stdin():
+    code, records, err = run_main([], GOOD_STR)
+    assert_equal(code, 0)
+    assert_equal(records[0]['path'], '-')
+    assert_equal(records[0]['protocols'],
+                 json.loads(json.dumps(xpp.parse(GOOD_STR))))
+    code, records, err = run_main(['-', '--engine', 'rd'], GOOD_STR)
+    assert_equal(records[0]['protocols'][0]['name'], 'Good')
+
+
+def test_nested_ascconv():
+    code, records, err = run_main([EG_PROTO, '--nested', '--ascconv'])
+    assert_equal(code, 0)
+    record, = records
+    nested, = record['nested']
+    assert_equal(nested['name'], 'Protocol0')
+    assert_equal(nested['protocols'][0]['name'], 'MultiStep Controller')
+    assert_equal(nested['error'], None)
+    section, = record['ascconv']
+    assert_equal(section['escaped'], True)
+    assert_equal(section['value']['sProtConsistencyInfo.tSystemType'],
+                 '092')
+    assert_equal(section['value']['ulVersion'], 0x14b44b6)
+
+
+def test_nested_error():
+    # A bad nested protocol does not lose the outer tree
+    twin_bad = BAD_STR.replace('"', '""')
+    outer = ('<XProtocol> { <Name> "Outer" '
+             '<ParamString."Protocol0"> { "' + twin_bad + '" } '
+             '<ParamString."Protocol1"> { "' + GOOD_STR.replace('"', '""') +
+             '" } }')
+    code, records, err = run_main(['--nested'], outer)
+    assert_equal(code, 0)
+    record, = records
+    assert_equal(record['error'], None)
+    assert_equal(record['protocols'][0]['name'], 'Outer')
+    bad, good = record['nested']
+    assert_equal(bad['name'], 'Protocol0')
+    assert_equal(bad['protocols'], None)
+    assert_equal(bad['error']['type'], 'SyntaxError')
+    assert_equal(good['name'], 'Protocol1')
+    assert_equal(good['protocols'][0]['name'], 'Good')
+    assert_equal(good['error'], None)
+
+
+def test_forgiving():
+    # Diagnostics go into the record, not between the records
+    skipped = GOOD_STR.replace('<ParamLong', '? <ParamLong')
+    code, records, err = run_main(['--forgiving'], skipped)
+    assert_equal(code, 0)
+    record, = records
+    assert_equal(record['protocols'][0]['name'], 'Good')
+    assert_equal(record['error'], None)
+    assert_equal(len(record['warnings']), 1)
+    assert_true(record['warnings'][0].startswith('Skipped 2 illegal'))
+    # Forgiving parse that cannot recover is an error
+    code, records, err = run_main(['--forgiving'], BAD_STR)
+    assert_equal(code, 1)
+    record, = records
+    assert_equal(record['protocols'], None)
+    assert_equal(record['error']['type'], 'SyntaxError')
+    assert_true(record['warnings'][0].startswith('Syntax error at'))
+    # Strict parse has no warnings
+    code, records, err = run_main([], GOOD_STR)
+    assert_equal(records[0]['warnings'], [])
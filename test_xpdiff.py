@@ -0,0 +1,98 @@
+""" Tests for structural diff of parse trees
+"""
+
+from copy import deepcopy
+
+import xpparse as xpp
+import xpdiff as xpd
+from xptesting import get_sample
+
+from nose.tools import assert_equal, assert_not_equal, assert_raises
+
+
+def summary(changes):
+    return [(c.kind, xpd.format_path(c.path)) for c in changes]
+
+
+def test_format_path():
+    assert_equal(xpd.format_path(()), '')
+    assert_equal(xpd.format_path((0, 'blocks', 'Count', 'value')),
+                 '[0]/blocks/Count/value')
+
+
+def test_same():
+    proto_str = get_sample()[1]
+    first = xpp.parse(proto_str)
+    assert_equal(xpd.diff(first, first), [])
+    assert_equal(xpd.diff(first, xpp.parse(proto_str)), [])
+    # Spans and lazy values do not matter
+    other = xpp.XProtocolSymbols(spans=True,
+                                 lazy_strings=True).parse(proto_str)
+    assert_equal(xpd.diff(first, other), [])
+    assert_equal(xpd.HashedTree(first).digest,
+                 xpd.HashedTree(other).digest)
+    # Unless we ask for spans
+    assert_not_equal(xpd.diff(first, other, ignore=()), [])
+    # Leaf types matter
+    assert_equal(summary(xpd.diff([1, 'a'], [1.0, 'a'])),
+                 [('changed', '[0]')])
+    assert_equal(summary(xpd.diff([True], [1])), [('changed', '[0]')])
+
+
+def test_changes():
+    proto_str = get_sample()[1]
+    first = xpp.parse(proto_str)
+    second = deepcopy(first)
+    root = second[0]
+    # Change a value in a nested map
+    multistep = [v for v in root['blocks'][0]['value']
+                 if v['name'] == 'MultiStep'][0]
+    count = [v for v in multistep['value'] if v['type'] == 'param_long'][0]
+    count['value'] = 99
+    # Change an attribute, add an attribute
+    sub_step = [v for v in multistep['value'] if v['name'] == 'SubStep'][0]
+    sub_step['attrs'][0] = ('Label', 'Other step')
+    sub_step['attrs'].append(('Comment', 'New'))
+    # Insert into list of dependencies with repeated names
+    new_dep = dict(type='dependency', name='Extra', values=[], dll=None,
+                   context=None)
+    root['depends'].insert(3, new_dep)
+    # Remove card line from unnamed list
+    del root['cards'][0]['lines'][1]
+    # Change parameter type
+    root['blocks'][0]['value'][0] = dict(root['blocks'][0]['value'][0],
+                                         type='param_double')
+    # Remove key
+    del root['user_version']
+    prefix = '[0]/blocks/""/value/'
+    assert_equal(
+        summary(xpd.diff(first, second)),
+        [('changed', prefix + 'LoadHook'),
+         ('changed', prefix + 'MultiStep/value/SubStep/attrs/Label'),
+         ('added', prefix + 'MultiStep/value/SubStep/attrs/Comment'),
+         ('changed', prefix + 'MultiStep/value/{0}/value'.format(
+             count['name'])),
+         ('removed', '[0]/cards/Multistep/lines/[1]'),
+         ('added', '[0]/depends/[3]'),
+         ('removed', '[0]/user_version')])
+    changes = xpd.diff(first, second)
+    assert_equal(changes[1][2:], ('Step', 'Other step'))
+    assert_equal(changes[3][2:], (None, 99))
+    assert_equal(changes[5].new, new_dep)
+    assert_equal(changes[6][2:], (666.0, None))
+    # Reverse diff
+    assert_equal(summary(xpd.diff(second, first))[-3:],
+                 [('added', '[0]/cards/Multistep/lines/[1]'),
+                  ('removed', '[0]/depends/[3]'),
+                  ('added', '[0]/user_version')])
+
+
+def test_hashed_tree():
+    proto_str = get_sample()[1]
+    first = xpp.parse(proto_str)
+    hashed = xpd.HashedTree(first)
+    second = deepcopy(first)
+    second[0]['id'] = 1
+    assert_equal(summary(xpd.diff(hashed, second)), [('changed', '[0]/id')])
+    assert_equal(summary(xpd.diff(second, hashed)), [('changed', '[0]/id')])
+    assert_raises(ValueError, xpd.diff, hashed, second, ())
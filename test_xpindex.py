@@ -0,0 +1,116 @@
+""" Tests for sidecar indices of XProtocol archives
+"""
+
+import io
+import json
+from os.path import join as pjoin, dirname, exists
+import shutil
+import sys
+from tempfile import mkdtemp
+
+import xpparse as xpp
+import xpindex as xpx
+import xpjson as xpj
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+
+DATA_PATH = dirname(__file__)
+EG_PROTO = pjoin(DATA_PATH, 'xprotocol_sample.txt')
+
+DOC_FMT = """<XProtocol>
+{{
+  <Name> "{name}"
+  <ID> {id}
+  <Userversion> 2.0
+  <ParamString."Note"> {{ "Braces }} {{ and ""quotes"" <Name> "  }}
+  <ParamMap."Map"> {{
+    <ParamLong."Count"> {{ {id} }}
+  }}
+  <ParamCardLayout."Card"> {{
+    <Repr> "R"
+    <Control> {{ <Param> "Count" <Pos> 1 2 }}
+    <Line> {{ 1 2 3 4 }}
+  }}
+  <Dependency."Dep"> {{ "Count" <Dll> "Lib" }}
+}}
+"""
+
+
+def get_archive():
+    with open(EG_PROTO, 'rt') as fobj:
+        contents = fobj.read()
+    docs = [DOC_FMT.format(name='Doc{0}'.format(i), id=i) for i in range(5)]
+    docs[3] = docs[3].replace('<Name> "Doc3"', '<Name> "Say ""hi"""')
+    return ''.join(docs[:2] + [contents] + docs[2:] + ['\n'])
+
+
+def test_index():
+    tmpdir = mkdtemp()
+    try:
+        path = pjoin(tmpdir, 'archive.txt')
+        text = get_archive()
+        with open(path, 'wt') as fobj:
+            fobj.write(text)
+        expected = xpp.parse(text)
+        index = xpx.write_index(path)
+        assert_true(exists(xpx.index_path_for(path)))
+        documents = index['documents']
+        assert_equal(len(documents), 6)
+        assert_equal([d['name'] for d in documents],
+                     ['Doc0', 'Doc1', expected[2]['name'], 'Doc2',
+                      'Say ""hi""', 'Doc4'])
+        assert_equal(documents[1]['id'], 1)
+        assert_equal(documents[1]['user_version'], 2.0)
+        assert_equal([(b['tag'], b['name']) for b in documents[0]['blocks']],
+                     [('ParamString', 'Note'), ('ParamMap', 'Map'),
+                      ('ParamCardLayout', 'Card'), ('Dependency', 'Dep')])
+        # Nested protocols in strings do not count
+        assert_equal([(b['tag'], b['name']) for b in documents[2]['blocks']],
+                     [('ParamMap', '')])
+        with xpx.IndexedArchive(path) as archive:
+            for entry, tree in zip(archive.documents, expected):
+                assert_equal(archive.read(entry), tree)
+                assert_equal(archive.read_text(entry).encode('utf-8'),
+                             text.encode('utf-8')[entry['offset']:
+                                                  entry['end']])
+            entry, = archive.find(name='Doc4')
+            assert_equal(archive.read(entry), expected[5])
+            assert_equal(archive.find(id=2), [archive.documents[3]])
+            assert_equal(archive.find(name='Doc4', id=2), [])
+            assert_equal(archive.find(name='Say ""hi""'),
+                         [archive.documents[4]])
+            tree = expected[5]
+            assert_equal(archive.read_block(entry, 'Map'), tree['blocks'][1])
+            assert_equal(archive.read_block(entry, 'Card'), tree['cards'][0])
+            assert_equal(archive.read_block(entry, 'Dep'),
+                         tree['depends'][0])
+            assert_raises(KeyError, archive.read_block, entry, 'Missing')
+        # Stale index is rebuilt
+        with open(path, 'at') as fobj:
+            fobj.write(DOC_FMT.format(name='Doc5', id=5))
+        with xpx.IndexedArchive(path) as archive:
+            assert_equal(len(archive.documents), 7)
+            assert_equal(archive.read(archive.find(id=5)[0])['name'],
+                         'Doc5')
+        with open(xpx.index_path_for(path), 'rt') as fobj:
+            assert_equal(len(json.load(fobj)['documents']), 7)
+        # Command line selects documents and blocks
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            assert_equal(xpx.main([path, '--id', '5']), 0)
+            assert_equal(xpx.main([path, '--name', 'Doc1', '--block',
+                                   'Map']), 0)
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        trees = list(xpj.iter_load(io.StringIO(out)))
+        assert_equal(trees[0]['name'], 'Doc5')
+        assert_equal(trees[1], expected[1]['blocks'][1])
+        # Empty archive
+        empty = pjoin(tmpdir, 'empty.txt')
+        open(empty, 'wt').close()
+        assert_equal(xpx.build_index(empty)['documents'], [])
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,59 @@
+""" Tests for interning of parse trees
+"""
+
+import xpparse as xpp
+import xpintern as xpi
+from xptesting import get_sample
+
+from nose.tools import assert_equal, assert_true, assert_false
+
+
+def test_intern():
+    proto_str = get_sample()[1]
+    interner = xpi.Interner()
+    first = xpp.parse(proto_str)
+    second = xpp.parse(proto_str.replace('<ID> 1000001', '<ID> 1000002'))
+    i_first = interner.intern(first)
+    n_unique = len(interner)
+    i_second = interner.intern(second)
+    assert_equal(i_first, first)
+    assert_equal(i_second, second)
+    # Only the changed dict, and the list holding it, are new
+    assert_equal(len(interner), n_unique + 2)
+    p1, p2 = i_first[0], i_second[0]
+    assert_false(p1 is p2)
+    for key in ('blocks', 'cards', 'depends', 'EVAStringTable'):
+        assert_true(p1[key] is p2[key])
+    # Strings are shared too
+    assert_true(p1['name'] is p2['name'])
+    # Interning again gives the same objects
+    assert_true(interner.intern(second) is i_second)
+    # Leaf types stay distinct
+    assert_equal([type(v) for v in interner.intern([1, True, 1.0])],
+                 [int, bool, float])
+    assert_false(interner.intern([1]) is interner.intern([True]))
+    assert_true(interner.intern((1, 'a')) is interner.intern((1, 'a')))
+    assert_false(interner.intern((1, 'a')) is interner.intern([1, 'a']))
+    # Clear forgets
+    interner.clear()
+    assert_equal(len(interner), 0)
+    assert_false(interner.intern(second)[0] is p2)
+
+
+def test_intern_spans():
+    # Values with source spans are never shared
+    proto_str = get_sample()[1]
+    symbols = xpp.XProtocolSymbols(spans=True, lazy_strings=True)
+    first, second = xpi.intern_trees([symbols.parse(proto_str),
+                                      symbols.parse(proto_str)])
+    assert_false(first[0]['blocks'] is second[0]['blocks'])
+    assert_equal(xpp.decode_lazy(first[0]['name']),
+                 xpp.decode_lazy(second[0]['name']))
+
+
+def test_tag_names():
+    # The lexer shares tag name strings between parses
+    proto_str = get_sample()[1]
+    first, second = xpp.parse(proto_str), xpp.parse(proto_str)
+    assert_true(first[0]['blocks'][0]['value'][0]['name'] is
+                second[0]['blocks'][0]['value'][0]['name'])
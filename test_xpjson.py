@@ -0,0 +1,81 @@
+""" Tests for streaming JSON of parse trees
+"""
+
+import io
+import json
+import math
+
+import xpparse as xpp
+import xpjson as xpj
+from xptesting import get_sample
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+
+TYPES_STR = """<XProtocol> {
+  <Name> "Types"
+  <EVAStringTable> { 2 400 "Label one" 401 "Label two" }
+  <ParamDouble."D"> { <Precision> 2 2.0 }
+  <ParamLong."L"> { 2 }
+  <ParamBool."B"> { "true" }
+  <ParamString."S"> { "Say ""hello"" \\ caf\xe9" }
+  <ParamDouble."Empty"> { }
+}"""
+
+
+def test_types():
+    tree = xpp.parse(TYPES_STR)
+    text = xpj.dumps(tree)
+    assert_true('\n' not in text)
+    text.encode('ascii')
+    assert_equal(xpj.loads(text), tree)
+    # Plain JSON loses the tuples, but has the same floats and ints
+    plain = json.loads(text)
+    assert_equal(plain[0]['EVAStringTable'],
+                 {'$tuple': [2, [{'$tuple': [400, 'Label one']},
+                                 {'$tuple': [401, 'Label two']}]]})
+    blocks = plain[0]['blocks']
+    assert_equal(blocks[0]['attrs'], [{'$tuple': ['Precision', 2]}])
+    assert_equal(repr(blocks[0]['value']), '2.0')
+    assert_equal(repr(blocks[1]['value']), '2')
+    assert_equal(blocks[2]['value'], True)
+    assert_equal(blocks[4]['value'], None)
+    # Non-finite floats, dicts with tag-like keys, subclasses
+    odd = {'$tuple': (1, [2.5, float('inf'), float('-inf')]),
+           'x': xpp.SpanStr('s'), 'y': xpp.SpanFloat(1.0)}
+    back = xpj.loads(xpj.dumps([odd, float('nan')]))
+    assert_equal(back[0], odd)
+    assert_equal(type(back[0]['$tuple']), tuple)
+    assert_true(math.isnan(back[1]))
+    assert_raises(TypeError, xpj.dumps, {'a': object()})
+
+
+def test_round_trip():
+    contents, proto_str = get_sample()
+    for text in (contents, proto_str):
+        tree = xpp.parse(text)
+        assert_equal(xpj.loads(xpj.dumps(tree)), tree)
+        # Spans left out, lazy scalars written as values
+        lazy_tree = xpp.XProtocolSymbols(spans=True,
+                                         lazy_strings=True).parse(text)
+        assert_equal(xpj.loads(xpj.dumps(lazy_tree)), tree)
+
+
+def test_streaming():
+    contents, proto_str = get_sample()
+    trees = [xpp.parse(text) for text in (contents, proto_str, TYPES_STR)]
+    fobj = io.StringIO()
+    # Small buffer, so we write in many pieces
+    writer = xpj.JSONWriter(fobj, buffer_size=8)
+    writer.write_all(trees)
+    assert_equal(len(fobj.getvalue().splitlines()), 3)
+    fobj.seek(0)
+    assert_equal(list(xpj.iter_load(fobj)), trees)
+    fobj = io.StringIO()
+    xpj.dump_all(trees, fobj)
+    fobj.write('\n')
+    fobj.seek(0)
+    assert_equal(xpj.load(fobj), trees)
+    fobj = io.StringIO()
+    xpj.dump(trees[2], fobj)
+    assert_equal(fobj.getvalue(), xpj.dumps(trees[2]) + '\n')
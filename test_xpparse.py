@@ -1,15 +1,28 @@
 """ Test module to parse xprotocl text
 """
 
+from contextlib import redirect_stdout
 from os.path import join as pjoin, dirname
+from itertools import product
+import io
+import re
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import ply.lex as lex
 import ply.yacc as yacc
 
 import xpparse as xpp
+from xptesting import get_sample
 
 from nose.tools import (assert_true, assert_false, assert_equal,
                         assert_not_equal, assert_raises)
+from nose.plugins.skip import SkipTest
 
 
 DATA_PATH = dirname(__file__)
@@ -59,7 +72,16 @@ def parse_with_start(start, source):
                        debug=DEBUG,
                        tabmodule=None,
                        write_tables=False)
-    return parser.parse(source, lexer=lexer)
+    result = parser.parse(source, lexer=lexer)
+    # Recursive descent engine should give the same result
+    assert_equal(rd_parse_with_start(start, source), result)
+    return result
+
+
+def rd_parse_with_start(start, source):
+    lexer = lex.lex(module=SYMBOLS)
+    lexer.input(source)
+    return xpp.RecursiveDescentParser(lexer, SYMBOLS.p_error).parse(start)
 
 
 def assert_parsed(source, start, expected):
@@ -495,6 +517,25 @@ def test_param_map():
                                    value=1)]))
 
 
+def test_deep_nesting():
+    # Nested block lists do not recurse in the recursive descent parser
+    n = 150
+    source = ('<XProtocol> { <Name> "Deep" ' +
+              '<ParamMap."M"> { <PipeService."P"> { <Class> "C" ' * n +
+              '<ParamLong."L"> { 3 } ' + '} } ' * n + '}')
+    expected = xpp.parse(source)
+    assert_equal(xpp.parse(source, engine='rd'), expected)
+    spans = xpp.XProtocolSymbols(spans=True)
+    assert_equal([d['span'].text for d in
+                  iter_dicts(spans.parse(source, engine='rd'))],
+                 [d['span'].text for d in iter_dicts(spans.parse(source))])
+    # Blocks nested in attributes still recurse; too deep is a syntax error
+    n = 2000
+    source = ('<ParamArray."A"> { <Default> ' * n + '<ParamLong.""> { } ' +
+              '{ } } ' * n)
+    assert_raises(SyntaxError, rd_parse_with_start, 'param_array', source)
+
+
 def test_param_choice():
     assert_parsed("""
       <ParamChoice."ComposingFunction">
@@ -840,15 +881,45 @@ def test_errors():
     # String is the default
     jeb = xpp.XProtocolSymbols()
     assert_raises(SyntaxError, jeb.parse, source)
-    # Forgiving mode - characters outside known tokens appear as character
-    # tokens
+    # Forgiving mode - runs of characters outside known tokens are skipped,
+    # up to the next tag or brace that starts a block
     hilary = xpp.XProtocolSymbols(error_mode='forgiving')
     hilary.lexer.input(source)
-    assert_equal([t.value for t in hilary.lexer], ['tag', 10, 'q', 'strung'])
+    assert_equal([t.value for t in hilary.lexer], ['tag', 10])
+    hilary.lexer.input('<tag> q\x00 { " } } <a> \n\n? x\n} <b> 1 ?')
+    assert_equal([t.value for t in hilary.lexer],
+                 ['tag', '}', '}', 'a', '}', 'b', 1])
+    # Line numbers count skipped lines
+    assert_equal(hilary.lexer.lineno, 4)
+    # One diagnostic for a damaged region, then parse resumes
+    good = '<XProtocol> { <Name> "Good" <ParamLong."L"> { 3 } }'
+    damaged = ('<XProtocol> { <Name> "Bad" ' +
+               ''.join(chr(i % 256) for i in range(5000)).replace('<', '') +
+               ' }\n' + good)
+    out = io.StringIO()
+    with redirect_stdout(out):
+        assert_equal(hilary.parse(damaged), xpp.parse(good))
+        assert_equal(hilary.parse(damaged, engine='rd'), None)
+    assert_equal(out.getvalue().count('Skipped'), 2)
+    assert_true('offsets 27 to 5008' in out.getvalue())
     # Parse just quietly returns None
     assert_equal(hilary.parse('<XProtocol>'), None)
     # EOF syntax error
     assert_equal(hilary.parse('<'), None)
+    # Same for recursive descent engine
+    assert_raises(ValueError, xpp.XProtocolSymbols, engine='foo')
+    assert_raises(ValueError, jeb.parse, source, engine='foo')
+    assert_raises(SyntaxError, jeb.parse, source, engine='rd')
+    assert_raises(SyntaxError, jeb.parse, '<XProtocol>', engine='rd')
+    assert_equal(hilary.parse('<XProtocol>', engine='rd'), None)
+    assert_equal(hilary.parse('<', engine='rd'), None)
+    # Wrong list type, empty curly list for attribute
+    for bad in ('<name> {22 "23"}', '<name> {}', '<name> <XProtocol>'):
+        assert_raises(SyntaxError, parse_with_start, 'key_value', bad)
+        assert_raises(SyntaxError, rd_parse_with_start, 'key_value', bad)
+    # Missing methods in functor
+    assert_raises(SyntaxError, rd_parse_with_start, 'emc',
+                  '<Event."e"> { "a" } <Method."m"> { "b" }')
 
 
 def test_sample_file():
@@ -866,3 +937,636 @@ def test_sample_file():
     proto_str, asc_hdr = xpp.split_ascconv(xpp.strip_twin_quote(v['value']))
     res2 = xpp.parse(proto_str)
     assert_equal(len(res2), 2)
+    # Recursive descent engine gives the same results
+    assert_equal(xpp.parse(contents, engine='rd'), res)
+    assert_equal(xpp.parse(proto_str, engine='rd'), res2)
+    rd_symbols = xpp.XProtocolSymbols(engine='rd')
+    assert_equal(rd_symbols.parse(proto_str), res2)
+
+
+def strip_spans(obj):
+    # Return copy of parse results `obj` without 'span' keys
+    if isinstance(obj, dict):
+        return dict((k, strip_spans(v)) for k, v in obj.items()
+                    if k != 'span')
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(strip_spans(v) for v in obj)
+    return obj
+
+
+def iter_dicts(obj):
+    # Generate all dicts in parse results `obj`
+    if isinstance(obj, dict):
+        yield obj
+        obj = obj.values()
+    if isinstance(obj, (list, tuple)) or hasattr(obj, 'keys'):
+        for v in obj:
+            for d in iter_dicts(v):
+                yield d
+
+
+def test_spans():
+    contents, proto_str = get_sample()
+    for engine in ('lalr', 'rd'):
+        symbols = xpp.XProtocolSymbols(engine=engine, spans=True)
+        for source in (contents, proto_str):
+            res = symbols.parse(source)
+            # Without the spans, results are the same as usual
+            assert_equal(strip_spans(res), xpp.parse(source))
+            n_dicts = 0
+            for d in iter_dicts(res):
+                text = d['span'].text
+                assert_equal(len(d['span']), len(text))
+                if d.get('type') is None:  # controls
+                    assert_true(text.startswith(('<Control>', '"')))
+                    continue
+                assert_true(text.startswith('<'))
+                assert_true(text.endswith('}'))
+                if 'name' in d:
+                    assert_true(d['name'] in text)
+                if d['type'].startswith('param_') and d['type'] not in (
+                        'param_card_layout',):
+                    # Reparse of source for block gives same block
+                    assert_equal(rd_parse_with_start('block', text),
+                                 strip_spans(d))
+                n_dicts += 1
+            assert_true(n_dicts > 0)
+        # Top level spans cover whole protocols
+        res = symbols.parse(contents)
+        assert_equal(res[0]['span'].text, contents.strip())
+        assert_equal(res[0]['span'].source, contents)
+        # Scalar values carry their own spans
+        proto = res[0]['blocks'][0]['value'][2]
+        assert_true(isinstance(proto['value'], xpp.SpanStr))
+        assert_equal(proto['value'].span.text, '"' + proto['value'] + '"')
+        count = res[0]['blocks'][0]['value'][1]
+        assert_equal(count['value'], 1)
+        assert_true(isinstance(count['value'], xpp.SpanInt))
+        assert_equal(count['value'].span.text, '1')
+        res = symbols.parse(proto_str)
+        assert_true(isinstance(res[0]['user_version'], xpp.SpanFloat))
+        assert_equal(res[0]['user_version'].span.text, '666.0')
+        assert_equal(repr(res[0]['user_version'].span),
+                     'SourceSpan({0}, {1})'.format(
+                         proto_str.index('666.0'),
+                         proto_str.index('666.0') + 5))
+
+
+def test_lazy():
+    contents, proto_str = get_sample()
+    for engine in ('lalr', 'rd'):
+        symbols = xpp.XProtocolSymbols(engine=engine, lazy_strings=True)
+        for source in (contents, proto_str):
+            res = symbols.parse(source)
+            # Lazy scalars compare equal to decoded values
+            expected = xpp.parse(source)
+            assert_equal(res, expected)
+            decoded = xpp.decode_lazy(res)
+            assert_equal(decoded, expected)
+            assert_equal(repr(decoded), repr(expected))
+        # Numbers and short strings are plain values
+        res = symbols.parse(proto_str)
+        assert_true(type(res[0]['user_version']) is float)
+        assert_true(type(res[0]['id']) is int)
+        assert_true(type(res[0]['name']) is str)
+        # Long strings are lazy
+        text = 'x' * (xpp.LAZY_MIN_LENGTH - 2)
+        res = symbols.parse(proto_str.replace('MultiStep Controller', text))
+        name = res[0]['name']
+        assert_true(isinstance(name, xpp.LazyScalar))
+        assert_equal(name.text, '"' + text + '"')
+        assert_false(hasattr(name, '_value'))
+        assert_equal(name.value, text)
+        assert_true(type(name.value) is str)
+        # Value is cached
+        assert_true(hasattr(name, '_value'))
+        assert_equal(str(name), text)
+        assert_equal(repr(name), 'LazyScalar("' + text + '")')
+        assert_equal(hash(name), hash(text))
+        assert_true(name != text + 'x')
+        res = symbols.parse(proto_str.replace('MultiStep Controller',
+                                              text[:-1]))
+        assert_true(type(res[0]['name']) is str)
+        # Booleans are not lazy
+        res = symbols.parse(contents)
+        assert_equal(res[0]['blocks'][0]['value'][0]['attrs'],
+                     [('LimitRange', [False, True])])
+        # Lazy string value is span of input without copy
+        proto = res[0]['blocks'][0]['value'][2]['value']
+        assert_true(proto.source is contents)
+        expected = xpp.parse(contents)[0]['blocks'][0]['value'][2]
+        assert_equal(proto.value, expected['value'])
+    # Lazy and spans together
+    symbols = xpp.XProtocolSymbols(lazy_strings=True, spans=True)
+    res = symbols.parse(proto_str)
+    assert_equal(strip_spans(res), xpp.parse(proto_str))
+    assert_equal(res[0]['user_version'].span.text, '666.0')
+
+
+def test_string_linear():
+    # Previous string pattern, with backtracking exponential in input length
+    old_re = re.compile(
+        r'"(?:[^"]|(?:"")|(?:\\x[0-9a-fA-F]+)|(?:\\.))*"', re.VERBOSE)
+    lexer = SYMBOLS.lexer
+    # Same tokens as previous pattern for all short strings
+    for length in range(1, 6):
+        for chars in product('"\\xa1\n', repeat=length):
+            source = '"' + ''.join(chars)
+            match = old_re.match(source)
+            lexer.input(source)
+            try:
+                tok = lexer.token()
+            except SyntaxError:
+                assert_equal(match, None)
+                continue
+            assert_equal(tok.value, match.group()[1:-1])
+    # Unterminated strings, long runs of backslashes, hex escapes and doubled
+    # quotes
+    n = 100000
+    for source in ('"' + '\\' * n,
+                   '"' + 'a\\x1' * n,
+                   '"' + '\\"' * n,
+                   '"' + '""\\' * n,
+                   '"' + 'a""' * n + '\n' * n):
+        start = time.time()
+        assert_raises(SyntaxError, SYMBOLS.parse, source)
+        assert_raises(SyntaxError, SYMBOLS.parse, source, engine='rd')
+        assert_true(time.time() - start < 2)
+    # Long terminated strings
+    source = '"' + 'a""\\' * n + '"'
+    start = time.time()
+    assert_tokens(source, [source[1:-1]])
+    assert_true(time.time() - start < 2)
+
+
+def test_ascconv_value():
+    assert_equal(xpp.ascconv_value('0x14b44b6'), 0x14b44b6)
+    assert_equal(xpp.ascconv_value('-434'), -434)
+    assert_equal(xpp.ascconv_value('-2.65859e-005'), -2.65859e-005)
+    assert_equal(xpp.ascconv_value('"1H"'), '1H')
+    assert_equal(xpp.ascconv_value('""1H""'), '1H')
+    assert_equal(xpp.ascconv_value('""'), '')
+    assert_equal(xpp.ascconv_value('""""'), '')
+    assert_equal(xpp.ascconv_value('"a ""b"" c"'), 'a ""b"" c')
+    assert_equal(xpp.ascconv_value('""a """"b"""" c""'), 'a ""b"" c')
+    assert_equal(xpp.ascconv_value('word'), 'word')
+
+
+def test_iter_ascconv():
+    with open(EG_PROTO, 'rt') as fobj:
+        contents = fobj.read()
+    sections = list(xpp.iter_ascconv(contents))
+    assert_equal(len(sections), 1)
+    section = sections[0]
+    assert_equal(section['type'], 'ascconv')
+    assert_true(section['escaped'])
+    assert_true(section['span'].text.startswith('### ASCCONV BEGIN ###\n'))
+    assert_true(section['span'].text.endswith('### ASCCONV END ###'))
+    assert_true(section['content'].text.startswith('ulVersion '))
+    values = dict(section['value'])
+    assert_equal(len(section['value']), 917)
+    assert_equal(values['ulVersion'], 0x14b44b6)
+    assert_equal(values['tSequenceFileName'], '%SiemensSeq%\\ep2d_diff')
+    assert_equal(values['sProtConsistencyInfo.flNominalB0'], 2.89362)
+    assert_equal(values['lProtID'], -434)
+    assert_equal(values['asCoilSelectMeas[0].aFFT_SCALE[9].bValid'], 1)
+    # Same as split_ascconv on unescaped text
+    unescaped = xpp.strip_twin_quote(contents)
+    proto_str, asc_hdr = xpp.split_ascconv(unescaped)
+    section2, = xpp.iter_ascconv(unescaped)
+    assert_false(section2['escaped'])
+    assert_equal(section2['content'].text.rstrip('\n'), asc_hdr)
+    assert_equal(section2['value'], section['value'])
+    # Multiple sections, with a section outside strings, markers with
+    # extra information, comments, and unmatched markers
+    source = ('### ASCCONV END ###\n' +
+              contents +
+              '\n### ASCCONV BEGIN object=MrProtDataImpl version=1 ###\n'
+              'lA = 1  # comment\n'
+              '# Comment line\n'
+              'tB = "b"\n'
+              '### ASCCONV END ###\n'
+              '### ASCCONV BEGIN ###\n' +
+              contents)
+    sections = list(xpp.iter_ascconv(source))
+    assert_equal(len(sections), 3)
+    assert_equal([s['escaped'] for s in sections], [True, False, True])
+    assert_equal(sections[1]['value'], [('lA', 1), ('tB', 'b')])
+    assert_equal(sections[2]['value'], section['value'])
+    for s in sections:
+        assert_true(s['span'].source is source)
+        assert_true(source[s['span'].start:].startswith(
+            '### ASCCONV BEGIN'))
+    offset = len(source) - len(contents)
+    assert_equal(sections[2]['span'].start, section['span'].start + offset)
+    assert_equal(sections[2]['span'].end, section['span'].end + offset)
+    assert_equal(list(xpp.iter_ascconv('No sections')), [])
+
+
+def test_ascconv_arrays():
+    if np is None:
+        raise SkipTest('Need numpy for ascconv_arrays')
+    source = """\
+sKSpace.lBaseResolution = 128
+asList[0].a[1].flFactor = 3.5
+asList[0].a[1].bValid = 1
+asList[0].a[0].flFactor = 2
+asList[1].a[2].bValid = 1
+asList[0].tName = ""Coil""
+asList[2].tName = ""Other""
+sRXSPEC.alDwellTime[2] = 0x10
+sGroup.adDist[1] = 4
+"""
+    arrays = xpp.ascconv_arrays(source)
+    assert_equal(sorted(arrays),
+                 ['asList[]', 'asList[].a[]', 'sGroup.adDist[]',
+                  'sRXSPEC.alDwellTime[]'])
+    arr = arrays['asList[].a[]']
+    assert_equal(arr.shape, (2, 3))
+    assert_equal(arr.dtype.names, ('flFactor', 'bValid'))
+    assert_equal(arr['flFactor'].dtype, np.float64)
+    assert_equal(arr['bValid'].dtype, np.int64)
+    assert_true(np.all(arr['flFactor'] == [[2, 3.5, 0], [0, 0, 0]]))
+    assert_true(np.all(arr['bValid'] == [[0, 1, 0], [0, 0, 1]]))
+    assert_true(np.all(arrays['asList[]']['tName'] == ['Coil', '', 'Other']))
+    # Arrays with no leaf names are not structured
+    assert_true(np.all(arrays['sRXSPEC.alDwellTime[]'] == [0, 0, 16]))
+    # Siemens double names give float arrays
+    assert_equal(arrays['sGroup.adDist[]'].dtype, np.float64)
+    # Same from parsed assignments
+    arrays2 = xpp.ascconv_arrays(xpp.parse_ascconv(source))
+    for key, arr in arrays.items():
+        assert_equal(arrays2[key].dtype, arr.dtype)
+        assert_true(np.all(arrays2[key] == arr))
+    # Sample file
+    with open(EG_PROTO, 'rt') as fobj:
+        contents = fobj.read()
+    proto_str, asc_hdr = xpp.split_ascconv(xpp.strip_twin_quote(contents))
+    arrays = xpp.ascconv_arrays(asc_hdr)
+    fft_scale = arrays['asCoilSelectMeas[].aFFT_SCALE[]']
+    assert_equal(fft_scale.shape, (1, 12))
+    assert_true(np.all(fft_scale['lRxChannel'] == np.arange(1, 13)))
+    assert_equal(fft_scale['flFactor'][0, 9], 4.57011)
+    section, = xpp.iter_ascconv(contents)
+    arrays2 = xpp.ascconv_arrays(section['value'])
+    for key, arr in arrays.items():
+        assert_equal(arrays2[key].dtype, arr.dtype)
+        assert_true(np.all(arrays2[key] == arr))
+
+
+def test_threaded_parse():
+    # Parse concurrently from many threads with shared parser
+    contents, proto_str = get_sample()
+    sources = [contents, proto_str,
+               '<XProtocol> { <Name> "Short" <ParamLong."L"> { 3 } }',
+               '<XProtocol> { <Name> "Bad" <ParamLong."L"> { 3.0 } }',
+               '<XProtocol> { <Name> "Bad lex" <ParamLong."L"> { ? } }']
+    symbols = xpp.XProtocolSymbols()
+    forgiving = xpp.XProtocolSymbols(error_mode='forgiving')
+    spans = xpp.XProtocolSymbols(spans=True)
+
+    def parse_or_error(symbols, source, engine):
+        try:
+            return symbols.parse(source, engine=engine)
+        except SyntaxError as e:
+            return (str(e), e.lineno)
+
+    cases = [(s, source, engine)
+             for s in (symbols, spans, forgiving)
+             for source in sources
+             for engine in ('lalr', 'rd')]
+    expected = [parse_or_error(*case) for case in cases]
+    failures = []
+    errors = []
+
+    def worker(seed):
+        try:
+            check_cases(seed)
+        except Exception as e:
+            errors.append((seed, e))
+
+    def check_cases(seed):
+        for i in range(20):
+            case_no = (seed * 7 + i * 3) % len(cases)
+            s, source, engine = cases[case_no]
+            result = parse_or_error(s, source, engine)
+            if s is spans and isinstance(result, list):
+                for d in iter_dicts(result):
+                    if d['span'].source is not source:
+                        failures.append((seed, i, 'span source'))
+                result = strip_spans(result)
+                exp = strip_spans(expected[case_no])
+            else:
+                exp = expected[case_no]
+            if result != exp:
+                failures.append((seed, i, case_no))
+
+    threads = [threading.Thread(target=worker, args=(seed,))
+               for seed in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(errors, [])
+    assert_equal(failures, [])
+    # Module level parse function is also safe
+    results = {}
+
+    def module_worker(seed):
+        try:
+            results[seed] = [xpp.parse(sources[seed % 3]) for i in range(5)]
+        except Exception as e:
+            errors.append((seed, e))
+
+    threads = [threading.Thread(target=module_worker, args=(seed,))
+               for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(errors, [])
+    assert_equal(sorted(results), list(range(8)))
+    for seed, seed_results in results.items():
+        for result in seed_results:
+            # Serial result from default symbols, lalr engine
+            assert_equal(result, expected[(seed % 3) * 2])
+
+
+def test_threaded_error_recovery():
+    # yacc error recovery, and so p_error, in many threads at once
+    good = '<XProtocol> { <Name> "Good" <ParamLong."L"> { 3 } }\n'
+    bad = ('<XProtocol> { <Name> "Bad" <ParamLong."L"> { 3.0 } }\n'
+           '<XProtocol> { <Name> "Bad" <ParamBool."B"> { 1 } }\n')
+    source = (good + bad) * 20 + good
+    forgiving = xpp.XProtocolSymbols(error_mode='forgiving')
+    with redirect_stdout(io.StringIO()) as out:
+        expected = forgiving.parse(source, engine='lalr')
+    n_messages = len(out.getvalue().splitlines())
+    assert_true(n_messages > 40)
+    barrier = threading.Barrier(8)
+    results = []
+    errors = []
+
+    def worker():
+        try:
+            barrier.wait()
+            for i in range(5):
+                results.append(forgiving.parse(source, engine='lalr'))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    with redirect_stdout(io.StringIO()) as out:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert_equal(errors, [])
+    assert_equal(results, [expected] * 40)
+    assert_equal(len(out.getvalue().splitlines()), n_messages * 40)
+
+
+def test_iterparse():
+    # Yield concatenated XProtocols one at a time
+    contents, proto_str = get_sample()
+    # Braces and doubled quotes in strings do not end documents
+    odd = ('<XProtocol> { <Name> "Odd } {{ ""}"" " '
+           '<ParamString."S"> { "}" } }')
+    source = '\n'.join([contents, proto_str, odd, proto_str]) + '\n\n'
+    expected = xpp.parse(source)
+    assert_equal(len(expected), 6)
+    for engine in ('lalr', 'rd'):
+        assert_equal(list(xpp.iterparse(source, engine=engine)), expected)
+    texts = [text for text, lineno in xpp.split_documents(source)]
+    assert_equal(''.join(texts), source.rstrip('\n'))
+    assert_equal(xpp.parse(texts[3]), [expected[3]])
+    # Reading from file objects, in small chunks
+    for chunk_size in (1, 7, 2 ** 16):
+        fobj = io.StringIO(source)
+        it = xpp.iterparse(fobj, chunk_size=chunk_size)
+        assert_equal(next(it), expected[0])
+        assert_equal(list(it), expected[1:])
+    # Same documents from pieces of any size
+    documents = list(xpp.split_documents(source))
+    for size in (1, 3, 1000):
+        splitter = xpp.DocumentSplitter()
+        found = []
+        for i in range(0, len(source), size):
+            found += splitter.feed(source[i:i + size])
+        assert_equal(found + splitter.close(), documents)
+    splitter = xpp.DocumentSplitter()
+    assert_equal(splitter.feed(odd[:-1]), [])
+    assert_equal(splitter.feed('} \n junk'), [(odd, 1)])
+    assert_equal(splitter.close(), [(' \n junk', 1)])
+    # Spans refer to the text of each document
+    spans = xpp.XProtocolSymbols(spans=True)
+    for text, tree in zip(texts, spans.iterparse(source)):
+        assert_equal(tree['span'].source, text)
+        assert_equal(tree['span'].text, text.strip())
+    # Errors give line numbers in the whole input
+    bad = '<XProtocol> { <Name> "Bad" <ParamLong."L"> { 3.0 } }'
+    n_lines = source.count('\n')
+    for engine in ('lalr', 'rd'):
+        it = xpp.iterparse(source + bad, engine=engine)
+        for i in range(6):
+            next(it)
+        try:
+            next(it)
+        except SyntaxError as e:
+            assert_equal(e.lineno, n_lines + 1)
+            assert_true("Line is: '{0}'".format(bad) in str(e))
+        else:
+            raise AssertionError('Expected SyntaxError')
+    # Trailing text gives a syntax error
+    it = xpp.iterparse(odd + ' <XProtocol> {')
+    assert_equal(next(it), expected[3])
+    assert_raises(SyntaxError, next, it)
+    assert_raises(SyntaxError, list, xpp.iterparse(odd + '}'))
+    # Forgiving mode skips bad documents
+    forgiving = xpp.XProtocolSymbols(error_mode='forgiving')
+    assert_equal(list(forgiving.iterparse(bad + odd, engine='rd')),
+                 [expected[3]])
+    assert_equal(list(xpp.iterparse('  \n')), [])
+
+
+def test_split_segments():
+    with open(EG_PROTO, 'rt') as fobj:
+        contents = fobj.read()
+    source = '\n'.join([contents, '<XProtocol> { <Name> "a\n}\n""\n" }'] * 3)
+    for size in (1, 10, 1000, len(source), 10 * len(source)):
+        segments = xpp.split_segments(source, size)
+        assert_equal(segments[0][0], 0)
+        assert_equal(segments[-1][1], len(source))
+        for (start, end), (next_start, next_end) in zip(segments[:-1],
+                                                        segments[1:]):
+            assert_equal(end, next_start)
+            assert_true(end > start)
+            # Cut after a newline, outside strings
+            assert_equal(source[end - 1], '\n')
+            assert_equal(source.count('"', 0, end) % 2, 0)
+    assert_equal(xpp.split_segments(''), [])
+
+
+def test_parallel_parse():
+    # Lex in parallel, parse merged tokens
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    contents, proto_str = get_sample()
+    source = '\n'.join([contents, proto_str])
+    bad_parse = proto_str + '\n<XProtocol> { <ParamLong."L"> { 3 } }'
+    bad_lex = proto_str + '\n<XProtocol> { <Name> "Bad" ? }'
+    spans = xpp.XProtocolSymbols(spans=True)
+    lazy = xpp.XProtocolSymbols(lazy_strings=True)
+    forgiving = xpp.XProtocolSymbols(error_mode='forgiving')
+
+    def parse_or_error(symbols, text, **kwargs):
+        try:
+            return symbols.parse(text, **kwargs)
+        except SyntaxError as e:
+            return (str(e), e.lineno)
+
+    with ProcessPoolExecutor(2) as processes, ThreadPoolExecutor(2) as threads:
+        for executor, engine in product((processes, threads), ('lalr', 'rd')):
+            for text in (source, bad_parse, bad_lex):
+                for symbols in (xpp.XPROTOCOL_SYMBOLS, forgiving):
+                    expected = parse_or_error(symbols, text, engine=engine)
+                    assert_equal(parse_or_error(symbols, text, engine=engine,
+                                                executor=executor,
+                                                segment_size=1000),
+                                 expected)
+            expected = spans.parse(source, engine=engine)
+            result = spans.parse(source, engine=engine, executor=executor,
+                                 segment_size=1000)
+            assert_equal(strip_spans(result), strip_spans(expected))
+            assert_equal([d['span'].text for d in iter_dicts(result)],
+                         [d['span'].text for d in iter_dicts(expected)])
+            result = lazy.parse(source, engine=engine, executor=executor,
+                                segment_size=1000)
+            proto = result[0]['blocks'][0]['value'][2]['value']
+            assert_true(isinstance(proto, xpp.LazyScalar))
+            assert_true(proto.source is source)
+            assert_equal(xpp.decode_lazy(result), xpp.parse(source))
+        # Short input parses here
+        assert_equal(xpp.parse(proto_str, executor=processes),
+                     xpp.parse(proto_str))
+        # Forgiving skips carry on past the end of a segment, and past braces
+        # at the end of a segment, as they do for serial lexing
+        for text in ('<XProtocol> { <Name> "Skip" ? 3\n4 5\n6\n'
+                     '<ParamLong."L"> { 7 } }',
+                     '<XProtocol> { <Name> "Skip" ? {\n8 9\n'
+                     '<ParamLong."L"> { 7 } }'):
+            out = io.StringIO()
+            with redirect_stdout(out):
+                expected = forgiving.parse(text)
+            assert_equal(expected[0]['blocks'][0]['value'], 7)
+            for executor, segment_size in product((processes, threads),
+                                                  (1, 5, 40)):
+                parallel_out = io.StringIO()
+                with redirect_stdout(parallel_out):
+                    assert_equal(forgiving.parse(text, executor=executor,
+                                                 segment_size=segment_size),
+                                 expected)
+                assert_equal(parallel_out.getvalue(), out.getvalue())
+
+
+def test_limits():
+    # Limits on input size, shape and parse time
+    from concurrent.futures import ThreadPoolExecutor
+    source = ('<XProtocol> {\n<Name> "Limits"\n'
+              '<ParamMap."M"> { <ParamArray."A"> { <Default> <ParamLong."">'
+              ' { } { 1 2 3 } { 4 } } }\n}')
+    good = xpp.parse(source)
+    for limits, failing in (
+            (xpp.ParseLimits(max_size=len(source)), 'max_size'),
+            (xpp.ParseLimits(max_tokens=23), 'max_tokens'),
+            (xpp.ParseLimits(max_depth=4), 'max_depth'),
+            (xpp.ParseLimits(max_string=6), 'max_string'),
+            (xpp.ParseLimits(max_list=3), 'max_list'),
+            (xpp.ParseLimits(timeout=10), 'timeout')):
+        under = xpp.XProtocolSymbols(limits=limits)
+        fields = limits._asdict()
+        if failing == 'timeout':
+            fields['timeout'] = -1
+        else:
+            fields[failing] -= 1
+        over = xpp.XProtocolSymbols(error_mode='forgiving',
+                                    limits=xpp.ParseLimits(**fields))
+        with ThreadPoolExecutor(2) as executor:
+            for engine, kwargs in (('lalr', {}), ('rd', {}),
+                                   ('lalr', dict(executor=executor,
+                                                 segment_size=10))):
+                assert_equal(under.parse(source, engine, **kwargs), good)
+                if failing == 'timeout':
+                    # Time checked every so many tokens
+                    text = '\n'.join([source] * xpp.TIME_CHECK_INTERVAL)
+                else:
+                    text = source
+                with assert_raises(xpp.ParseLimitError) as cm:
+                    over.parse(text, engine, **kwargs)
+                assert_equal(cm.exception.limit, failing)
+    # Lazy strings are spans of the source, with quotes
+    long_source = source.replace('Limits', 'L' * 100)
+    lazy = xpp.XProtocolSymbols(lazy_strings=True,
+                                limits=xpp.ParseLimits(max_string=99))
+    assert_raises(xpp.ParseLimitError, lazy.parse, long_source)
+    assert_equal(xpp.get_symbols(
+        lazy_strings=True,
+        limits=xpp.ParseLimits(max_string=100)).parse(long_source),
+        xpp.parse(long_source))
+    # Line of the error
+    with assert_raises(xpp.ParseLimitError) as cm:
+        xpp.XProtocolSymbols(limits=xpp.ParseLimits(max_depth=1)).parse(
+            source)
+    assert_equal(cm.exception.lineno, 3)
+    assert_true(str(cm.exception).startswith('Input exceeds max_depth of 1'))
+
+
+def test_progress_cancel():
+    # Progress callback and cancellation
+    contents = '\n'.join(get_sample())
+    expected = xpp.parse(contents)
+    lexer = xpp.XPROTOCOL_SYMBOLS.lexer.clone()
+    lexer.input(contents)
+    n_tokens = len(list(lexer))
+    total = len(contents)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(2) as executor:
+        for engine, kwargs in (('lalr', {}), ('rd', {}),
+                               ('lalr', dict(executor=executor,
+                                             segment_size=10000))):
+            calls = []
+            assert_equal(xpp.parse(contents, engine,
+                                   progress=lambda *args: calls.append(args),
+                                   progress_interval=10, **kwargs),
+                         expected)
+            assert_equal(len(calls), n_tokens // 10 + 1)
+            assert_equal(calls[-1], (total, total))
+            done = [c[0] for c in calls]
+            assert_equal(done, sorted(done))
+            assert_true(all(c[1] == total for c in calls))
+            # Cancel from the progress callback
+            cancel = threading.Event()
+
+            def progress(done, total):
+                if done > total // 2:
+                    cancel.set()
+
+            assert_raises(xpp.ParseCancelled, xpp.parse, contents, engine,
+                          progress=progress, cancel=cancel,
+                          progress_interval=10, **kwargs)
+            # Already cancelled
+            assert_raises(xpp.ParseCancelled, xpp.parse, contents, engine,
+                          cancel=cancel, progress_interval=1, **kwargs)
+    # The pair from the cancelled parse is fine to use again
+    assert_equal(xpp.parse(contents), expected)
+
+
+def test_error_record():
+    try:
+        xpp.parse('<XProtocol> {\n<ParamLong."L"> { 3.0 } }')
+    except SyntaxError as e:
+        record = xpp.error_record(e)
+    assert_equal(record['type'], 'SyntaxError')
+    assert_equal(record['lineno'], 2)
+    assert_true(record['message'])
+    assert_equal(xpp.error_record(ValueError('bad')),
+                 dict(type='ValueError', message='bad', lineno=None))
@@ -0,0 +1,97 @@
+""" Tests for path queries over parse trees
+"""
+
+import xpparse as xpp
+import xpquery as xpq
+from xptesting import get_sample
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+
+def naive_find(obj, node_type, name):
+    # Recursive search for comparison
+    found = []
+    if isinstance(obj, dict):
+        if obj.get('type') == node_type and obj.get('name') == name:
+            found.append(obj)
+        for value in obj.values():
+            found += naive_find(value, node_type, name)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            found += naive_find(value, node_type, name)
+    return found
+
+
+def test_queries():
+    contents, proto_str = get_sample()
+    tree = xpp.parse(proto_str)
+    outer = xpp.parse(contents)
+    assert_equal(xpq.find_all(outer, '//ParamLong[name="Count"]/value'), [1])
+    assert_equal(xpq.find_all(outer, 'XProtocol/name'),
+                 ['PhoenixMetaProtocol'])
+    assert_equal(xpq.find_all(tree, '/XProtocol/name'),
+                 ['MultiStep Controller'])
+    assert_equal(xpq.find_all(tree, '/XProtocol/ParamMap/ParamMap/name'),
+                 ['DMWL', 'MultiStep', 'Properties', 'PerformanceCache'])
+    assert_equal(xpq.find_all(tree, '//*[@Label="Step"]/name'), ['SubStep'])
+    assert_equal(xpq.find_all(tree, '//ParamChoice/@Limit')[0],
+                 ['Angio', 'Spine', 'Adaptive'])
+    # Attribute step with predicate on parameter in attribute
+    assert_equal(
+        xpq.find_all(tree, '//ParamArray/@Default[type="param_bool"]/name'),
+        ['""'] * 3)
+    assert_equal(xpq.find_all(tree, '//Dependency[context!="ONLINE"]/name'),
+                 ['Value_FALSE'])
+    assert_equal(len(xpq.find_all(tree, '//Dependency[dll]')), 24)
+    assert_equal(len(xpq.find_all(tree, '//ParamFunctor/method')), 3)
+    assert_equal(xpq.find_all(tree, '//ParamCardLayout/name'),
+                 ['Multistep', 'Inline Compose'])
+    # Nested descendant steps do not repeat results
+    all_longs = xpq.find_all(tree, '//ParamLong')
+    assert_equal(len(all_longs), 20)
+    assert_equal(xpq.find_all(tree, '//ParamMap//ParamLong'), all_longs)
+    assert_equal(xpq.find_all(tree, '//ParamLong[name="LoadHook"]'),
+                 naive_find(tree, 'param_long', 'LoadHook'))
+    # Literal types are strict
+    tree = xpp.parse('<XProtocol> { <Name> "N" <ParamLong."A"> { 1 } '
+                     '<ParamBool."B"> { "true" } '
+                     '<ParamDouble."C"> { 1.0 } }')
+    assert_equal(xpq.find_all(tree, '//*[value=1]/name'), ['A'])
+    assert_equal(xpq.find_all(tree, '//*[value=true]/name'), ['B'])
+    assert_equal(xpq.find_all(tree, '//*[value=1.0]/name'), ['C'])
+    assert_equal(xpq.find_all(tree, '//*[value!=1]/name'), ['B', 'C'])
+    assert_equal(xpq.find_all(tree, '//value'), [1, True, 1.0])
+    # Lazy values and spans
+    lazy = xpp.XProtocolSymbols(lazy_strings=True, spans=True).parse(proto_str)
+    assert_equal(xpq.find_all(lazy, '//*[@Label="Step"]/name'), ['SubStep'])
+
+
+def test_compile():
+    proto_str = get_sample()[1]
+    tree = xpp.parse(proto_str)
+    query = xpq.compile_query('//ParamLong[name="Count"]/value')
+    assert_true(xpq.compile_query('//ParamLong[name="Count"]/value')
+                is query)
+    assert_equal(query(tree), [])
+    assert_equal(query.find_first(tree, 'default'), 'default')
+    assert_equal(xpq.compile_query('//ParamMap/name').find_first(tree), '""')
+    for bad in ('', '/', '//ParamLong/', 'ParamFoo', '//*[name=]',
+                '//*[name="a"', '//*[=1]', 'name name', '//*[name=foo]',
+                '//ParamLong#', '//ParamFunctor[1]'):
+        assert_raises(xpq.QueryError, xpq.Query, bad)
+
+
+def test_name_index():
+    proto_str = get_sample()[1]
+    tree = xpp.parse(proto_str)
+    index = xpq.NameIndex(tree)
+    assert_equal(len(index.get('SubStep')), 1)
+    assert_equal(index.get('not there'), [])
+    for query in ('//ParamArray[name="SubStep"]/@Label',
+                  '//*[name="MultiStep"]/ParamBool/name',
+                  '//ParamBool[name="AlwaysFalse"]',
+                  '//ParamLong/name',
+                  '/XProtocol/name'):
+        assert_equal(xpq.find_all(index, query), xpq.find_all(tree, query))
+    assert_equal(xpq.find_all(index, '//ParamArray[name="SubStep"]/@Label'),
+                 ['Step'])
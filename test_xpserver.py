@@ -0,0 +1,96 @@
+""" Tests for parse server and client
+"""
+
+import os
+from os.path import join as pjoin
+import socket
+import stat
+import threading
+
+import xpparse as xpp
+import xpserver as xps
+import xpclient as xpc
+import xpbinary as xpb
+from xptesting import (DATA_PATH, EG_PROTO, GOOD_STR, BAD_STR,
+                       write_file, temp_dir)
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+
+def test_server():
+    with temp_dir() as tmpdir:
+        socket_path = pjoin(tmpdir, 'xpparse.sock')
+        server = xps.XProtocolServer(socket_path, workers=2,
+                                     roots=[DATA_PATH, tmpdir])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            # Only we can connect, and only one server
+            assert_equal(stat.S_IMODE(os.stat(socket_path).st_mode), 0o600)
+            assert_raises(OSError, xps.XProtocolServer, socket_path, workers=1)
+            with open(EG_PROTO, 'rt') as fobj:
+                contents = fobj.read()
+            with xpc.XProtocolClient(socket_path) as client:
+                assert_equal(client.parse_file(EG_PROTO), xpp.parse(contents))
+                assert_equal(client.parse(GOOD_STR), xpp.parse(GOOD_STR))
+                with assert_raises(SyntaxError) as cm:
+                    client.parse(BAD_STR)
+                assert_equal(cm.exception.lineno, 1)
+                assert_raises(OSError, client.parse_file,
+                              pjoin(tmpdir, 'missing.txt'))
+                # Files outside the roots
+                assert_raises(PermissionError, client.parse_file,
+                              '/etc/passwd')
+                assert_raises(PermissionError, client.parse_file,
+                              pjoin(tmpdir, '..', 'other.txt'))
+                # Connection still good after errors
+                non_ascii = GOOD_STR.replace('Good', 'G\xf6\xf6d')
+                result = client.parse(non_ascii)
+                assert_equal(xpb.to_python(result), xpp.parse(non_ascii))
+            # Options go to the server parser
+            with xpc.XProtocolClient(socket_path, error_mode='forgiving',
+                                     engine='rd') as client:
+                assert_equal(client.parse(BAD_STR), None)
+                assert_equal(client.parse(GOOD_STR), xpp.parse(GOOD_STR))
+            # Only known options and values
+            for options in (dict(debug=True), dict(engine='foo'),
+                            dict(spans=1)):
+                with xpc.XProtocolClient(socket_path, **options) as client:
+                    assert_raises(ValueError, client.parse, GOOD_STR)
+
+            # Concurrent clients
+            results = {}
+
+            def work(i):
+                with xpc.XProtocolClient(socket_path) as client:
+                    results[i] = [xpb.to_python(client.parse(GOOD_STR))
+                                  for j in range(5)]
+
+            threads = [threading.Thread(target=work, args=(i,))
+                       for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert_equal(results, dict((i, [xpp.parse(GOOD_STR)] * 5)
+                                       for i in range(4)))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            assert_equal(os.path.exists(socket_path), False)
+
+
+def test_socket_file():
+    with temp_dir() as tmpdir:
+        socket_path = pjoin(tmpdir, 'xpparse.sock')
+        # Stale socket, with no server, is replaced
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(socket_path)
+        sock.close()
+        server = xps.XProtocolServer(socket_path, workers=1)
+        server.server_close()
+        # Other files are not
+        write_file(socket_path, 'Not a socket')
+        assert_raises(OSError, xps.XProtocolServer, socket_path, workers=1)
+        assert_true(os.path.exists(socket_path))
@@ -0,0 +1,101 @@
+""" Tests for NumPy structural index of XProtocol text
+"""
+
+from os.path import join as pjoin, dirname
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import xpparse as xpp
+import xpstruct as xps
+import xpindex as xpx
+
+from nose.tools import assert_equal, assert_true, assert_raises
+from nose.plugins.skip import SkipTest
+
+
+DATA_PATH = dirname(__file__)
+EG_PROTO = pjoin(DATA_PATH, 'xprotocol_sample.txt')
+
+SMALL_STR = """<XProtocol> {
+  <Name> "Small { "" } "
+  <ParamArray."A">
+                                                      { <Default> <ParamLong."">
+    { } { 1 } { 2 } }
+  <ParamString."S"> { "<ParamLong.""Fake""> { }" }
+}
+<XProtocol> { <Name> "Two" <ParamLong."L"> { 3 } }"""
+
+
+def spanned_dicts(obj):
+    """ Generate dicts with spans in parse tree `obj` """
+    if isinstance(obj, dict):
+        if 'span' in obj:
+            yield obj
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        for value in obj:
+            for d in spanned_dicts(value):
+                yield d
+
+
+def test_structural_index():
+    if np is None:
+        raise SkipTest('Need numpy for structural index')
+    for source in (SMALL_STR, open(EG_PROTO, 'rt').read()):
+        index = xps.StructuralIndex(source)
+        data = source.encode('utf-8')
+        arr = np.frombuffer(data, dtype=np.uint8)
+        assert_equal(arr[index.opens].tolist(), [ord('{')] * len(index))
+        assert_equal(arr[index.closes].tolist(), [ord('}')] * len(index))
+        assert_true(np.all(index.closes > index.opens))
+        # Blocks match the spans from the parser
+        tree = xpp.XProtocolSymbols(spans=True).parse(source)
+        blocks = set(zip(index.starts.tolist(), index.ends.tolist()))
+        for d in spanned_dicts(tree):
+            span = d['span']
+            assert_true((span.start, span.end) in blocks)
+        # Top-level documents, as from split_documents
+        assert_equal([data[start:end].decode('utf-8') for start, end in
+                      index.documents()],
+                     [text.strip() for text, lineno in
+                      xpp.split_documents(source)])
+    index = xps.StructuralIndex(SMALL_STR.encode('utf-8'))
+    assert_equal(index.depths.tolist(), [0, 1, 2, 2, 2, 1, 0, 1])
+    assert_equal([index.tag(i) for i in range(len(index))],
+                 [('XProtocol', None), ('ParamArray', 'A'),
+                  ('ParamLong', ''), (None, None), (None, None),
+                  ('ParamString', 'S'), ('XProtocol', None),
+                  ('ParamLong', 'L')])
+    assert_equal(index.children(0).tolist(), [1, 5])
+    assert_equal(index.children(1).tolist(), [2, 3, 4])
+    assert_equal(index.blocks_at(0).tolist(), [0, 6])
+    # Tags in strings are not blocks
+    assert_equal(index.find(name='Fake').tolist(), [])
+    assert_equal(index.find(tag='ParamLong').tolist(), [2, 7])
+    assert_equal(index.find(tag='ParamLong', depth=1).tolist(), [7])
+    assert_equal(index.find(name='S').tolist(), [5])
+    assert_equal(len(index.find()), 6)
+    # Parse selected blocks only
+    tree = xpp.parse(SMALL_STR)
+    assert_equal(index.parse(5), tree[0]['blocks'][1])
+    assert_equal(index.parse(6), tree[1])
+    assert_equal(xps.parse_element(index.text(1).decode('utf-8'),
+                                   'ParamArray'),
+                 tree[0]['blocks'][0])
+    assert_raises(ValueError, index.parse, 3)
+    # Broken structure
+    for bad in ('<XProtocol> { "open }', '{ { }', '{ } }'):
+        assert_raises(ValueError, xps.StructuralIndex, bad)
+    assert_equal(len(xps.StructuralIndex(b'')), 0)
+
+
+def test_scan_structure():
+    if np is None:
+        raise SkipTest('Need numpy for structural index')
+    contents = open(EG_PROTO, 'rt').read()
+    for source in (SMALL_STR, contents, SMALL_STR + contents):
+        buf = source.encode('utf-8')
+        assert_equal(xpx.scan_structure(buf), xpx.scan_documents(buf))
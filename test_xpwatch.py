@@ -0,0 +1,196 @@
+""" Tests for spool directory watcher
+"""
+
+import io
+import json
+import os
+from os.path import join as pjoin, exists
+import shutil
+import threading
+import time
+
+import xpparse as xpp
+import xpjson as xpj
+import xpwatch as xpw
+from xptesting import (EG_PROTO, GOOD_STR, BAD_STR, write_file,
+                       temp_dir)
+
+from nose.tools import assert_equal, assert_true, assert_false
+from nose.plugins.skip import SkipTest
+
+
+def wait_for(ingester, predicate, timeout=20):
+    """ Step `ingester` until `predicate()` is True """
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        ingester.step(0.05)
+        if predicate():
+            return True
+    return False
+
+
+def check_watcher(watcher, root):
+    path = pjoin(root, 'new.txt')
+    write_file(path, GOOD_STR)
+    assert_true(path in watcher.poll(0.5))
+    assert_equal(watcher.poll(0.05), set())
+    os.mkdir(pjoin(root, 'sub'))
+    sub_path = pjoin(root, 'sub', 'deep.txt')
+    write_file(sub_path, GOOD_STR)
+    changed = watcher.poll(0.5)
+    # Polling may see the file at once; inotify sees it on the next poll
+    changed |= watcher.poll(0.5) if sub_path not in changed else set()
+    assert_true(sub_path in changed)
+    os.unlink(path)
+    assert_true(path in watcher.poll(0.5))
+    # Renamed directory: files go from the old path, arrive at the new
+    moved_path = pjoin(root, 'moved', 'deep.txt')
+    os.rename(pjoin(root, 'sub'), pjoin(root, 'moved'))
+    changed = watcher.poll(0.5)
+    assert_true(moved_path in changed)
+    assert_true(sub_path in changed or pjoin(root, 'sub', '') in changed)
+    # and later changes come from the new path
+    write_file(moved_path, GOOD_STR * 2)
+    assert_equal(watcher.poll(0.5), {moved_path})
+    watcher.close()
+
+
+def test_watchers():
+    with temp_dir() as root:
+        check_watcher(xpw.PollingWatcher(root), root)
+    if xpw._load_libc() is None:
+        raise SkipTest('No inotify')
+    with temp_dir() as root:
+        check_watcher(xpw.InotifyWatcher(root), root)
+
+
+def test_ingester():
+    for use_inotify in (False, None):
+        with temp_dir() as spool, temp_dir() as cache:
+            shutil.copy(EG_PROTO, pjoin(spool, 'sample.txt'))
+            log = io.StringIO()
+            with xpw.Ingester(spool, cache, workers=2, settle=0.3,
+                              poll_interval=0.05, use_inotify=use_inotify,
+                              log=log) as ingester:
+                files = ingester.catalog['files']
+                # Files present at the start
+                assert_true(wait_for(ingester, lambda: 'sample.txt' in files))
+                entry = files['sample.txt']
+                assert_equal(entry['error'], None)
+                with open(pjoin(cache, entry['output']), 'rt') as fobj:
+                    assert_equal(list(xpj.iter_load(fobj)),
+                                 xpp.parse(open(EG_PROTO, 'rt').read()))
+                # New files, in new directories; partial writes wait
+                os.mkdir(pjoin(spool, 'scanner'))
+                path = pjoin(spool, 'scanner', 'good.txt')
+                with open(path, 'wt') as fobj:
+                    fobj.write(GOOD_STR[:20])
+                    fobj.flush()
+                    ingester.step(0.05)
+                    ingester.step(0.05)
+                    assert_false('scanner/good.txt' in files)
+                    fobj.write(GOOD_STR[20:])
+                write_file(pjoin(spool, 'bad.txt'), BAD_STR)
+                write_file(pjoin(spool, 'partial.tmp'), GOOD_STR)
+                assert_true(wait_for(ingester, lambda: (
+                    'scanner/good.txt' in files and 'bad.txt' in files)))
+                assert_equal(files['scanner/good.txt']['names'], ['Good'])
+                assert_equal(files['bad.txt']['output'], None)
+                assert_equal(files['bad.txt']['error']['type'], 'SyntaxError')
+                assert_false('partial.tmp' in files)
+                # Changed file is parsed again
+                write_file(pjoin(spool, 'bad.txt'), GOOD_STR)
+                assert_true(wait_for(
+                    ingester, lambda: files['bad.txt']['error'] is None))
+                # Deleted file leaves the catalog
+                out_path = pjoin(cache, files['bad.txt']['output'])
+                assert_true(exists(out_path))
+                os.unlink(pjoin(spool, 'bad.txt'))
+                assert_true(wait_for(ingester, lambda: 'bad.txt' not in files))
+                assert_false(exists(out_path))
+                # Directory moved out of the spool leaves the catalog
+                out_path = pjoin(cache, files['scanner/good.txt']['output'])
+                with temp_dir() as outside:
+                    shutil.move(pjoin(spool, 'scanner'), outside)
+                assert_true(wait_for(
+                    ingester, lambda: 'scanner/good.txt' not in files))
+                assert_false(exists(out_path))
+            with open(pjoin(cache, xpw.CATALOG_NAME), 'rt') as fobj:
+                catalog = json.load(fobj)
+            assert_equal(sorted(catalog['files']), ['sample.txt'])
+            assert_true('parsed: ' in log.getvalue())
+            # Restart parses only files changed while stopped
+            write_file(pjoin(spool, 'later.txt'), GOOD_STR)
+            log = io.StringIO()
+            with xpw.Ingester(spool, cache, workers=1, settle=0.05,
+                              poll_interval=0.05, use_inotify=use_inotify,
+                              log=log) as ingester:
+                ingester.run(once=True)
+            assert_equal(log.getvalue().splitlines(),
+                         ['parsed: ' + pjoin(spool, 'later.txt')])
+            # Stop from another thread
+            stop = threading.Event()
+            with xpw.Ingester(spool, cache, workers=1,
+                              poll_interval=0.05,
+                              use_inotify=use_inotify) as ingester:
+                timer = threading.Timer(0.2, stop.set)
+                timer.start()
+                ingester.run(stop)
+
+
+def test_ingest():
+    # Failures go in the entry, and leave no temporary files
+    with temp_dir() as spool, temp_dir() as cache:
+        out_path = pjoin(cache, 'trees', 'f.txt.json')
+        task = (pjoin(spool, 'f.txt'), out_path, 'trees/f.txt.json', {})
+        # File deleted before we got to it
+        path, entry = xpw.ingest(task)
+        assert_equal(entry['error']['type'], 'FileNotFoundError')
+        assert_equal((entry['size'], entry['output']), (None, None))
+        # Document without a name
+        write_file(task[0], '<XProtocol> { <ID> 1 <ParamLong."L"> { 3 } }')
+        path, entry = xpw.ingest(task)
+        assert_equal(entry['error'], None)
+        assert_equal(entry['names'], [None])
+        assert_true(exists(out_path))
+        write_file(task[0], BAD_STR)
+        path, entry = xpw.ingest(task)
+        assert_equal(entry['error']['type'], 'SyntaxError')
+        assert_equal(os.listdir(pjoin(cache, 'trees')), ['f.txt.json'])
+        # File deleted while we parsed it
+        gone = pjoin(spool, 'gone.txt')
+        gone_out = pjoin(cache, 'trees', 'gone.txt.json')
+        write_file(gone, GOOD_STR)
+        gone_result = xpw.ingest((gone, gone_out, 'trees/gone.txt.json', {}))
+        assert_true(exists(gone_out))
+        os.unlink(gone)
+
+        class Result(object):
+            def __init__(self, value):
+                self.value = value
+
+            def ready(self):
+                return True
+
+            def get(self):
+                if isinstance(self.value, Exception):
+                    raise self.value
+                return self.value
+
+        with xpw.Ingester(spool, cache, workers=1) as ingester:
+            # Failures outside ingest do not stop the ingester
+            ingester._running[task[0]] = Result(RuntimeError('Worker died'))
+            ingester._running[gone] = Result(RuntimeError('Worker died'))
+            assert_true(ingester._collect())
+            files = ingester.catalog['files']
+            assert_equal(files['f.txt']['error']['type'], 'RuntimeError')
+            assert_false('gone.txt' in files)
+            # Trees of a file deleted while we parsed it go too
+            ingester._running[gone] = Result(gone_result)
+            assert_false(ingester._collect())
+            assert_false(exists(gone_out))
+            # Deleting a file in the catalog makes the catalog dirty
+            files['gone.txt'] = gone_result[1]
+            ingester._running[gone] = Result(gone_result)
+            assert_true(ingester._collect())
+            assert_false('gone.txt' in files)
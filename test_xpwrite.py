@@ -0,0 +1,91 @@
+""" Tests for writing parse trees as XProtocol text
+"""
+
+import io
+
+import xpparse as xpp
+import xpwrite as xpw
+from xptesting import get_sample
+
+from nose.tools import assert_equal, assert_raises
+
+
+EVA_STR = """<XProtocol> {
+  <Name> "Old"
+  <ParamDouble."D"> { <Precision> 2 1.5e-10 }
+  <ParamChoice."C"> { <Limit> { "A" "B" } "A" }
+  <ParamBool."B"> { "true" }
+  <EVACardLayout."Card"> { "Repr" 2 "P1" 10 20 "R1" "P2" 30 40 "R2"
+    <Line> { 1 2 3 4 } }
+  <Dependency."Dep"> { "P1" "P2" <Dll> "Lib" }
+}"""
+
+
+def assert_round_trip(text, symbols=xpp.XPROTOCOL_SYMBOLS):
+    tree = symbols.parse(text)
+    out = xpw.dumps(tree)
+    assert_equal(xpp.parse(out), xpp.decode_lazy(tree))
+    assert_equal(xpp.XProtocolSymbols(engine='rd').parse(out),
+                 xpp.decode_lazy(tree))
+    return out
+
+
+def test_round_trip():
+    contents, proto_str = get_sample()
+    assert_round_trip(contents)
+    # Embedded protocol, with functors and card layouts
+    assert_round_trip(proto_str)
+    # Lazy scalars write their source text
+    assert_round_trip(proto_str, xpp.XProtocolSymbols(lazy_strings=True))
+    out = assert_round_trip(EVA_STR)
+    assert_equal(out.splitlines()[:3],
+                 ['<XProtocol>', '{', '  <Name> "Old"'])
+    # Patched tree writes patched values
+    tree = xpp.parse(EVA_STR)
+    tree[0]['name'] = 'Say "new"'
+    tree[0]['blocks'][0]['value'] = 2.0
+    new_tree = xpp.parse(xpw.dumps(tree))
+    assert_equal(new_tree[0]['name'], 'Say ""new""')
+    assert_equal(new_tree[0]['blocks'][0]['value'], 2.0)
+
+
+def test_write():
+    tree = xpp.parse(EVA_STR)
+    fobj = io.StringIO()
+    writer = xpw.XProtocolWriter(fobj, indent='\t', buffer_lines=2)
+    writer.write(tree[0])
+    assert_equal(fobj.getvalue(), xpw.dumps(tree, indent='\t'))
+    fobj = io.StringIO()
+    xpw.write(tree, fobj)
+    assert_equal(fobj.getvalue(), xpw.dumps(tree))
+
+
+def test_format_scalar():
+    assert_equal(xpw.format_scalar(True), '"true"')
+    assert_equal(xpw.format_scalar(False), '"false"')
+    assert_equal(xpw.format_scalar(10), '10')
+    assert_equal(xpw.format_scalar(1.0), '1.0')
+    assert_equal(xpw.format_scalar(1e20), '1e+20')
+    assert_equal(xpw.format_scalar('a ""b""'), '"a ""b"""')
+    assert_equal(xpw.format_scalar('a "b"'), '"a ""b"""')
+    assert_equal(xpw.format_scalar('"'), '""""')
+    assert_equal(xpw.format_scalar(''), '""')
+    assert_raises(ValueError, xpw.format_scalar, float('inf'))
+    assert_raises(TypeError, xpw.format_scalar, None)
+
+
+def test_write_ascconv():
+    pairs = [('ulVersion', 0x14b44b6),
+             ('tProtocolName', 'Name "quoted" here'),
+             ('sSliceArray.asSlice[0].dThickness', 2.5),
+             ('tEmpty', '')]
+    for escaped in (False, True):
+        fobj = io.StringIO()
+        xpw.write_ascconv(pairs, fobj, escaped)
+        text = fobj.getvalue()
+        assert_equal(xpp.parse_ascconv(text), pairs)
+        section, = xpp.iter_ascconv(text)
+        assert_equal(section['value'], pairs)
+        if escaped:
+            text = xpp.strip_twin_quote(text)
+        assert_equal(xpp.parse_ascconv(xpp.split_ascconv(text)[1]), pairs)
@@ -0,0 +1,278 @@
+""" asyncio interface to the XProtocol parser
+
+Parsing is CPU bound, so it runs in an executor.  Streams are read in the
+event loop, and split into documents as they arrive, so we parse each
+document while reading the next.  Files are read in the executor, along
+with the parse.  A semaphore bounds the number of parses running at the same
+time.  ``AsyncParser.parse_many`` only pulls new inputs, and
+``AsyncParser.parse_stream`` only reads more of a stream, when there is room
+for them, so a slow parser holds back a fast producer.
+
+Needs Python 3.7 or later.
+"""
+
+import asyncio
+import codecs
+import os
+import weakref
+
+import xpparse as xpp
+
+
+def _parse_text(options, in_str):
+    """ Parse `in_str` with symbols for `options` items tuple
+
+    Module level function, so we can send it to a process pool.  Each
+    process keeps its own symbols.
+    """
+    return xpp.get_symbols(**dict(options)).parse(in_str)
+
+
+def _parse_document(options, in_str, lineno):
+    """ Parse document `in_str` starting at line `lineno` of its input """
+    return xpp.get_symbols(**dict(options))._parse(in_str, lineno=lineno)
+
+
+def _parse_file(options, path, encoding, errors):
+    """ Read and parse file at `path`, with symbols for `options` """
+    with open(path, 'rt', encoding=encoding, errors=errors) as fobj:
+        in_str = fobj.read()
+    return _parse_text(options, in_str)
+
+
+class AsyncParser(object):
+    """ Parse XProtocol text from coroutines
+
+    Parameters
+    ----------
+    executor : None or ``concurrent.futures.Executor``, optional
+        Executor for parsing and file reading.  None means the event loop
+        default executor.  Process pools are fine; each worker process keeps
+        its own parser.
+    max_concurrency : int, optional
+        Maximum number of parses running at the same time, and the maximum
+        number of inputs in flight in ``parse_many``.
+    encoding : str, optional
+        Encoding for bytes, streams and files.
+    errors : str, optional
+        Decoding error handling; see ``codecs``.
+    chunk_size : int, optional
+        Number of bytes to read from streams at each step.
+    **options : dict
+        Keyword arguments for ``xpparse.XProtocolSymbols``, such as
+        ``error_mode`` or ``engine``.
+    """
+
+    def __init__(self, executor=None, max_concurrency=4, encoding='utf-8',
+                 errors='strict', chunk_size=2 ** 16, **options):
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency should be >= 1')
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.encoding = encoding
+        self.errors = errors
+        self.chunk_size = chunk_size
+        self.options = tuple(sorted(options.items()))
+        # Check options now rather than in the executor
+        xpp.get_symbols(**options)
+        # Semaphores belong to one event loop, and we may run in several
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_semaphore(self):
+        """ Return semaphore for the running loop, making it on first use
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return self._semaphores[loop]
+        except KeyError:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            return self._semaphores.setdefault(loop, semaphore)
+
+    async def parse(self, in_str):
+        """ Parse XProtocol text `in_str` in the executor
+
+        Parameters
+        ----------
+        in_str : str or bytes
+            XProtocol text.  We decode bytes with ``self.encoding``.
+
+        Returns
+        -------
+        xprotocols : list or None
+            As for ``xpparse.XProtocolSymbols.parse``.
+        """
+        if isinstance(in_str, bytes):
+            in_str = in_str.decode(self.encoding, self.errors)
+        return await self._run(_parse_text, self.options, in_str)
+
+    async def _run(self, func, *args):
+        """ Run `func` with `args` in the executor, when there is room """
+        loop = asyncio.get_running_loop()
+        async with self._get_semaphore():
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def read_stream(self, reader):
+        """ Read and decode all text from ``asyncio.StreamReader`` `reader`
+
+        We decode each chunk as it arrives, so we never hold the whole input
+        as bytes and text at the same time.
+        """
+        decoder = codecs.getincrementaldecoder(self.encoding)(self.errors)
+        parts = []
+        while True:
+            chunk = await reader.read(self.chunk_size)
+            if not chunk:
+                break
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b'', final=True))
+        return ''.join(parts)
+
+    async def parse_stream(self, reader):
+        """ Parse XProtocol text from ``asyncio.StreamReader`` `reader`
+
+        We split the text into top-level documents with
+        ``xpparse.DocumentSplitter`` as it arrives, and start parsing each
+        document as soon as it is complete, while we read the rest.  We
+        only read more when fewer than ``max_concurrency`` documents are
+        waiting or being parsed, so we do not buffer the stream faster than
+        we can parse it.  Syntax errors give line numbers in the whole
+        stream.  As for ``xpparse.XProtocolSymbols.iterparse``, in
+        'forgiving' mode we drop documents that give no output, so the
+        result is always a list.
+        """
+        decoder = codecs.getincrementaldecoder(self.encoding)(self.errors)
+        splitter = xpp.DocumentSplitter()
+        tasks = []
+        pending = set()
+        try:
+            while True:
+                while len(pending) >= self.max_concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        # Raise errors now, rather than read on
+                        task.result()
+                chunk = await reader.read(self.chunk_size)
+                documents = splitter.feed(
+                    decoder.decode(chunk, final=not chunk))
+                if not chunk:
+                    documents += splitter.close()
+                for text, lineno in documents:
+                    task = asyncio.ensure_future(self._run(
+                        _parse_document, self.options, text, lineno))
+                    tasks.append(task)
+                    pending.add(task)
+                if not chunk:
+                    break
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        xprotocols = []
+        for result in results:
+            if result is not None:
+                xprotocols += result
+        return xprotocols
+
+    async def parse_file(self, path):
+        """ Parse XProtocol text from file at `path`
+
+        The file read runs in the executor, with the parse, so it does not
+        block the loop.
+        """
+        return await self._run(_parse_file, self.options, path,
+                               self.encoding, self.errors)
+
+    def _parse_input(self, source):
+        """ Return coroutine parsing `source`, depending on its type """
+        if isinstance(source, (str, bytes)):
+            return self.parse(source)
+        if isinstance(source, asyncio.StreamReader):
+            return self.parse_stream(source)
+        if isinstance(source, os.PathLike):
+            return self.parse_file(source)
+        raise TypeError('Cannot parse input of type {0}'.format(type(source)))
+
+    async def parse_many(self, sources, ordered=True,
+                         return_exceptions=False):
+        """ Parse many inputs, yielding results as an async iterator
+
+        Parameters
+        ----------
+        sources : iterable or async iterable
+            Inputs to parse.  Each input can be text (str), bytes, an
+            ``asyncio.StreamReader`` or a path-like object such as
+            ``pathlib.Path``.  Plain ``str`` inputs are always text, never
+            file names.
+        ordered : bool, optional
+            If True, yield results in input order, otherwise yield results as
+            they complete.
+        return_exceptions : bool, optional
+            If True, yield exceptions from parsing as results, otherwise
+            raise the first one.
+
+        Yields
+        ------
+        xprotocols : list or None or Exception
+            Parse result for each input.
+
+        Notes
+        -----
+        There are at most ``max_concurrency`` inputs in flight.  We only take
+        the next input from `sources` when one of these has finished.
+        """
+        if hasattr(sources, '__aiter__'):
+            iterator = sources.__aiter__()
+
+            async def next_source():
+                return await iterator.__anext__()
+        else:
+            iterator = iter(sources)
+
+            async def next_source():
+                try:
+                    return next(iterator)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        async def run(source):
+            try:
+                return await self._parse_input(source)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        pending = []
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.max_concurrency:
+                    try:
+                        source = await next_source()
+                    except StopAsyncIteration:
+                        exhausted = True
+                    else:
+                        pending.append(asyncio.ensure_future(run(source)))
+                if not pending:
+                    break
+                if ordered:
+                    task = pending.pop(0)
+                    yield await task
+                    continue
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.remove(task)
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def parse(in_str, **kwargs):
+    """ Parse XProtocol text `in_str` in the default executor
+
+    `kwargs` are options for ``XProtocolSymbols``.
+    """
+    return await AsyncParser(**kwargs).parse(in_str)
@@ -0,0 +1,84 @@
+""" Parse many files in worker processes, returning trees in shared memory
+
+Sending parse trees back from a ``multiprocessing`` pool pickles the nested
+dicts in the worker, and unpickles them in the parent, which can cost as
+much as the parse.  Here the workers store each tree in the ``xpbinary``
+format in shared memory, and send back only the name and size of the
+memory.  The parent reads the trees in place, decoding only the parts it
+asks for, so the cost in the parent does not depend on the size or depth of
+the trees.
+"""
+from __future__ import print_function, absolute_import
+
+from collections import namedtuple
+from multiprocessing import Pool
+
+import xpparse as xpp
+import xpbinary as xpb
+
+BatchResult = namedtuple('BatchResult', ('path', 'tree', 'error'))
+BatchResult.__doc__ = """ Result for one input of :func:`parse_files`
+
+`tree` is a ``xpbinary.BinaryTree``, or None if there was an error.  Use
+``tree.root`` for the list of XProtocols, and close the tree to free its
+memory.  `error` is None or a dict with keys "type", "message" and
+"lineno".
+"""
+
+
+def _parse_to_shared(task):
+    """ Parse file for `task` in worker; return path, shared memory, error
+    """
+    path, options = task
+    try:
+        with open(path, 'rt') as fobj:
+            text = fobj.read()
+        tree = xpp.get_symbols(**options).parse(text)
+        # Storing can fail too, for integers outside int64
+        return path, xpb.dump_shared(tree), None
+    except Exception as e:
+        # Report the error for this file; do not stop the batch
+        return path, None, xpp.error_record(e)
+
+
+def _attach(result):
+    path, shared, error = result
+    return BatchResult(path,
+                       None if shared is None else xpb.attach_shared(*shared),
+                       error)
+
+
+def parse_files(paths, workers=None, ordered=True, **options):
+    """ Parse files at `paths` in a process pool; generate results
+
+    Parameters
+    ----------
+    paths : iterable
+        Filenames to parse.
+    workers : None or int, optional
+        Number of worker processes.  None means one per CPU.
+    ordered : bool, optional
+        If True, give results in the order of `paths`.  Otherwise give them
+        as they finish.
+    \\*\\*options : dict
+        Keyword arguments for ``XProtocolSymbols``, such as ``engine``.
+        Spans and lazy scalars are not stored.
+
+    Yields
+    ------
+    result : BatchResult
+        Result for each path.  Close ``result.tree`` when done.  If you stop
+        early, we wait for the remaining parses, and free their results.
+    """
+    tasks = ((path, options) for path in paths)
+    with Pool(workers) as pool:
+        results = (pool.imap(_parse_to_shared, tasks) if ordered
+                   else pool.imap_unordered(_parse_to_shared, tasks))
+        try:
+            for result in results:
+                yield _attach(result)
+        finally:
+            # Free shared memory of results nobody will see
+            for result in results:
+                if result[1] is not None:
+                    xpb.attach_shared(*result[1]).close()
@@ -0,0 +1,542 @@
+""" Compact binary format for XProtocol parse trees, with lazy reads
+
+Pickle and JSON are slow for the nested dicts from ``parse``, and JSON loses
+the difference between ints, floats and bools.  This format stores a parse
+tree so we can memory map it, and read parts of it without decoding the
+rest.
+
+Layout, all little-endian:
+
+* Header of 32 bytes: magic ``b'XPB\\x00'``, uint16 version, uint16 flags
+  (unused), uint32 offset of the string table, uint32 number of strings,
+  the slot for the root value (see below), and padding.
+* Records for dicts, lists and tuples.  Each record starts with a uint8
+  record type, three pad bytes, and a uint32 element count.  Then:
+
+  - dicts (``m``): for each item, uint32 string index for the key, then the
+    slot for the value;
+  - lists (``l``) and tuples (``t``): one slot per element;
+  - lists with all elements of one scalar type - typed arrays: ``I`` for
+    int64, ``D`` for float64, ``B`` for uint8 bools, ``S`` for uint32
+    string indices.  The data starts at the next multiple of 8 bytes.
+
+  Children come before their parents, and a subtree that appears more than
+  once in the tree - as it does after ``xpintern`` interning - is stored
+  once.
+* A slot is one byte of value type and eight bytes of payload: ``n`` None,
+  ``T`` True, ``F`` False (no payload), ``i`` int64, ``f`` float64, ``s``
+  string index as uint32, ``c`` record offset as uint32.
+* The string table: uint32 offsets for each string and one past the last,
+  relative to the start of the string data, followed by the UTF-8 string
+  data.  Each distinct string is stored once.
+"""
+from __future__ import print_function, absolute_import
+
+from array import array
+from collections.abc import Mapping, Sequence
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'XPB\x00'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHII')
+HEADER_SIZE = 32
+RECORD = struct.Struct('<B3xI')
+SLOT_SIZE = 9
+KEY_SIZE = 4
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+F64 = struct.Struct('<d')
+
+# Record types
+DICT, LIST, TUPLE = ord('m'), ord('l'), ord('t')
+INT_ARRAY, FLOAT_ARRAY, BOOL_ARRAY, STR_ARRAY = (ord(c) for c in 'IDBS')
+# Array type code, item size, for typed arrays
+ARRAY_CODES = {INT_ARRAY: ('q', 8),
+               FLOAT_ARRAY: ('d', 8),
+               BOOL_ARRAY: ('B', 1),
+               STR_ARRAY: ('I', 4)}
+# Slot types
+NONE, TRUE, FALSE, INT, FLOAT, STRING, CONTAINER = (ord(c) for c in 'nTFifsc')
+
+# Dict keys we do not store by default.  Source spans refer to input text we
+# do not have, and differ between documents with the same content.  The JSON
+# writer and the diff use the same default; this module does not import
+# ``xpparse``, so it is the one place all three can share.
+IGNORE_KEYS = ('span',)
+
+if sys.byteorder != 'little':
+    raise ImportError('Binary format only implemented for little-endian '
+                      'machines')
+
+
+class _Builder(object):
+    """ Collect records and strings for one tree """
+
+    def __init__(self, ignore):
+        # Import here, so readers of the format do not pay for building the
+        # parser tables on import of xpparse
+        from xpparse import LazyScalar
+        self.lazy_type = LazyScalar
+        self.ignore = frozenset(ignore)
+        self.out = bytearray(HEADER_SIZE)
+        self.strings = {}
+        # Offsets of records by id of node; `self.nodes` keeps them alive
+        self.offsets = {}
+        self.nodes = []
+
+    def string(self, value):
+        try:
+            return self.strings[value]
+        except KeyError:
+            pass
+        return self.strings.setdefault(str.__str__(value), len(self.strings))
+
+    def slot(self, value):
+        """ Return bytes of slot for `value`, writing records as needed """
+        # Fast path for the common plain types
+        value_type = type(value)
+        if value_type is str:
+            return b's' + U32.pack(self.string(value)) + bytes(4)
+        if value_type is dict or value_type is list or value_type is tuple:
+            return b'c' + U32.pack(self.record(value)) + bytes(4)
+        if isinstance(value, self.lazy_type):
+            value = value.value
+        if value is None:
+            return b'n' + bytes(8)
+        if isinstance(value, bool):
+            return (b'T' if value else b'F') + bytes(8)
+        if isinstance(value, int):
+            if not INT64_MIN <= value <= INT64_MAX:
+                raise ValueError(
+                    'Cannot store integer {0}; outside int64'.format(value))
+            return b'i' + I64.pack(value)
+        if isinstance(value, float):
+            return b'f' + F64.pack(value)
+        if isinstance(value, str):
+            return b's' + U32.pack(self.string(value)) + bytes(4)
+        if isinstance(value, (dict, list, tuple)):
+            return b'c' + U32.pack(self.record(value)) + bytes(4)
+        raise TypeError('Cannot store value of type {0}'.format(type(value)))
+
+    def _array_type(self, values):
+        if not values:
+            return None
+        first = type(values[0])
+        for record_type, value_type in ((BOOL_ARRAY, bool),
+                                        (INT_ARRAY, int),
+                                        (FLOAT_ARRAY, float),
+                                        (STR_ARRAY, str)):
+            if issubclass(first, value_type):
+                break
+        else:
+            return None
+        for value in values:
+            if (not isinstance(value, value_type) or
+                    (value_type is int and isinstance(value, bool))):
+                return None
+        # Slots raise the error for integers outside int64
+        if (record_type == INT_ARRAY and
+                not INT64_MIN <= min(values) <= max(values) <= INT64_MAX):
+            return None
+        return record_type
+
+    def record(self, node):
+        """ Write record for container `node`, return its offset """
+        try:
+            return self.offsets[id(node)]
+        except KeyError:
+            pass
+        if isinstance(node, dict):
+            items = [(self.string(k), self.slot(v)) for k, v in node.items()
+                     if k not in self.ignore]
+            data = b''.join(U32.pack(k) + s for k, s in items)
+            record_type, count = DICT, len(items)
+        else:
+            values = [v.value if isinstance(v, self.lazy_type) else v
+                      for v in node]
+            array_type = (self._array_type(values) if isinstance(node, list)
+                          else None)
+            count = len(node)
+            if array_type is None:
+                data = b''.join(self.slot(v) for v in values)
+                record_type = LIST if isinstance(node, list) else TUPLE
+            else:
+                record_type = array_type
+                if array_type == STR_ARRAY:
+                    values = [self.string(v) for v in values]
+                data = array(ARRAY_CODES[array_type][0], values).tobytes()
+        offset = len(self.out)
+        self.out += RECORD.pack(record_type, count)
+        if record_type in ARRAY_CODES:
+            self.out += bytes(-len(self.out) % 8)
+        self.out += data
+        self.out += bytes(-len(self.out) % 8)
+        self.offsets[id(node)] = offset
+        self.nodes.append(node)
+        return offset
+
+    def finish(self, root_slot):
+        strings = [s.encode('utf-8', 'surrogatepass') for s in self.strings]
+        offsets = array('I', [0])
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        table_offset = len(self.out)
+        self.out += offsets.tobytes()
+        self.out += b''.join(strings)
+        self.out[:HEADER.size + SLOT_SIZE] = (
+            HEADER.pack(MAGIC, VERSION, 0, table_offset, len(strings)) +
+            root_slot)
+        return bytes(self.out)
+
+
+def dumps(tree, ignore=IGNORE_KEYS):
+    """ Return binary form of parse tree `tree` as bytes
+
+    Parameters
+    ----------
+    tree : object
+        Output from ``XProtocolSymbols.parse``, or any tree of dicts with
+        str keys, lists, tuples, None, bool, int, float and str.  Lazy
+        scalars and values with spans store as their plain values.  Integers
+        must fit in int64; we raise ValueError otherwise.
+    ignore : sequence of str, optional
+        Dict keys to leave out.  By default we leave out source spans.
+
+    Returns
+    -------
+    data : bytes
+        Binary form of `tree`.
+    """
+    builder = _Builder(ignore)
+    root_slot = builder.slot(tree)
+    return builder.finish(root_slot)
+
+
+def dump(tree, fobj, ignore=IGNORE_KEYS):
+    """ Write binary form of parse tree `tree` to binary file `fobj` """
+    fobj.write(dumps(tree, ignore))
+
+
+class BinaryTree(object):
+    """ Parse tree in binary form, decoded on access
+
+    Parameters
+    ----------
+    buffer : bytes-like
+        Data from :func:`dumps`, for example in a ``bytes``, ``mmap`` or
+        shared memory buffer.  We do not copy it.
+
+    Attributes
+    ----------
+    root : object
+        Root value of tree.  Dicts and lists are read-only proxies that
+        decode their elements when you ask for them.
+    """
+
+    def __init__(self, buffer):
+        # Memory map to close with the tree; see :func:`load`
+        self.mmap = None
+        # Shared memory to close and unlink with the tree; see
+        # :func:`attach_shared`
+        self.shared = None
+        self.buffer = memoryview(buffer).cast('B')
+        magic, version, flags, table_offset, n_strings = \
+            HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError('Buffer does not contain binary parse tree')
+        if version != VERSION:
+            raise ValueError('Cannot read binary format version {0}'
+                             .format(version))
+        self._str_offsets = self.buffer[
+            table_offset:table_offset + 4 * (n_strings + 1)].cast('I')
+        self._str_data = table_offset + 4 * (n_strings + 1)
+        self._strings = [None] * n_strings
+        self.root = self.value(HEADER.size)
+
+    def close(self):
+        """ Release our views of the buffer
+
+        Proxies from this tree stop working after the close.
+        """
+        self._str_offsets.release()
+        self.buffer.release()
+        if self.mmap is not None:
+            self.mmap.close()
+        if self.shared is not None:
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def string(self, index):
+        """ Return string number `index` from the string table """
+        value = self._strings[index]
+        if value is None:
+            start = self._str_data + self._str_offsets[index]
+            end = self._str_data + self._str_offsets[index + 1]
+            value = self._strings[index] = str(
+                self.buffer[start:end], 'utf-8', 'surrogatepass')
+        return value
+
+    def value(self, pos):
+        """ Return value from slot at buffer offset `pos` """
+        slot_type = self.buffer[pos]
+        if slot_type == STRING:
+            return self.string(U32.unpack_from(self.buffer, pos + 1)[0])
+        if slot_type == CONTAINER:
+            return self.record(U32.unpack_from(self.buffer, pos + 1)[0])
+        if slot_type == INT:
+            return I64.unpack_from(self.buffer, pos + 1)[0]
+        if slot_type == FLOAT:
+            return F64.unpack_from(self.buffer, pos + 1)[0]
+        if slot_type == NONE:
+            return None
+        if slot_type == TRUE:
+            return True
+        if slot_type == FALSE:
+            return False
+        raise ValueError('Bad slot type {0} at offset {1}'
+                         .format(slot_type, pos))
+
+    def record(self, offset):
+        """ Return proxy, or tuple, for record at buffer offset `offset` """
+        record_type, count = RECORD.unpack_from(self.buffer, offset)
+        start = offset + RECORD.size
+        if record_type == DICT:
+            return BinaryDict(self, start, count)
+        if record_type == LIST:
+            return BinaryList(self, start, count)
+        if record_type == TUPLE:
+            return tuple(self.value(start + i * SLOT_SIZE)
+                         for i in range(count))
+        if record_type in ARRAY_CODES:
+            start += -start % 8
+            code, size = ARRAY_CODES[record_type]
+            values = self.buffer[start:start + count * size].cast(code)
+            return BinaryArray(self, values, record_type)
+        raise ValueError('Bad record type {0} at offset {1}'
+                         .format(record_type, offset))
+
+
+def to_python(value):
+    """ Return plain dicts, lists and tuples for binary tree `value` """
+    if isinstance(value, Mapping):
+        return dict((k, to_python(v)) for k, v in value.items())
+    if isinstance(value, (BinaryList, BinaryArray)):
+        return [to_python(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(to_python(v) for v in value)
+    return value
+
+
+class BinaryDict(Mapping):
+    """ Read-only dict proxy for a dict record """
+
+    def __init__(self, tree, start, count):
+        self._tree = tree
+        self._start = start
+        self._count = count
+
+    def _key_pos(self, i):
+        return self._start + i * (KEY_SIZE + SLOT_SIZE)
+
+    def __getitem__(self, key):
+        # Dicts in parse trees are small, so a linear search is fast
+        tree = self._tree
+        for i in range(self._count):
+            pos = self._key_pos(i)
+            if tree.string(U32.unpack_from(tree.buffer, pos)[0]) == key:
+                return tree.value(pos + KEY_SIZE)
+        raise KeyError(key)
+
+    def __iter__(self):
+        buffer = self._tree.buffer
+        for i in range(self._count):
+            yield self._tree.string(U32.unpack_from(buffer,
+                                                    self._key_pos(i))[0])
+
+    def __len__(self):
+        return self._count
+
+    def items(self):
+        # Faster than the Mapping default, which looks up each key
+        tree = self._tree
+        for i in range(self._count):
+            pos = self._key_pos(i)
+            yield (tree.string(U32.unpack_from(tree.buffer, pos)[0]),
+                   tree.value(pos + KEY_SIZE))
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, dict(self.items()))
+
+
+class _BinarySequence(Sequence):
+    """ Read-only list proxy """
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, _BinarySequence)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('list index out of range')
+        return self._get(index)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, list(self))
+
+
+class BinaryList(_BinarySequence):
+    """ Read-only list proxy for a list record """
+
+    def __init__(self, tree, start, count):
+        self._tree = tree
+        self._start = start
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def _get(self, index):
+        return self._tree.value(self._start + index * SLOT_SIZE)
+
+
+class BinaryArray(_BinarySequence):
+    """ Read-only list proxy for a typed array record
+
+    Attributes
+    ----------
+    values : memoryview
+        View of the int64, float64, uint8 (bool) or uint32 (string index)
+        array data in the buffer, without copying.
+    """
+
+    def __init__(self, tree, values, record_type):
+        self._tree = tree
+        self.values = values
+        self._record_type = record_type
+
+    def __len__(self):
+        return len(self.values)
+
+    def _get(self, index):
+        value = self.values[index]
+        if self._record_type == BOOL_ARRAY:
+            return bool(value)
+        if self._record_type == STR_ARRAY:
+            return self._tree.string(value)
+        return value
+
+
+def loads(data):
+    """ Return root value of binary parse tree in bytes-like `data`
+
+    The returned proxies keep a reference to `data`.
+    """
+    return BinaryTree(data).root
+
+
+def load(filename):
+    """ Memory map binary parse tree in file `filename`
+
+    Returns
+    -------
+    tree : BinaryTree
+        Tree reading from memory mapped file.  Use ``tree.root`` for the
+        root value.  Close the tree when done, or use it as a context
+        manager.  You cannot close a tree while there are views of its
+        typed arrays (``BinaryArray.values``) still alive.
+    """
+    with open(filename, 'rb') as fobj:
+        mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    tree = BinaryTree(mapped)
+    tree.mmap = mapped
+    return tree
+
+
+def dump_shared(tree, ignore=IGNORE_KEYS):
+    """ Store binary form of `tree` in new shared memory
+
+    Use this to send parse results between processes: pass the returned
+    name and size, which pickle to a few bytes whatever the size of the
+    tree, and read the tree in the other process with
+    :func:`attach_shared`.  The shared memory stays until the reader closes
+    the tree.
+
+    Parameters
+    ----------
+    tree : object
+        Parse tree; see :func:`dumps`.
+    ignore : sequence of str, optional
+        Dict keys to leave out.
+
+    Returns
+    -------
+    name : str
+        Name of shared memory block.
+    size : int
+        Number of bytes of binary data in the block.
+    """
+    from multiprocessing import shared_memory
+    data = dumps(tree, ignore)
+    try:
+        # Python >= 3.13; the reader owns the memory, not us
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1),
+                                         track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        if os.name == 'posix':
+            # Do not let our resource tracker remove the memory when this
+            # process exits; the reader registers it again when it attaches.
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+    return shm.name, len(data)
+
+
+def attach_shared(name, size):
+    """ Return tree from shared memory `name` with binary data of `size`
+
+    Returns
+    -------
+    tree : BinaryTree
+        Tree reading from the shared memory, without copying.  Closing the
+        tree frees the shared memory; do that when done, or use the tree as
+        a context manager.  As for :func:`load`, views of typed arrays must
+        be gone before the close.
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        tree = BinaryTree(shm.buf[:size])
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    tree.shared = shm
+    return tree
@@ -0,0 +1,200 @@
+""" Command line tool to parse XProtocol files to newline-delimited JSON
+
+Run as::
+
+    python xpcli.py [options] [file-or-glob ...]
+
+Writes one JSON record per input document to stdout, as each parse
+finishes.  Records have keys:
+
+* "path": input filename, or "-" for stdin;
+* "protocols": the parse tree, or null if the parse failed;
+* "error": null, or an object with "type", "message" and "lineno";
+* "warnings": a list of lines of diagnostics from ``--forgiving`` parsing,
+  for the errors the parser skipped;
+* "nested": with ``--nested``, a list of objects with "name", the
+  parameter name, "protocols", the parse tree, and "error", as above, for
+  XProtocol text embedded in string parameters, such as ``Protocol0``.  A
+  nested parse that fails has null "protocols" and sets its own "error",
+  leaving the outer record as it is;
+* "ascconv": with ``--ascconv``, a list of objects with "escaped", as for
+  ``iter_ascconv``, and "value", an object of ASCCONV assignments.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+from contextlib import redirect_stdout
+import glob
+import io
+import json
+from multiprocessing import Pool
+import os
+import sys
+import time
+
+import xpparse as xpp
+
+NESTED_START = '<XProtocol>'
+
+
+def nested_protocols(tree, options):
+    """ Parse XProtocol text in string parameters of `tree`
+
+    Returns list of dicts with keys 'name', 'protocols' and 'error'.  Nested
+    text has its double quotes doubled, and may have an ASCCONV section after
+    the protocol.  If a nested parse fails, 'protocols' for that string is
+    None, and 'error' is the error record; otherwise 'error' is None.
+    """
+    found = []
+    stack = [tree]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            value = obj.get('value')
+            if (obj.get('type') == 'param_string' and
+                    isinstance(value, str) and
+                    value.lstrip().startswith(NESTED_START)):
+                text = xpp.strip_twin_quote(value)
+                if '### ASCCONV BEGIN ###' in text:
+                    text = xpp.split_ascconv(text)[0]
+                entry = dict(name=obj['name'], protocols=None, error=None)
+                try:
+                    entry['protocols'] = xpp.get_symbols(**options).parse(text)
+                    if entry['protocols'] is None:
+                        raise SyntaxError(
+                            'Could not recover from syntax errors')
+                except (SyntaxError, ValueError) as e:
+                    entry['error'] = xpp.error_record(e)
+                found.append(entry)
+            stack.extend(reversed(list(obj.values())))
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(reversed(obj))
+    return found
+
+
+def process(task):
+    """ Parse one document
+
+    Returns tuple of (path, JSON record string, error flag, number of input
+    characters, seconds).
+
+    `task` is a tuple of (path, text, options, nested, ascconv).  If `text`
+    is None, read the text from `path`.  Runs in worker processes, so we
+    return the record already encoded.
+
+    The parser prints its forgiving mode diagnostics; we collect them into
+    the record, so they do not mix with the records on stdout.
+    """
+    path, text, options, nested, ascconv = task
+    start = time.perf_counter()
+    record = dict(path=path, protocols=None, error=None, warnings=[])
+    diagnostics = io.StringIO()
+    try:
+        if text is None:
+            with open(path, 'rt') as fobj:
+                text = fobj.read()
+        with redirect_stdout(diagnostics):
+            protocols = xpp.get_symbols(**options).parse(text)
+            if protocols is None:
+                # Forgiving parse could not recover
+                raise SyntaxError('Could not recover from syntax errors')
+            record['protocols'] = protocols
+            if nested:
+                record['nested'] = nested_protocols(protocols, options)
+        if ascconv:
+            record['ascconv'] = [
+                dict(escaped=section['escaped'],
+                     value=dict(section['value']))
+                for section in xpp.iter_ascconv(text)]
+    except (SyntaxError, ValueError, OSError) as e:
+        record['protocols'] = None
+        record['error'] = xpp.error_record(e)
+    record['warnings'] = diagnostics.getvalue().splitlines()
+    return (path,
+            json.dumps(record),
+            record['error'] is not None,
+            0 if text is None else len(text),
+            time.perf_counter() - start)
+
+
+def expand_inputs(inputs):
+    """ Return list of paths for filenames and glob patterns in `inputs`
+
+    Keeps "-" for stdin.  Patterns that match nothing stay in the list, so
+    we report them as missing files.
+    """
+    paths = []
+    for name in inputs:
+        if name == '-' or os.path.exists(name):
+            paths.append(name)
+            continue
+        matches = sorted(glob.glob(name, recursive=True))
+        paths += matches if matches else [name]
+    return paths
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='xpparse',
+        description='Parse XProtocol files, write one JSON record per '
+        'document to stdout')
+    parser.add_argument('inputs', nargs='*', default=['-'],
+                        help='files or glob patterns; "-" or nothing for '
+                        'stdin')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--engine', choices=('lalr', 'rd'), default='lalr',
+                        help='parser engine (default lalr)')
+    parser.add_argument('--forgiving', action='store_true',
+                        help='record parse errors as warnings and carry on, '
+                        'rather than failing the document')
+    parser.add_argument('--nested', action='store_true',
+                        help='also parse XProtocol text in string '
+                        'parameters')
+    parser.add_argument('--ascconv', action='store_true',
+                        help='also extract ASCCONV sections')
+    parser.add_argument('--stats', action='store_true',
+                        help='report per-file timings and throughput on '
+                        'stderr')
+    return parser
+
+
+def main(argv=None):
+    """ Run command line tool with arguments `argv`; return exit code """
+    args = get_parser().parse_args(argv)
+    options = dict(engine=args.engine,
+                   error_mode='forgiving' if args.forgiving else 'strict')
+    tasks = []
+    for path in expand_inputs(args.inputs):
+        text = sys.stdin.read() if path == '-' else None
+        tasks.append((path, text, options, args.nested, args.ascconv))
+    start = time.perf_counter()
+    n_bytes = n_errors = 0
+    pool = Pool(args.workers) if args.workers > 1 else None
+    try:
+        results = (pool.imap_unordered(process, tasks) if pool
+                   else map(process, tasks))
+        for path, record, error, size, seconds in results:
+            sys.stdout.write(record + '\n')
+            sys.stdout.flush()
+            n_bytes += size
+            n_errors += error
+            if args.stats:
+                print('{0}: {1} bytes in {2:.2f} ms'.format(
+                    path, size, seconds * 1000), file=sys.stderr)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if args.stats:
+        elapsed = time.perf_counter() - start
+        print('{0} documents, {1} errors, {2:.1f} MB in {3:.2f} s: '
+              '{4:.1f} documents/s, {5:.2f} MB/s'.format(
+                  len(tasks), n_errors, n_bytes / 1e6, elapsed,
+                  len(tasks) / elapsed, n_bytes / 1e6 / elapsed),
+              file=sys.stderr)
+    return 1 if n_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+""" Thin client for the parse server in ``xpserver``
+
+This module does not import ``xpparse``, so it starts quickly.  See
+``xpserver`` for the message format.
+"""
+from __future__ import print_function, absolute_import
+
+import builtins
+import json
+import os
+import socket
+import struct
+
+import xpbinary as xpb
+
+LENGTH = struct.Struct('>I')
+
+# Largest frame we accept
+MAX_FRAME = 2 ** 31
+
+
+def send_frame(sock, data):
+    """ Send bytes `data` as one frame on socket `sock` """
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, n_bytes):
+    parts = []
+    while n_bytes:
+        part = sock.recv(min(n_bytes, 2 ** 20))
+        if not part:
+            return None
+        parts.append(part)
+        n_bytes -= len(part)
+    return b''.join(parts)
+
+
+def recv_frame(sock):
+    """ Return bytes of next frame from socket `sock`, None at end of input
+    """
+    header = _recv_exactly(sock, LENGTH.size)
+    if header is None:
+        return None
+    n_bytes = LENGTH.unpack(header)[0]
+    if n_bytes > MAX_FRAME:
+        raise ValueError('Frame of {0} bytes is too large'.format(n_bytes))
+    data = _recv_exactly(sock, n_bytes)
+    if data is None:
+        raise EOFError('Connection closed in middle of frame')
+    return data
+
+
+class XProtocolClient(object):
+    """ Client for ``xpserver.XProtocolServer``
+
+    Parameters
+    ----------
+    socket_path : str
+        Filename of server socket.
+    options : dict, optional
+        Keyword arguments for ``XProtocolSymbols`` in the server.
+
+    Notes
+    -----
+    Parse results are ``xpbinary`` proxies over the received bytes, so
+    reading one value does not decode the whole tree.  Use
+    ``xpbinary.to_python`` to get plain dicts and lists.
+    """
+
+    def __init__(self, socket_path, **options):
+        self.socket_path = socket_path
+        self.options = options
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, header, text=None):
+        header['options'] = self.options
+        send_frame(self.sock, json.dumps(header).encode('utf-8'))
+        if text is not None:
+            send_frame(self.sock, text.encode('utf-8'))
+        response = recv_frame(self.sock)
+        if response is None:
+            raise EOFError('Server closed connection')
+        if response[:1] == b'O':
+            return xpb.loads(memoryview(response)[1:])
+        error = json.loads(response[1:].decode('utf-8'))
+        # Raise builtin exceptions as themselves, others as RuntimeError
+        exc_type = getattr(builtins, error['type'], None)
+        if not (isinstance(exc_type, type) and
+                issubclass(exc_type, Exception)):
+            exc_type = RuntimeError
+        exc = exc_type(error['message'])
+        if error['lineno'] is not None:
+            exc.lineno = error['lineno']
+        raise exc
+
+    def parse(self, text):
+        """ Parse XProtocol `text` in the server """
+        return self._request({'text': True}, text)
+
+    def parse_file(self, path):
+        """ Parse XProtocol file at `path` in the server
+
+        The server reads the file, so it must be below one of the server
+        root directories.  The server raises PermissionError otherwise.
+        """
+        return self._request({'path': os.path.abspath(path)})
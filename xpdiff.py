@@ -0,0 +1,232 @@
+""" Structural diff between parsed XProtocol trees
+
+We hash every subtree of the parse output once, then walk both trees
+together, only descending into subtrees whose hashes differ.  Comparing a
+protocol against a reference therefore costs one hashing pass over the
+protocol, plus work proportional to the changed parts of the tree.  Hash the
+reference once with :class:`HashedTree` to reuse it over many comparisons.
+"""
+from __future__ import print_function, absolute_import
+
+from collections import namedtuple
+from difflib import SequenceMatcher
+import hashlib
+
+import xpparse as xpp
+from xpbinary import IGNORE_KEYS
+
+
+class Change(namedtuple('Change', ('kind', 'path', 'old', 'new'))):
+    """ One difference between two parse trees
+
+    Attributes
+    ----------
+    kind : {'added', 'removed', 'changed'}
+        Type of change.
+    path : tuple
+        Steps from the root to the changed value.  Steps are dict keys,
+        names of elements in lists of named elements, or list indices.
+    old : object
+        Value in first tree, None if `kind` is 'added'.
+    new : object
+        Value in second tree, None if `kind` is 'removed'.
+    """
+    __slots__ = ()
+
+
+def format_path(path):
+    """ Return string form of `path` from :class:`Change`
+
+    Examples
+    --------
+    >>> format_path((0, 'blocks', 'Count', 'value'))
+    '[0]/blocks/Count/value'
+    """
+    return '/'.join('[{0}]'.format(step) if isinstance(step, int)
+                    else str(step) for step in path)
+
+
+def _leaf_key(value):
+    """ Return bytes identifying scalar `value`
+
+    Keeps True distinct from 1, and 1 distinct from 1.0, and treats lazy
+    scalars and span-carrying values the same as their plain values.
+    """
+    if isinstance(value, xpp.LazyScalar):
+        value = value.value
+    if value is None or isinstance(value, bool):
+        out = repr(value)
+    elif isinstance(value, int):
+        out = 'i' + int.__repr__(value)
+    elif isinstance(value, float):
+        out = 'f' + float.__repr__(value)
+    elif isinstance(value, str):
+        out = 's' + str.__str__(value)
+    else:
+        out = type(value).__name__ + repr(value)
+    return out.encode('utf-8', 'surrogatepass')
+
+
+def _named_key(element):
+    """ Key to align `element` in a list, or None if not a named element """
+    if isinstance(element, dict):
+        return xpp.decode_lazy(element.get('name'))
+    if (isinstance(element, tuple) and len(element) == 2 and
+            isinstance(element[0], str)):
+        return element[0]
+    return None
+
+
+def _named_items(sequence):
+    """ Return list of (name, value) pairs for `sequence` or None
+
+    None unless all elements are named, with unique names.  Named dicts are
+    their own values; (name, value) attribute pairs give their second element.
+    """
+    items = []
+    for element in sequence:
+        key = _named_key(element)
+        if key is None:
+            return None
+        items.append((key, element[1] if isinstance(element, tuple)
+                      else element))
+    if len(set(key for key, value in items)) != len(items):
+        return None
+    return items
+
+
+class HashedTree(object):
+    """ Parse tree with hashes for all its container subtrees
+
+    Parameters
+    ----------
+    tree : object
+        Output of ``XProtocolSymbols.parse`` or any part of it.
+    ignore : sequence of str, optional
+        Dict keys to leave out of the hashes, and so the comparison.
+    """
+
+    def __init__(self, tree, ignore=IGNORE_KEYS):
+        self.tree = tree
+        self.ignore = frozenset(ignore)
+        # Hashes are by id; `self.tree` keeps the subtrees alive
+        self._hashes = {}
+        self.digest = self.key(tree)
+
+    def key(self, node):
+        """ Return bytes identifying content of `node` in this tree """
+        if not isinstance(node, (dict, list, tuple)):
+            return _leaf_key(node)
+        try:
+            return self._hashes[id(node)]
+        except KeyError:
+            pass
+        if isinstance(node, dict):
+            h = hashlib.sha1(b'd')
+            parts = (part for key in sorted(node) if key not in self.ignore
+                     for part in (_leaf_key(key), self.key(node[key])))
+        else:
+            h = hashlib.sha1(b'l' if isinstance(node, list) else b't')
+            parts = (self.key(element) for element in node)
+        for part in parts:
+            # Length prefix so concatenations are unambiguous
+            h.update(str(len(part)).encode('ascii') + b':' + part)
+        digest = self._hashes[id(node)] = h.digest()
+        return digest
+
+
+def _as_hashed(tree, ignore):
+    if isinstance(tree, HashedTree):
+        if tree.ignore != frozenset(ignore):
+            raise ValueError('HashedTree ignores different keys')
+        return tree
+    return HashedTree(tree, ignore)
+
+
+def diff(first, second, ignore=IGNORE_KEYS):
+    """ Return list of changes from parse tree `first` to tree `second`
+
+    Parameters
+    ----------
+    first : object or HashedTree
+        Reference parse tree, such as the output of ``XProtocolSymbols.parse``.
+        Pass a :class:`HashedTree` to reuse the hashes of the reference
+        across many comparisons.
+    second : object or HashedTree
+        Parse tree to compare.
+    ignore : sequence of str, optional
+        Dict keys to ignore.
+
+    Returns
+    -------
+    changes : list of :class:`Change`
+        Empty list if the trees have the same content.
+
+    Notes
+    -----
+    We match up list elements by name where all elements in both lists are
+    named dicts (parameters, cards) or (name, value) attribute pairs, with
+    unique names.  Otherwise we match list elements on their hashes with
+    ``difflib.SequenceMatcher``, so an inserted element gives one change.
+    Dicts with different 'type' values count as one changed value.
+    """
+    first = _as_hashed(first, ignore)
+    second = _as_hashed(second, ignore)
+    changes = []
+    _diff_node(first, second, first.tree, second.tree, (), changes)
+    return changes
+
+
+def _diff_node(first, second, a, b, path, changes):
+    if first.key(a) == second.key(b):
+        return
+    if isinstance(a, dict) and isinstance(b, dict):
+        if a.get('type') != b.get('type'):
+            changes.append(Change('changed', path, a, b))
+            return
+        for key in a:
+            if key in first.ignore:
+                continue
+            if key not in b:
+                changes.append(Change('removed', path + (key,), a[key], None))
+            else:
+                _diff_node(first, second, a[key], b[key], path + (key,),
+                           changes)
+        for key in b:
+            if key not in a and key not in first.ignore:
+                changes.append(Change('added', path + (key,), None, b[key]))
+    elif isinstance(a, (list, tuple)) and type(a) is type(b):
+        _diff_sequence(first, second, a, b, path, changes)
+    else:
+        changes.append(Change('changed', path, a, b))
+
+
+def _diff_sequence(first, second, a, b, path, changes):
+    items_a, items_b = _named_items(a), _named_items(b)
+    if items_a is not None and items_b is not None:
+        named_b = dict(items_b)
+        for key, value in items_a:
+            if key in named_b:
+                _diff_node(first, second, value, named_b[key], path + (key,),
+                           changes)
+            else:
+                changes.append(Change('removed', path + (key,), value, None))
+        named_a = dict(items_a)
+        for key, value in items_b:
+            if key not in named_a:
+                changes.append(Change('added', path + (key,), None, value))
+        return
+    matcher = SequenceMatcher(None,
+                              [first.key(element) for element in a],
+                              [second.key(element) for element in b],
+                              autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        n_pairs = min(i2 - i1, j2 - j1)
+        for i, j in zip(range(i1, i1 + n_pairs), range(j1, j1 + n_pairs)):
+            _diff_node(first, second, a[i], b[j], path + (i,), changes)
+        for i in range(i1 + n_pairs, i2):
+            changes.append(Change('removed', path + (i,), a[i], None))
+        for j in range(j1 + n_pairs, j2):
+            changes.append(Change('added', path + (j,), None, b[j]))
@@ -0,0 +1,354 @@
+""" Sidecar index of XProtocol archives for direct access by name or ID
+
+Archives hold many XProtocol documents one after another.  Finding one
+document by its ``<Name>`` or ``<ID>`` means parsing all the documents
+before it.  Instead, build an index of the archive once, with a fast scan of
+the structure, and save it next to the archive::
+
+    python xpindex.py archive.txt
+
+The index is JSON, in ``archive.txt.xpidx``, with keys:
+
+* "version": index format version, now 1;
+* "size", "mtime": size and modification time of the archive when indexed;
+* "documents": list of objects, one per top-level XProtocol document, with
+  keys "offset" and "end", the byte offsets of the document in the archive;
+  "name", "id" and "user_version", the ``<Name>``, ``<ID>`` and
+  ``<Userversion>`` header values, or null if missing; and "blocks", a list
+  of objects for each named element directly inside the document, with
+  keys "tag" (such as "ParamMap" or "Dependency"), "name", "offset" and
+  "end".
+
+String values, such as "name", have doubled double quotes, as from the
+parser.  :class:`IndexedArchive` uses the index to seek to a document or
+block and parse only its bytes::
+
+    with IndexedArchive('archive.txt') as archive:
+        for entry in archive.find(name='Head'):
+            protocol = archive.read(entry)
+
+Syntax errors in documents read this way give line numbers from the start of
+the document.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import json
+import mmap
+import os
+import re
+import sys
+
+import xpparse as xpp
+import xpstruct as xps
+
+INDEX_VERSION = 1
+
+INDEX_SUFFIX = '.xpidx'
+
+# Strings, braces and tags, with type and name for typed tags
+SCAN_RE = re.compile(br'''
+    (?P<quote>")
+    | (?P<open>\{)
+    | (?P<close>\})
+    | <(?P<tag>[A-Za-z_]\w*)(?:\."(?P<name>[^"]*)")?>
+    ''', re.VERBOSE)
+
+# Header value after its tag
+HDR_VALUE_RE = re.compile(br'\s*("[^"]*(?:""[^"]*)*"|[-+\w.]+)')
+
+HDR_KEYS = {b'Name': 'name', b'ID': 'id', b'Userversion': 'user_version'}
+
+
+def _hdr_value(key, text):
+    """ Decode header `text` for `key` as the parser does """
+    text = text.decode('utf-8')
+    if text.startswith('"'):
+        return text[1:-1]
+    try:
+        return int(text) if key == 'id' else float(text)
+    except ValueError:
+        return text
+
+
+def scan_documents(buf):
+    """ Return list of document index entries for XProtocol bytes `buf`
+
+    Parameters
+    ----------
+    buf : bytes-like
+        XProtocol archive contents, such as a ``mmap``.
+
+    Returns
+    -------
+    documents : list
+        List of dicts, one per top-level document, with keys as for
+        "documents" in the index; see the module docstring.
+    """
+    documents = []
+    depth = 0
+    pos = 0
+    doc = block = None
+    search = SCAN_RE.search
+    while True:
+        match = search(buf, pos)
+        if match is None:
+            break
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'quote':
+            # Jump past string; doubled quotes close and reopen it
+            end = buf.find(b'"', pos)
+            if end == -1:
+                break
+            pos = end + 1
+        elif kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            if depth == 0:
+                continue
+            depth -= 1
+            if depth == 1 and block is not None:
+                block['end'] = pos
+                block = None
+            elif depth == 0 and doc is not None:
+                doc['end'] = pos
+                documents.append(doc)
+                doc = None
+        elif depth == 0:
+            if match.group('tag') == b'XProtocol':
+                doc = dict(offset=match.start(), end=None, name=None,
+                           id=None, user_version=None, blocks=[])
+        elif depth == 1 and doc is not None:
+            tag, name = match.group('tag', 'name')
+            if name is not None:
+                block = dict(tag=tag.decode('ascii'),
+                             name=name.decode('utf-8'),
+                             offset=match.start(),
+                             end=None)
+                doc['blocks'].append(block)
+            elif tag in HDR_KEYS:
+                value = HDR_VALUE_RE.match(buf, pos)
+                if value is not None:
+                    key = HDR_KEYS[tag]
+                    doc[key] = _hdr_value(key, value.group(1))
+                    pos = value.end()
+    return documents
+
+
+def _scan_header(buf, pos, end):
+    """ Return dict of header values in ``buf[pos:end]`` """
+    header = {}
+    while True:
+        match = SCAN_RE.search(buf, pos, end)
+        if match is None:
+            return header
+        pos = match.end()
+        if match.lastgroup == 'quote':
+            pos = buf.find(b'"', pos, end) + 1
+            if pos == 0:
+                return header
+        elif match.group('tag') in HDR_KEYS:
+            value = HDR_VALUE_RE.match(buf, pos, end)
+            if value is not None:
+                key = HDR_KEYS[match.group('tag')]
+                header[key] = _hdr_value(key, value.group(1))
+                pos = value.end()
+
+
+def scan_structure(buf):
+    """ Return document index entries, as for :func:`scan_documents`
+
+    Uses a NumPy structural index of `buf`, so is faster for large inputs.
+    Raises ValueError for unbalanced braces or strings.
+    """
+    index = xps.StructuralIndex(buf)
+    starts, ends = index.starts.tolist(), index.ends.tolist()
+    documents = []
+    for i in index.blocks_at(0).tolist():
+        if index.tag(i)[0] != 'XProtocol':
+            continue
+        doc = dict(offset=starts[i], end=ends[i], name=None, id=None,
+                   user_version=None, blocks=[])
+        hdr_end = ends[i]
+        for j in index.children(i).tolist():
+            tag, name = index.tag(j)
+            if name is None:
+                continue
+            hdr_end = min(hdr_end, starts[j])
+            doc['blocks'].append(dict(tag=tag, name=name,
+                                      offset=starts[j], end=ends[j]))
+        doc.update(_scan_header(buf, int(index.opens[i]) + 1, hdr_end))
+        documents.append(doc)
+    return documents
+
+
+def index_path_for(path):
+    """ Return default sidecar index filename for archive `path` """
+    return path + INDEX_SUFFIX
+
+
+def build_index(path):
+    """ Return index dict for archive at `path`
+
+    Uses :func:`scan_structure` if we have NumPy and the archive has
+    balanced braces and strings, otherwise :func:`scan_documents`.
+    """
+    stat = os.stat(path)
+    documents = []
+    if stat.st_size:
+        with open(path, 'rb') as fobj:
+            with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                documents = None
+                if xps.np is not None:
+                    try:
+                        documents = scan_structure(buf)
+                    except ValueError:
+                        pass
+                if documents is None:
+                    documents = scan_documents(buf)
+    return dict(version=INDEX_VERSION,
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                documents=documents)
+
+
+def write_index(path, index_path=None):
+    """ Build index for archive `path`, write to `index_path`, return index
+
+    `index_path` of None gives the default filename from
+    :func:`index_path_for`.
+    """
+    index = build_index(path)
+    index_path = index_path_for(path) if index_path is None else index_path
+    # Write to a temporary file first, so readers never see half an index
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wt') as fobj:
+        json.dump(index, fobj)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def is_current(index, path):
+    """ True if `index` is for the current contents of archive `path` """
+    stat = os.stat(path)
+    return (index.get('version') == INDEX_VERSION and
+            index.get('size') == stat.st_size and
+            index.get('mtime') == stat.st_mtime)
+
+
+def load_index(path, index_path=None):
+    """ Return index for archive `path`, rebuilding it if missing or stale
+    """
+    index_path = index_path_for(path) if index_path is None else index_path
+    try:
+        with open(index_path, 'rt') as fobj:
+            index = json.load(fobj)
+    except (OSError, ValueError):
+        index = None
+    if index is None or not is_current(index, path):
+        index = write_index(path, index_path)
+    return index
+
+
+class IndexedArchive(object):
+    """ Read documents and blocks from an XProtocol archive via its index
+
+    Parameters
+    ----------
+    path : str
+        Filename of archive.
+    index_path : None or str, optional
+        Filename of index.  None gives the default from
+        :func:`index_path_for`.  We build the index if it is missing or out
+        of date.
+    symbols : None or ``XProtocolSymbols``, optional
+        Symbols to parse with.  None gives the default symbols.
+    encoding : str, optional
+        Encoding of the archive.
+    """
+
+    def __init__(self, path, index_path=None, symbols=None,
+                 encoding='utf-8'):
+        self.path = path
+        self.index = load_index(path, index_path)
+        self.documents = self.index['documents']
+        self.symbols = xpp.get_symbols() if symbols is None else symbols
+        self.encoding = encoding
+        self._fobj = open(path, 'rb')
+
+    def close(self):
+        self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def find(self, name=None, id=None, user_version=None):
+        """ Return list of document entries matching all given values """
+        criteria = [(key, value) for key, value in
+                    (('name', name), ('id', id),
+                     ('user_version', user_version))
+                    if value is not None]
+        return [doc for doc in self.documents
+                if all(doc[key] == value for key, value in criteria)]
+
+    def read_text(self, entry):
+        """ Return text of document or block `entry` from the archive """
+        self._fobj.seek(entry['offset'])
+        data = self._fobj.read(entry['end'] - entry['offset'])
+        return data.decode(self.encoding)
+
+    def read(self, entry):
+        """ Parse and return XProtocol dict for document `entry` """
+        xprotocols = self.symbols.parse(self.read_text(entry))
+        return None if xprotocols is None else xprotocols[0]
+
+    def read_block(self, entry, name):
+        """ Parse and return element called `name` in document `entry`
+
+        Raises KeyError if the document has no such element.
+        """
+        for block in entry['blocks']:
+            if block['name'] == name:
+                break
+        else:
+            raise KeyError('No element "{0}" in document'.format(name))
+        return xps.parse_element(self.read_text(block), block['tag'],
+                                 self.symbols)
+
+
+def main(argv=None):
+    """ Index archives, and print matching documents as JSON lines """
+    import xpjson as xpj
+    parser = argparse.ArgumentParser(
+        prog='xpindex',
+        description='Build sidecar indices for XProtocol archives.  With '
+        'selection options, print matching documents as JSON lines.')
+    parser.add_argument('archives', nargs='+', help='archive filenames')
+    parser.add_argument('--name', help='select documents by <Name>')
+    parser.add_argument('--id', type=int, help='select documents by <ID>')
+    parser.add_argument('--block', help='print only the element with this '
+                        'name from each selected document')
+    args = parser.parse_args(argv)
+    select = args.name is not None or args.id is not None
+    for path in args.archives:
+        if not select:
+            index = write_index(path)
+            print('{0}: {1} documents'.format(path, len(index['documents'])),
+                  file=sys.stderr)
+            continue
+        with IndexedArchive(path) as archive:
+            for entry in archive.find(name=args.name, id=args.id):
+                if args.block is None:
+                    tree = archive.read(entry)
+                else:
+                    tree = archive.read_block(entry, args.block)
+                xpj.dump(tree, sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
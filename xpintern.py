@@ -0,0 +1,111 @@
+""" Share identical subtrees and strings between parsed XProtocol trees
+
+Protocols in a corpus repeat most of their content: card layouts, string
+tables, functors, dependency lists.  An :class:`Interner` rebuilds parse
+trees so that equal subtrees, and equal strings, are the same object in
+memory, and the memory for a corpus grows with its unique content.
+
+Interned trees share their dicts and lists, so treat them as read only.  A
+change to one document would show up in every document sharing that
+subtree.
+"""
+from __future__ import print_function, absolute_import
+
+# Leaf types we compare by value.  We compare other leaves, including values
+# with source spans and lazy scalars, by identity, so we never share them.
+_VALUE_TYPES = (type(None), bool, int, float)
+
+
+class Interner(object):
+    """ Table of canonical subtrees and strings
+
+    Examples
+    --------
+    >>> interner = Interner()
+    >>> first = interner.intern([{'name': 'A', 'value': [1, 2]}])
+    >>> second = interner.intern([{'name': 'A', 'value': [1, 2]}, 3])
+    >>> second[0] is first[0]
+    True
+    """
+
+    def __init__(self):
+        self._strings = {}
+        self._nodes = {}
+
+    def __len__(self):
+        """ Number of unique strings and containers in the table """
+        return len(self._strings) + len(self._nodes)
+
+    def clear(self):
+        """ Forget all canonical objects
+
+        Trees interned before and after the clear do not share objects.
+        """
+        self._strings.clear()
+        self._nodes.clear()
+
+    def string(self, in_str):
+        """ Return canonical copy of string `in_str` """
+        return self._strings.setdefault(in_str, in_str)
+
+    def _key(self, value):
+        """ Key for canonical `value` in the key of its parent """
+        value_type = type(value)
+        if value_type in _VALUE_TYPES:
+            # Keep True distinct from 1, and 1 distinct from 1.0
+            return value_type, value
+        # Canonical containers and strings are unique for their content
+        return id(value)
+
+    def intern(self, tree):
+        """ Return copy of `tree` with equal subtrees as shared objects
+
+        Parameters
+        ----------
+        tree : object
+            Output of ``XProtocolSymbols.parse``, or any part of it.
+
+        Returns
+        -------
+        interned : object
+            Tree equal to `tree`, where any dict, list, tuple or string equal
+            to one in an earlier interned tree is the object from that earlier
+            tree.
+        """
+        tree_type = type(tree)
+        if tree_type is str:
+            return self.string(tree)
+        if tree_type is dict:
+            items = [(self.string(k), self.intern(v)) for k, v in tree.items()]
+            key = ('d',) + tuple((id(k), self._key(v)) for k, v in items)
+            make = dict
+        elif tree_type in (list, tuple):
+            items = [self.intern(v) for v in tree]
+            key = (tree_type.__name__,) + tuple(self._key(v) for v in items)
+            make = tree_type
+        else:
+            return tree
+        try:
+            return self._nodes[key]
+        except KeyError:
+            pass
+        return self._nodes.setdefault(key, make(items))
+
+
+def intern_trees(trees, interner=None):
+    """ Return list of `trees` interned with `interner`
+
+    Parameters
+    ----------
+    trees : iterable
+        Parse trees, such as outputs of ``XProtocolSymbols.parse``.
+    interner : None or :class:`Interner`, optional
+        Interner to use.  None means use a new interner.
+
+    Returns
+    -------
+    interned : list
+        Interned trees.
+    """
+    interner = Interner() if interner is None else interner
+    return [interner.intern(tree) for tree in trees]
@@ -0,0 +1,220 @@
+""" Streaming JSON for parse trees, keeping tuples, floats and None
+
+``json.dumps`` on a parse tree builds the whole string in memory, turns
+tuples into lists, and writes non-finite floats as invalid JSON.  Here we
+write trees to a file object in small pieces, and read them back with the
+same types.  The schema is JSON, with these rules:
+
+* dicts, lists, strings, ints, bools and None are JSON objects, arrays,
+  strings, numbers, ``true``, ``false`` and ``null``;
+* floats always have a decimal point or exponent (``2.0``, ``1e-05``), and
+  ints never do, so ``ParamDouble`` values stay floats;
+* tuples, such as the attribute pairs, header items and EVAStringTable
+  entries from the parser, are ``{"$tuple": [...]}``;
+* infinite and NaN floats are ``{"$float": "inf"}``, ``{"$float": "-inf"}``
+  and ``{"$float": "nan"}``;
+* a dict with a key starting with ``$`` is ``{"$dict": [[key, value],
+  ...]}``, so it cannot clash with the tags above.  Parse trees have no such
+  keys.
+
+Output is ASCII.  We write lazy scalars as their values, and leave out
+source spans.  Files hold one document per line, so a reader can decode one
+document at a time with :func:`iter_load`.
+"""
+from __future__ import print_function, absolute_import
+
+import io
+import json
+from json.encoder import encode_basestring_ascii
+import math
+
+import xpparse as xpp
+from xpbinary import IGNORE_KEYS
+
+NON_FINITE = {'inf': float('inf'), '-inf': float('-inf'), 'nan': float('nan')}
+
+
+def format_float(value):
+    """ Return JSON text for float `value` in the schema above """
+    if math.isfinite(value):
+        return float.__repr__(value)
+    name = 'nan' if math.isnan(value) else ('inf' if value > 0 else '-inf')
+    return '{"$float": "' + name + '"}'
+
+
+class JSONWriter(object):
+    """ Write parse trees as JSON lines to a file object
+
+    Parameters
+    ----------
+    fobj : file-like
+        Text file object to write to.
+    ignore : sequence, optional
+        Dict keys to leave out.
+    buffer_size : int, optional
+        Number of text pieces to collect before each write to `fobj`.
+    """
+
+    def __init__(self, fobj, ignore=IGNORE_KEYS, buffer_size=4096):
+        self.fobj = fobj
+        self.ignore = frozenset(ignore)
+        self.buffer_size = buffer_size
+        self._parts = []
+
+    def flush(self):
+        """ Write any buffered text to the file object """
+        if self._parts:
+            self.fobj.write(''.join(self._parts))
+            del self._parts[:]
+
+    def write(self, tree):
+        """ Write `tree` as one line of JSON """
+        self._value(tree)
+        self._parts.append('\n')
+        self.flush()
+
+    def write_all(self, trees):
+        """ Write each tree in iterable `trees` as a line of JSON """
+        for tree in trees:
+            self.write(tree)
+
+    def _value(self, value):
+        parts = self._parts
+        # Exact type checks first; these cover nearly all values
+        kind = type(value)
+        if kind is str:
+            parts.append(encode_basestring_ascii(value))
+        elif kind is dict:
+            self._dict(value)
+        elif kind is tuple:
+            parts.append('{"$tuple": ')
+            self._list(value)
+            parts.append('}')
+        elif kind is list:
+            self._list(value)
+        elif kind is int:
+            parts.append(int.__repr__(value))
+        elif kind is float:
+            parts.append(format_float(value))
+        elif value is None:
+            parts.append('null')
+        elif value is True:
+            parts.append('true')
+        elif value is False:
+            parts.append('false')
+        elif isinstance(value, xpp.LazyScalar):
+            self._value(value.value)
+        # Subclasses, such as the span types
+        elif isinstance(value, str):
+            parts.append(encode_basestring_ascii(value))
+        elif isinstance(value, int):
+            parts.append(int.__repr__(value))
+        elif isinstance(value, float):
+            parts.append(format_float(value))
+        else:
+            raise TypeError('Cannot write value of type {0}'
+                            .format(type(value)))
+
+    def _list(self, values):
+        parts = self._parts
+        append = parts.append
+        append('[')
+        sep = ''
+        for value in values:
+            # Inline the common scalar types; this is the hot loop
+            kind = type(value)
+            if kind is str:
+                append(sep + encode_basestring_ascii(value))
+            elif kind is int:
+                append(sep + int.__repr__(value))
+            else:
+                append(sep)
+                self._value(value)
+            sep = ', '
+        append(']')
+        if len(parts) >= self.buffer_size:
+            self.flush()
+
+    def _dict(self, obj):
+        parts = self._parts
+        if any(key.startswith('$') for key in obj):
+            # The object hook sees inner objects first, so we write
+            # key-value pairs rather than an object that could look tagged
+            parts.append('{"$dict": ')
+            self._list([[key, value] for key, value in obj.items()
+                        if key not in self.ignore])
+            parts.append('}')
+            return
+        append = parts.append
+        ignore = self.ignore
+        append('{')
+        sep = ''
+        for key, value in obj.items():
+            if key in ignore:
+                continue
+            key = sep + encode_basestring_ascii(key) + ': '
+            sep = ', '
+            kind = type(value)
+            if kind is str:
+                append(key + encode_basestring_ascii(value))
+            elif kind is int:
+                append(key + int.__repr__(value))
+            else:
+                append(key)
+                self._value(value)
+        append('}')
+        if len(parts) >= self.buffer_size:
+            self.flush()
+
+
+def decode_tags(obj):
+    """ Object hook for ``json.loads``, undoing the tags of the schema """
+    if len(obj) == 1:
+        for tag, value in obj.items():
+            if tag == '$tuple':
+                return tuple(value)
+            if tag == '$float':
+                return NON_FINITE[value]
+            if tag == '$dict':
+                return dict(value)
+    return obj
+
+
+_DECODER = json.JSONDecoder(object_hook=decode_tags)
+
+
+def dump(tree, fobj, ignore=IGNORE_KEYS):
+    """ Write `tree` to text file object `fobj` as one line of JSON """
+    JSONWriter(fobj, ignore).write(tree)
+
+
+def dump_all(trees, fobj, ignore=IGNORE_KEYS):
+    """ Write each tree in iterable `trees` to `fobj`, one per line """
+    JSONWriter(fobj, ignore).write_all(trees)
+
+
+def dumps(tree, ignore=IGNORE_KEYS):
+    """ Return JSON text for `tree`, without the trailing newline """
+    fobj = io.StringIO()
+    dump(tree, fobj, ignore)
+    return fobj.getvalue()[:-1]
+
+
+def loads(text):
+    """ Return tree from JSON `text` in the schema above """
+    return _DECODER.decode(text)
+
+
+def iter_load(fobj):
+    """ Generate trees from text file object `fobj`, one per line
+
+    We only hold one line in memory at a time.  Blank lines are skipped.
+    """
+    for line in fobj:
+        if line.strip():
+            yield _DECODER.decode(line)
+
+
+def load(fobj):
+    """ Return list of all trees in text file object `fobj` """
+    return list(iter_load(fobj))
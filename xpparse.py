@@ -2,7 +2,19 @@
 """
 from __future__ import print_function, absolute_import
 
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import copy
+import keyword
 import re
+import sys
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import ply.lex as lex
 import ply.yacc as yacc
@@ -27,6 +39,297 @@ def find_column(input, lexpos):
     return lexpos - last_cr - 1
 
 
+class SourceSpan(object):
+    """ Span ``source[start:end]`` of the parsed input text
+
+    The span keeps a reference to the input text, and only slices it when you
+    ask for the text, so holding spans does not copy the input.  Offsets are
+    indices into the input string.
+    """
+    __slots__ = ('source', 'start', 'end')
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+
+    @property
+    def text(self):
+        """ Raw source text for this span """
+        return self.source[self.start:self.end]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return '{0}({1}, {2})'.format(
+            self.__class__.__name__, self.start, self.end)
+
+
+class LazyScalar(SourceSpan):
+    """ Scalar value decoded from its source text on first access
+
+    Parsing with ``lazy_strings=True`` gives lazy scalars for long strings.
+
+    The decoded value is cached in the instance.  Lazy scalars compare equal
+    to, and hash the same as, their decoded values.  Use :func:`decode_lazy`
+    to convert all lazy scalars in a parse result to plain values.
+    """
+    __slots__ = ('decoder', '_value')
+
+    def __init__(self, source, start, end, decoder):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.decoder = decoder
+
+    @property
+    def value(self):
+        """ Decoded value """
+        try:
+            return self._value
+        except AttributeError:
+            self._value = self.decoder(self)
+        return self._value
+
+    def __eq__(self, other):
+        if isinstance(other, LazyScalar):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self.text)
+
+
+def _decode_string(span):
+    return span.source[span.start + 1:span.end - 1]
+
+
+# Shortest string token, with quotes, to keep as a lazy scalar.  A lazy
+# scalar costs about as much memory as a decoded string of this length.
+LAZY_MIN_LENGTH = 64
+
+
+def decode_lazy(obj):
+    """ Return copy of parse results `obj` with lazy scalars decoded
+
+    Parameters
+    ----------
+    obj : object
+        Output from parse, or a part of it.
+
+    Returns
+    -------
+    decoded : object
+        `obj` with any dicts, lists and tuples copied, and any
+        :class:`LazyScalar` replaced by its value.
+    """
+    if isinstance(obj, LazyScalar):
+        return obj.value
+    if isinstance(obj, dict):
+        return dict((k, decode_lazy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(decode_lazy(v) for v in obj)
+    return obj
+
+
+class SpanStr(str):
+    """ String value with source span in `span` attribute """
+    __slots__ = ('span',)
+
+
+class SpanInt(int):
+    """ Integer value with source span in `span` attribute """
+
+
+class SpanFloat(float):
+    """ Float value with source span in `span` attribute """
+    __slots__ = ('span',)
+
+
+class ParseLimits(namedtuple('ParseLimits',
+                               ('max_size', 'max_tokens', 'max_depth',
+                                'max_string', 'max_list', 'timeout'))):
+    """ Limits on input to parse, to bound the cost of hostile input
+
+    None for any limit means no limit.
+
+    Attributes
+    ----------
+    max_size : None or int
+        Maximum number of characters in the input to one parse.  For
+        ``iterparse``, the limit is on each document.
+    max_tokens : None or int
+        Maximum number of tokens, not counting whitespace.
+    max_depth : None or int
+        Maximum nesting depth of braces.
+    max_string : None or int
+        Maximum length of a string in characters between the quotes.
+    max_list : None or int
+        Maximum number of items directly inside one pair of braces.  Items
+        are scalars and braced blocks.
+    timeout : None or float
+        Maximum time for one parse in seconds.  We check the time while
+        fetching tokens, so one very long token can overrun; use `max_size`
+        to bound that.
+    """
+    __slots__ = ()
+
+
+ParseLimits.__new__.__defaults__ = (None,) * len(ParseLimits._fields)
+
+
+class ParseLimitError(ValueError):
+    """ Input exceeds a limit in :class:`ParseLimits`
+
+    Attributes
+    ----------
+    limit : str
+        Name of the limit, such as "max_depth".
+    lineno : None or int
+        Line at which we passed the limit, if known.
+    """
+
+    def __init__(self, limit, value, lineno=None):
+        msg = 'Input exceeds {0} of {1}'.format(limit, value)
+        if lineno is not None:
+            msg += ' at line {0}'.format(lineno)
+        super(ParseLimitError, self).__init__(msg)
+        self.limit = limit
+        self.lineno = lineno
+
+
+# Number of tokens between checks of the time
+TIME_CHECK_INTERVAL = 64
+
+
+class _LimitedTokens(object):
+    """ Token function checking tokens from `tokenfunc` against `limits`
+
+    Counts tokens, and items at each brace depth, as they go to the parser,
+    so the checks work the same for both engines.
+    """
+
+    def __init__(self, tokenfunc, limits):
+        self.tokenfunc = tokenfunc
+        self.limits = limits
+        self.n_tokens = 0
+        # Number of items so far at each open brace depth
+        self.items = [0]
+        self.deadline = (None if limits.timeout is None
+                         else time.monotonic() + limits.timeout)
+
+    def _fail(self, limit, tok):
+        raise ParseLimitError(limit, getattr(self.limits, limit), tok.lineno)
+
+    def __call__(self):
+        tok = self.tokenfunc()
+        if tok is None:
+            return None
+        limits = self.limits
+        self.n_tokens += 1
+        if limits.max_tokens is not None and self.n_tokens > limits.max_tokens:
+            self._fail('max_tokens', tok)
+        if (self.deadline is not None and
+                not self.n_tokens % TIME_CHECK_INTERVAL and
+                time.monotonic() > self.deadline):
+            self._fail('timeout', tok)
+        tok_type = tok.type
+        items = self.items
+        if tok_type == '}':
+            if len(items) > 1:
+                items.pop()
+            return tok
+        if tok_type == '{' or tok_type in RecursiveDescentParser.scalar_types:
+            items[-1] += 1
+            if limits.max_list is not None and items[-1] > limits.max_list:
+                self._fail('max_list', tok)
+            if tok_type == '{':
+                items.append(0)
+                if (limits.max_depth is not None and
+                        len(items) - 1 > limits.max_depth):
+                    self._fail('max_depth', tok)
+            elif (tok_type == 'MULTI_STRING' and
+                  limits.max_string is not None):
+                value = tok.value
+                # Lazy strings are spans, with quotes
+                length = len(value) - (2 if isinstance(value, LazyScalar)
+                                       else 0)
+                if length > limits.max_string:
+                    self._fail('max_string', tok)
+        return tok
+
+
+class ParseCancelled(Exception):
+    """ Parse stopped because its cancel event was set """
+
+
+class _WatchedTokens(object):
+    """ Token function reporting progress and checking for cancellation
+
+    Every `interval` tokens from `tokenfunc`, checks `cancel`, then calls
+    `progress` with the position of the token in the input and the length
+    `total` of the input.  Calls `progress` with ``(total, total)`` at the
+    end of the input.
+    """
+
+    def __init__(self, tokenfunc, total, progress=None, cancel=None,
+                 interval=1000):
+        self.tokenfunc = tokenfunc
+        self.total = total
+        self.progress = progress
+        self.cancel = cancel
+        self.interval = interval
+        self.countdown = interval
+
+    def __call__(self):
+        tok = self.tokenfunc()
+        self.countdown -= 1
+        if self.countdown and tok is not None:
+            return tok
+        self.countdown = self.interval
+        if self.cancel is not None and self.cancel.is_set():
+            raise ParseCancelled('Parse cancelled')
+        if self.progress is not None:
+            self.progress(self.total if tok is None else tok.lexpos,
+                          self.total)
+        return tok
+
+
+# Where the lexer picks up again after illegal characters: a complete tag,
+# or a brace followed by a tag, another brace, or the end of the input.
+# Braces in random binary data rarely look like this.
+RESYNC_RE = re.compile(r'''
+    <[A-Za-z_]\w*(?:\."[^"\n]*")?>
+    | [{}](?=\s*(?:[<{}]|\Z))''', re.VERBOSE)
+
+
+def _resync_end(data, start):
+    """ Return end of illegal characters in `data` starting at `start` """
+    match = RESYNC_RE.search(data, start + 1)
+    return len(data) if match is None else match.start()
+
+
+def _skip_message(data, start, end, lineno):
+    """ Return diagnostic for skipping `data` from `start` to `end` """
+    return ("Skipped {0} illegal characters at line {1} col {2} "
+            "(offsets {3} to {4})".format(
+                end - start, lineno, find_column(data, start) + 1,
+                start, end))
+
+
 class XProtocolSymbols(object):
     # Known basic tag identifiers
     basic_tag_ids = {'XProtocol': 'XPROTOCOL',
@@ -73,7 +376,13 @@ class XProtocolSymbols(object):
 
     literals = '{}'
 
-    def __init__(self, error_mode='strict'):
+    # Types for scalar token values with source spans
+    span_types = {'MULTI_STRING': SpanStr,
+                  'INTEGER': SpanInt,
+                  'FLOAT': SpanFloat}
+
+    def __init__(self, error_mode='strict', engine='lalr', spans=False,
+                 lazy_strings=False, limits=None):
         """ Build lexer and parser with given `error_mode`
 
         Parameters
@@ -81,17 +390,63 @@ class XProtocolSymbols(object):
         error_mode : {'strict', 'forgiving'}
             'strict' gives SyntaxErrors for a lexing or parsing error.
             'forgiving' tries to skip past the errors.
+        engine : {'lalr', 'rd'}
+            Default parser engine.  'lalr' uses the ``ply.yacc`` table driven
+            parser, 'rd' uses the hand-written recursive descent parser in
+            :class:`RecursiveDescentParser`.  Both give the same output for
+            valid input.  In 'forgiving' mode, the yacc parser recovers from
+            syntax errors by discarding tokens, and returns the XProtocols
+            it could parse; the 'rd' parser stops at the first syntax error
+            and returns None.
+        spans : bool, optional
+            If True, record where each parsed element came from in the input.
+            Each output dict gets a 'span' key with a :class:`SourceSpan`
+            value giving the dict's source text from start tag to closing
+            brace.  String, integer and float values are returned as
+            :class:`SpanStr`, :class:`SpanInt` and :class:`SpanFloat`, which
+            compare equal to the plain values, with a `span` attribute giving
+            the span of the value token.  Python does not allow subclasses of
+            bool, so boolean values have no span.
+        lazy_strings : bool, optional
+            If True, return strings of at least ``LAZY_MIN_LENGTH``
+            characters, with quotes, as :class:`LazyScalar` instances, which
+            decode the value from the source text when first asked for their
+            `value`.  Lazy scalars are spans of the input text, so the parse
+            result does not hold copies of long strings.  This only saves
+            memory: lexing does the same work per token, because ``ply``
+            copies each token's text before our rules see it.  Shorter
+            strings, numbers and booleans are always plain values.  A lazy
+            scalar is larger than an int, a float or a short string, so lazy
+            numbers made the result bigger (86888 against 66184 bytes for
+            the protocol embedded in the sample file) and no faster to
+            parse.  With long strings lazy, the sample file result takes
+            1180 bytes instead of 68962, and the embedded protocol 57473
+            bytes instead of 66184, in about the same time.
+        limits : None or :class:`ParseLimits`, optional
+            Limits on the size and shape of the input, and the time to parse
+            it.  Parsing raises :class:`ParseLimitError` for input past a
+            limit, in either error mode.  None means no limits.
         """
         if error_mode not in ('strict', 'forgiving'):
             raise ValueError('Error mode should be "strict" or "forgiving"')
+        if engine not in ('lalr', 'rd'):
+            raise ValueError('Engine should be "lalr" or "rd"')
         self.lexer = lex.lex(module=self)
         self.parser = yacc.yacc(debug=False, module=self)
+        # Pool of (lexer, parser) pairs for concurrent parsing
+        self._pool = []
+        self._pool_lock = threading.Lock()
         self.error_mode = error_mode
+        self.engine = engine
+        self.spans = spans
+        self.lazy_strings = lazy_strings
+        self.limits = limits
 
     # Basic tag
     def t_TAG(self, t):
         r'<(?P<tagname>[A-Za-z_][\w_]*)>'
-        t.value = t.lexer.lexmatch.group('tagname')
+        # Tag names repeat a lot; share one string for each name
+        t.value = sys.intern(t.lexer.lexmatch.group('tagname'))
         t.type = self.basic_tag_ids.get(t.value, 'TAG')
         return t
 
@@ -99,7 +454,7 @@ class XProtocolSymbols(object):
     def t_TYPED_TAG(self, t):
         r'<(?P<tagtype>[A-Za-z_][\w_]*)\."(?P<tagname>.*?)">'
         match = t.lexer.lexmatch
-        t.value = match.group('tagname')
+        t.value = sys.intern(match.group('tagname'))
         t.type = self.typed_tag_ids.get(match.group('tagtype'), 'TYPED_TAG')
         return t
 
@@ -130,25 +485,41 @@ class XProtocolSymbols(object):
         t.value = False
         return t
 
+    # String literal; doubled double quotes do not end the string.  The
+    # pattern has only one way of matching any input, so matching is linear
+    # in the input length, even for unterminated strings.
     def t_MULTI_STRING(self, t):
-        r'"(?:[^"]|(?:"")|(?:\\x[0-9a-fA-F]+)|(?:\\.))*"'
+        r'"[^"]*(?:""[^"]*)*"'
         t.lexer.lineno += t.value.count("\n")
-        t.value = t.value[1:-1]
+        if self.lazy_strings and len(t.value) >= LAZY_MIN_LENGTH:
+            t.value = LazyScalar(t.lexer.lexdata, t.lexpos, t.lexer.lexpos,
+                                 _decode_string)
+        else:
+            t.value = t.value[1:-1]
         return t
 
     def t_error(self, t):
-        msg = ("Illegal character '{0}' at line {1} col {2}".format(
-            t.value[0],
-            t.lexer.lineno,
-            find_column(t.lexer.lexdata, t.lexpos) + 1))
+        lexer = t.lexer
+        data = lexer.lexdata
+        start = t.lexpos
         if self.error_mode == 'strict':
+            msg = ("Illegal character '{0}' at line {1} col {2}".format(
+                data[start], lexer.lineno, find_column(data, start) + 1))
             exc = SyntaxError(msg)
-            exc.lineno = t.lexer.lineno
+            exc.lineno = lexer.lineno
             raise exc
-        t.type = t.value[0]
-        t.value = t.value[0]
-        t.lexer.skip(1)
-        return t
+        # Skip the whole run of damaged input in one step, up to the next
+        # point where the lexer can pick up again.  Binary blobs or corrupted
+        # regions then give one diagnostic instead of one per character.
+        end = _resync_end(data, start)
+        skipped = getattr(lexer, 'skipped', None)
+        if skipped is None:
+            print(_skip_message(data, start, end, lexer.lineno))
+        else:
+            # Lexing for a parallel parse; the merge reports the skip
+            skipped.append((None, None, lexer.lineno, start, end))
+        lexer.lineno += data.count('\n', start, end)
+        lexer.skip(end - start)
 
     # yacc Grammar
 
@@ -171,6 +542,7 @@ class XProtocolSymbols(object):
                     cards=[] if p[5] is None else p[5],
                     depends=[] if p[6] is None else p[6])
         p[0].update(p[3])
+        self._add_span(p)
 
     def p_xp_hdr(self, p):
         """ xp_hdr : xp_hdr xp_hdr_key
@@ -232,6 +604,7 @@ class XProtocolSymbols(object):
                 'name': p[1],
                 'class': p[3],
                 'value': p[4]}
+        self._add_span(p)
 
     def p_param_functor(self, p):
         """ param_functor : PARAMFUNCTOR '{' class block_list emc '}'
@@ -243,6 +616,7 @@ class XProtocolSymbols(object):
         for param in p[5]:
             key = param['type']
             p[0][key] = param
+        self._add_span(p)
 
     def p_param_emc(self, p):
         """ emc : event method connection
@@ -260,6 +634,7 @@ class XProtocolSymbols(object):
         p[0] = dict(type='method',
                     name=p[1],
                     args=p[3])
+        self._add_span(p)
 
     def p_connection(self, p):
         """ connection : CONNECTION '{' string_list '}'
@@ -267,6 +642,7 @@ class XProtocolSymbols(object):
         p[0] = dict(type='connection',
                     name=p[1],
                     args=p[3])
+        self._add_span(p)
 
     def p_event(self, p):
         """ event : EVENT '{' string_list '}'
@@ -274,6 +650,7 @@ class XProtocolSymbols(object):
         p[0] = dict(type='event',
                     name=p[1],
                     args=p[3])
+        self._add_span(p)
 
     def p_param_choice(self, p):
         """ param_choice : PARAMCHOICE '{' attr_list MULTI_STRING '}'
@@ -283,6 +660,7 @@ class XProtocolSymbols(object):
                     name=p[1],
                     attrs=p[3],
                     value=p[4])
+        self._add_span(p)
 
     def p_param_map(self, p):
         """ param_map : PARAMMAP '{' block_list '}'
@@ -290,6 +668,7 @@ class XProtocolSymbols(object):
         p[0] = dict(type='param_map',
                     name=p[1],
                     value=p[3])
+        self._add_span(p)
 
     def p_block_list(self, p):
         """ block_list : block_list block
@@ -304,6 +683,7 @@ class XProtocolSymbols(object):
                     name=p[1],
                     attrs=p[3],
                     value=p[4])
+        self._add_span(p)
 
     def p_curly_lists(self, p):
         """ curly_lists : curly_lists curly_list
@@ -338,6 +718,7 @@ class XProtocolSymbols(object):
                     name=p[1],
                     attrs=p[3],
                     value=p[4])
+        self._add_span(p)
 
     def p_param_double(self, p):
         """ param_double : PARAMDOUBLE '{' attr_list empty '}'
@@ -347,6 +728,7 @@ class XProtocolSymbols(object):
                     name=p[1],
                     attrs=p[3],
                     value=p[4])
+        self._add_span(p)
 
     def p_param_long(self, p):
         """ param_long : PARAMLONG '{' attr_list empty '}'
@@ -356,6 +738,7 @@ class XProtocolSymbols(object):
                     name=p[1],
                     attrs=p[3],
                     value=p[4])
+        self._add_span(p)
 
     def p_param_bool(self, p):
         """ param_bool : PARAMBOOL '{' attr_list empty '}'
@@ -366,6 +749,7 @@ class XProtocolSymbols(object):
                     name=p[1],
                     attrs=p[3],
                     value=p[4])
+        self._add_span(p)
 
     def p_attr_list(self, p):
         """ attr_list : attr_list key_value
@@ -406,6 +790,7 @@ class XProtocolSymbols(object):
                     values=p[3],
                     dll=p[4],
                     context=p[5])
+        self._add_span(p)
 
     def p_curly_list(self, p):
         """ curly_list : '{' string_list '}'
@@ -437,6 +822,7 @@ class XProtocolSymbols(object):
                     repr=p[3],
                     controls=p[4],
                     lines=p[5])
+        self._add_span(p)
 
     def p_eva_card_layout(self, p):
         """ eva_card_layout : EVACARDLAYOUT '{' MULTI_STRING INTEGER eva_controls lines '}'
@@ -448,6 +834,7 @@ class XProtocolSymbols(object):
                     n_controls=p[4],
                     controls=p[5],
                     lines=p[6])
+        self._add_span(p)
 
     def p_controls(self, p):
         """ controls : controls control
@@ -474,6 +861,7 @@ class XProtocolSymbols(object):
         p[0] = dict(param=p[3],
                     pos=p[4],
                     repr=p[5])
+        self._add_span(p)
 
     def p_eva_control(self, p):
         """ eva_control : MULTI_STRING INTEGER INTEGER MULTI_STRING
@@ -481,6 +869,7 @@ class XProtocolSymbols(object):
         p[0] = dict(param=p[1],
                     pos=[p[2], p[3]],
                     repr=p[4])
+        self._add_span(p)
 
     def p_eva_string_table(self, p):
         """ eva_string_table : EVASTRINGTABLE '{' INTEGER int_strings '}'
@@ -540,9 +929,12 @@ class XProtocolSymbols(object):
             msg = "Syntax error at EOF"
         else:
             in_data = p.lexer.lexdata
+            start = in_data.rfind('\n', 0, p.lexpos) + 1
+            end = in_data.find('\n', p.lexpos)
             msg = ("Syntax error at '{0}', line {1}, col {2}".format(
-                p.value, p.lineno, find_column(in_data, p.lexpos) + 1) +
-                "\nLine is: '{0}'".format(in_data.splitlines()[p.lineno-1]))
+                p.value, p.lineno, p.lexpos - start + 1) +
+                "\nLine is: '{0}'".format(
+                    in_data[start:None if end == -1 else end].rstrip('\r')))
         if self.error_mode == 'strict':
             exc = SyntaxError(msg)
             if not p:
@@ -552,15 +944,860 @@ class XProtocolSymbols(object):
             raise exc
         print(msg)
 
+    def _add_span(self, p):
+        """ Add source span to dict made by production `p` if tracking spans
+        """
+        if self.spans:
+            p[0]['span'] = SourceSpan(p.lexer.lexdata,
+                                      p.lexpos(1),
+                                      p.slice[-1].endlexpos)
+
+    def token_func(self, lexer):
+        """ Return function returning next token from `lexer`
+
+        Gives tokens carrying source spans if we are tracking spans.  Lazy
+        scalars are already spans, so do not need wrapping.  Checks tokens
+        against our `limits`, if any.
+        """
+        token = lexer.token
+        if self.spans:
+            token = self._span_token_func(lexer)
+        if self.limits is not None:
+            token = _LimitedTokens(token, self.limits)
+        return token
+
+    def _span_token_func(self, lexer):
+        """ Return function giving tokens from `lexer` with source spans """
+        token = lexer.token
+        span_types = self.span_types
+
+        def span_token():
+            tok = token()
+            if tok is None:
+                return None
+            tok.endlexpos = lexer.lexpos
+            # Lazy scalars are already spans
+            if (tok.type in span_types and
+                    not isinstance(tok.value, LazyScalar)):
+                tok.value = span_types[tok.type](tok.value)
+                tok.value.span = SourceSpan(lexer.lexdata,
+                                            tok.lexpos,
+                                            tok.endlexpos)
+            return tok
+
+        return span_token
+
     def reset(self):
         """ Reset lexer ready for new read """
         self.lexer.lineno = 1
 
-    def parse(self, in_str):
+    def _acquire(self):
+        """ Get unused (lexer, parser) pair from pool, or make a new one
+
+        Lexers and LR parsers keep the state of the current parse, so each
+        concurrent parse needs its own pair.  Clones share the lexing and
+        parsing tables of `self.lexer` and `self.parser`.
+        """
+        with self._pool_lock:
+            if self._pool:
+                return self._pool.pop()
+        return self.lexer.clone(), copy.copy(self.parser)
+
+    def _release(self, pair):
+        """ Return (lexer, parser) pair to pool """
+        # Don't keep the last input alive in the pool
+        lexer = pair[0]
+        lexer.lexdata = lexer.lexmatch = None
+        with self._pool_lock:
+            self._pool.append(pair)
+
+    def parse(self, in_str, engine=None, executor=None,
+              segment_size=2 ** 20, progress=None, cancel=None,
+              progress_interval=1000):
         """ Parse `in_str` with XProtocol parser
+
+        It is safe to call this method from several threads at the same
+        time.  Each call gets its own lexer and parser from a pool.
+
+        Parameters
+        ----------
+        in_str : str
+            XProtocol text to parse.
+        engine : None or {'lalr', 'rd'}, optional
+            Parser engine to use.  None (the default) means use the engine
+            given at construction time.
+        executor : None or ``concurrent.futures.Executor``, optional
+            If not None, and `in_str` is longer than `segment_size`, split
+            `in_str` with :func:`split_segments`, lex the segments in
+            parallel in `executor`, and parse the merged tokens here.  Use a
+            process pool; lexing holds the GIL.
+        segment_size : int, optional
+            Approximate number of characters in each segment to lex in
+            parallel.
+        progress : None or callable, optional
+            If not None, called every `progress_interval` tokens as
+            ``progress(done, total)``, where `done` is the number of
+            characters of `in_str` parsed so far, and `total` is the length
+            of `in_str`.  Called with ``(total, total)`` at the end of the
+            input.
+        cancel : None or ``threading.Event``, optional
+            If not None, checked every `progress_interval` tokens.  If set,
+            stop and raise :class:`ParseCancelled`.  Set it from another
+            thread, such as a user interface, to cancel the parse.
+        progress_interval : int, optional
+            Number of tokens between calls to `progress` and checks of
+            `cancel`.
+
+        Returns
+        -------
+        xprotocols : list or None
+            List of parsed XProtocol dicts.  None if there was an error in
+            'forgiving' mode.
+        """
+        watch = (None if progress is None and cancel is None
+                 else (progress, cancel, progress_interval))
+        if executor is None or len(in_str) <= segment_size:
+            return self._parse(in_str, engine, watch=watch)
+        return self._parse_parallel(in_str, engine, executor, segment_size,
+                                    watch)
+
+    def _watch(self, tokenfunc, in_str, watch):
+        """ Wrap `tokenfunc` for progress and cancel in `watch`, if any """
+        if watch is None:
+            return tokenfunc
+        return _WatchedTokens(tokenfunc, len(in_str), *watch)
+
+    def _check_size(self, in_str):
+        """ Raise ParseLimitError if `in_str` is over our size limit """
+        if self.limits is None or self.limits.max_size is None:
+            return
+        if len(in_str) > self.limits.max_size:
+            raise ParseLimitError('max_size', self.limits.max_size)
+
+    def _parse(self, in_str, engine=None, lineno=1, watch=None):
+        """ Parse `in_str`, with line numbers starting at `lineno`
+
+        `watch` is None or a tuple of (progress, cancel, interval), as for
+        :meth:`parse`.
+        """
+        engine = self.engine if engine is None else engine
+        if engine not in ('lalr', 'rd'):
+            raise ValueError('Engine should be "lalr" or "rd"')
+        self._check_size(in_str)
+        pair = self._acquire()
+        try:
+            lexer, parser = pair
+            lexer.lineno = lineno
+            tokenfunc = self._watch(self.token_func(lexer), in_str, watch)
+            if engine == 'lalr':
+                return parser.parse(in_str,
+                                    lexer=lexer,
+                                    tracking=self.spans,
+                                    tokenfunc=tokenfunc)
+            lexer.input(in_str)
+            return RecursiveDescentParser(lexer,
+                                          self.p_error,
+                                          tokenfunc,
+                                          self.spans).parse()
+        finally:
+            self._release(pair)
+
+    def _parse_parallel(self, in_str, engine, executor, segment_size,
+                        watch=None):
+        """ Parse `in_str` from tokens lexed in parallel in `executor` """
+        engine = self.engine if engine is None else engine
+        if engine not in ('lalr', 'rd'):
+            raise ValueError('Engine should be "lalr" or "rd"')
+        self._check_size(in_str)
+        options = (('error_mode', self.error_mode),
+                   ('lazy_strings', self.lazy_strings))
+        futures = []
+        starts = []
+        lineno = 1
+        for start, end in split_segments(in_str, segment_size):
+            futures.append(executor.submit(_lex_segment, options,
+                                           in_str[start:end], lineno, start))
+            starts.append(start)
+            lineno += in_str.count('\n', start, end)
+        tokens = self._merge_tokens(in_str, starts, futures)
+        tokenfunc = lambda: next(tokens, None)
+        if self.limits is not None:
+            tokenfunc = _LimitedTokens(tokenfunc, self.limits)
+        tokenfunc = self._watch(tokenfunc, in_str, watch)
+        pair = self._acquire()
+        try:
+            lexer, parser = pair
+            # Error messages take the input from the lexer
+            lexer.input(in_str)
+            if engine == 'lalr':
+                return parser.parse(lexer=lexer,
+                                    tracking=self.spans,
+                                    tokenfunc=tokenfunc)
+            return RecursiveDescentParser(lexer,
+                                          self.p_error,
+                                          tokenfunc,
+                                          self.spans).parse()
+        finally:
+            for future in futures:
+                future.cancel()
+            self._release(pair)
+
+    def _merge_tokens(self, in_str, starts, futures):
+        """ Generate tokens for `in_str` from segment `futures` in order
+
+        `starts` are the offsets of the segments in `in_str`.  Rebuilds
+        tokens from the tuples of :func:`_lex_segment`, with spans or lazy
+        scalars of `in_str`.  Raises lexing errors when we reach them, as the
+        serial lexer does.
+        """
+        span_types = self.span_types if self.spans else {}
+        for tok_type, value, lineno, lexpos, endlexpos in self._merge_items(
+                in_str, starts, futures):
+            tok = lex.LexToken()
+            tok.type = tok_type
+            tok.lineno = lineno
+            tok.lexpos = lexpos
+            tok.endlexpos = endlexpos
+            if value is None:
+                value = LazyScalar(in_str, lexpos, endlexpos, _decode_string)
+            elif tok_type in span_types:
+                value = span_types[tok_type](value)
+                value.span = SourceSpan(in_str, lexpos, endlexpos)
+            tok.value = value
+            yield tok
+
+    def _merge_items(self, in_str, starts, futures):
+        """ Generate token tuples of segment `futures` in order
+
+        Reports the skips over illegal characters in the segments.  A
+        segment only sees its own text, so a skip can stop at the segment
+        end, or at a brace that is only followed by the segment end, where
+        the serial lexer would carry on.  From a skip like that, we lex
+        `in_str` serially, until we reach the start of a segment between two
+        tokens, and continue with the tuples of that segment.
+        """
+        index = 0
+        while index < len(futures):
+            tokens, error = futures[index].result()
+            index += 1
+            for item in tokens:
+                if item[0] is not None:
+                    yield item
+                    continue
+                lineno, start, end = item[2:]
+                if end == _resync_end(in_str, start):
+                    print(_skip_message(in_str, start, end, lineno))
+                    continue
+                index = yield from self._lex_serial(in_str, starts, start,
+                                                    lineno)
+                break
+            else:
+                if error is not None:
+                    exc = SyntaxError(error[0])
+                    exc.lineno = error[1]
+                    raise exc
+
+    def _lex_serial(self, in_str, starts, pos, lineno):
+        """ Generate token tuples lexing `in_str` from `pos` at `lineno`
+
+        Stops at the first segment start from `starts`, after `pos`, that
+        comes after the last token or skip, and before the next.  Returns
+        the index of that segment, or the number of segments if we reached
+        the end of `in_str`.
         """
-        self.reset()
-        return self.parser.parse(in_str, lexer=self.lexer)
+        lexer = self.lexer.clone()
+        lexer.input(in_str)
+        lexer.lexpos = pos
+        lexer.lineno = lineno
+        lexer.skipped = skipped = []
+        # Next segment start after the last token or skip
+        index = bisect_right(starts, pos)
+        while True:
+            tok = lexer.token()
+            items = skipped[:]
+            del skipped[:]
+            if tok is not None:
+                value = tok.value
+                if isinstance(value, LazyScalar):
+                    value = None
+                items.append((tok.type, value, tok.lineno, tok.lexpos,
+                              lexer.lexpos))
+            for item in items:
+                if index < len(starts) and item[3] >= starts[index]:
+                    return index
+                tok_type, value, item_lineno, start, end = item
+                if tok_type is None:
+                    print(_skip_message(in_str, start, end, item_lineno))
+                else:
+                    yield item
+                index = max(index, bisect_left(starts, end))
+            if tok is None:
+                return len(starts)
+
+    def iterparse(self, source, engine=None, chunk_size=2 ** 16):
+        """ Generate XProtocol dicts from `source`, one at a time
+
+        ``parse`` returns all the XProtocols of its input in one list, after
+        it has parsed them all.  Here we split the input into top-level
+        documents with :func:`split_documents`, and parse and yield each
+        document in turn.  We only hold one document at a time, so memory
+        use does not grow with the number of documents in `source`.
+
+        Parameters
+        ----------
+        source : str or file-like
+            XProtocol text, or text file object to read it from.
+        engine : None or {'lalr', 'rd'}, optional
+            Parser engine to use.  None (the default) means use the engine
+            given at construction time.
+        chunk_size : int, optional
+            Number of characters to read from a file object at a time.
+
+        Yields
+        ------
+        xprotocol : dict
+            Parsed XProtocol dict.  Syntax errors give line numbers in the
+            whole of `source`.  Spans and lazy scalars refer to the text of
+            their document.  In 'forgiving' mode, we skip documents that give
+            no output.
+        """
+        for text, lineno in split_documents(source, chunk_size):
+            xprotocols = self._parse(text, engine, lineno)
+            if xprotocols is not None:
+                for xprotocol in xprotocols:
+                    yield xprotocol
+
+
+class _ParseAbort(Exception):
+    """ Signal to unwind recursive descent parse after a forgiven error """
+
+
+def _spanned(method):
+    """ Decorate parser `method` to add source span to output dict """
+
+    def spanned_method(self):
+        if not self.spans:
+            return method(self)
+        start = None if self.tok is None else self.tok.lexpos
+        out = method(self)
+        out['span'] = SourceSpan(self.lexer.lexdata,
+                                 start,
+                                 self.prev.endlexpos)
+        return out
+
+    spanned_method.__name__ = method.__name__
+    spanned_method.__doc__ = method.__doc__
+    return spanned_method
+
+
+class RecursiveDescentParser(object):
+    """ Predictive recursive descent parser for XProtocol token streams
+
+    Works from the same token stream as the LALR parser, and gives identical
+    output.  The grammar is LL(1) apart from empty curly lists in
+    ``param_array``, which need the token after the opening brace.
+
+    There is one method per nonterminal of the ``XProtocolSymbols`` grammar,
+    so you can parse from any start symbol, as you can with
+    ``yacc.yacc(start=...)``.  Nonterminals that are Python keywords have a
+    trailing underscore, as in ``class_``.
+
+    The yacc parser recovers from syntax errors in 'forgiving' mode by
+    discarding tokens.  This parser instead reports the first syntax error to
+    `errorf` and returns None.
+    """
+
+    # Map block token types to names of methods parsing the block
+    block_methods = {'PARAMBOOL': 'param_bool',
+                     'PARAMLONG': 'param_long',
+                     'PARAMDOUBLE': 'param_double',
+                     'PARAMSTRING': 'param_string',
+                     'PARAMARRAY': 'param_array',
+                     'PARAMMAP': 'param_map',
+                     'PARAMCHOICE': 'param_choice',
+                     'PARAMFUNCTOR': 'param_functor',
+                     'PIPESERVICE': 'pipe_service'}
+
+    # Blocks holding lists of blocks
+    container_types = ('PARAMMAP', 'PIPESERVICE', 'PARAMFUNCTOR')
+
+    hdr_methods = {'NAME': 'name',
+                   'ID': 'id',
+                   'USERVERSION': 'user_version',
+                   'EVASTRINGTABLE': 'eva_string_table'}
+
+    emc_methods = {'EVENT': 'event',
+                   'METHOD': 'method',
+                   'CONNECTION': 'connection'}
+
+    scalar_types = ('FLOAT', 'INTEGER', 'FALSE', 'TRUE', 'MULTI_STRING')
+
+    # Map first token type in curly list to allowed token types in list
+    list_types = {'MULTI_STRING': ('MULTI_STRING',),
+                  'INTEGER': ('INTEGER',),
+                  'FLOAT': ('FLOAT',),
+                  'TRUE': ('TRUE', 'FALSE'),
+                  'FALSE': ('TRUE', 'FALSE')}
+
+    def __init__(self, lexer, errorf, tokenfunc=None, spans=False):
+        """ Initialize parser reading tokens from `lexer`
+
+        Parameters
+        ----------
+        lexer : ``ply.lex.Lexer`` instance
+            Lexer which has already been given its input.
+        errorf : callable
+            Called with the unexpected token (or None at end of input) on a
+            syntax error.  Can raise an error, such as SyntaxError.
+        tokenfunc : None or callable, optional
+            Function returning next token.  If None, use ``lexer.token``.
+        spans : bool, optional
+            If True, add a 'span' :class:`SourceSpan` to each output dict.
+            Tokens must have an `endlexpos` attribute, as from
+            ``XProtocolSymbols.token_func`` with span tracking.
+        """
+        self.lexer = lexer
+        self.errorf = errorf
+        self._token = lexer.token if tokenfunc is None else tokenfunc
+        self.spans = spans
+        self.tok = None
+        self.type = None
+        self.prev = None
+        self._advance()
+
+    def _advance(self):
+        tok = self._token()
+        self.prev = self.tok
+        self.tok = tok
+        self.type = '$end' if tok is None else tok.type
+
+    def _error(self):
+        tok = self.tok
+        if tok is not None and not hasattr(tok, 'lexer'):
+            tok.lexer = self.lexer
+        self.errorf(tok)
+        raise _ParseAbort()
+
+    def _expect(self, tok_type):
+        """ Consume token of type `tok_type`, return its value """
+        tok = self.tok
+        if self.type != tok_type:
+            self._error()
+        self._advance()
+        return tok.value
+
+    def _repeat(self, method, tok_types):
+        """ Parse one or more `method` while lookahead is in `tok_types` """
+        out = [method()]
+        while self.type in tok_types:
+            out.append(method())
+        return out
+
+    def parse(self, start='xprotocols'):
+        """ Parse whole token stream as nonterminal `start`
+
+        Returns None if there was a syntax error, and `errorf` did not raise.
+        """
+        if keyword.iskeyword(start):
+            start += '_'
+        try:
+            out = getattr(self, start)()
+            if self.type != '$end':
+                self._error()
+        except _ParseAbort:
+            return None
+        except RecursionError:
+            # Blocks nested in attributes still recurse
+            lineno = None if self.tok is None else self.tok.lineno
+            exc = SyntaxError('Nesting too deep for recursive descent parser'
+                              + ('' if lineno is None
+                                 else ' at line {0}'.format(lineno)))
+            exc.lineno = lineno
+            raise exc
+        return out
+
+    def xprotocols(self):
+        return self._repeat(self.xprotocol, ('XPROTOCOL',))
+
+    @_spanned
+    def xprotocol(self):
+        self._expect('XPROTOCOL')
+        self._expect('{')
+        hdr = self.xp_hdr()
+        blocks = self.block_list()
+        if self.type == 'PARAMCARDLAYOUT':
+            cards = self.param_cards()
+        elif self.type == 'EVACARDLAYOUT':
+            cards = self.eva_cards()
+        else:
+            cards = []
+        depends = self.depends() if self.type == 'DEPENDENCY' else []
+        self._expect('}')
+        out = dict(type='xprotocol',
+                   blocks=blocks,
+                   cards=cards,
+                   depends=depends)
+        out.update(hdr)
+        return out
+
+    def xp_hdr(self):
+        hdr = dict([self.xp_hdr_key()])
+        while self.type in self.hdr_methods:
+            hdr.update(dict([self.xp_hdr_key()]))
+        return hdr
+
+    def xp_hdr_key(self):
+        if self.type not in self.hdr_methods:
+            self._error()
+        return getattr(self, self.hdr_methods[self.type])()
+
+    def name(self):
+        self._expect('NAME')
+        return ('name', self._expect('MULTI_STRING'))
+
+    def id(self):
+        self._expect('ID')
+        return ('id', self._expect('INTEGER'))
+
+    def user_version(self):
+        self._expect('USERVERSION')
+        return ('user_version', self._expect('FLOAT'))
+
+    def depends(self):
+        return self._repeat(self.dependency, ('DEPENDENCY',))
+
+    def param_cards(self):
+        return self._repeat(self.param_card_layout, ('PARAMCARDLAYOUT',))
+
+    def eva_cards(self):
+        return self._repeat(self.eva_card_layout, ('EVACARDLAYOUT',))
+
+    def _open_container(self):
+        """ Parse start of block holding a block list, up to the list
+
+        Returns output dict without its value, and start of block in input.
+        """
+        tok_type = self.type
+        start = self.tok.lexpos
+        out = {'type': self.block_methods[tok_type],
+               'name': self._expect(tok_type)}
+        self._expect('{')
+        if tok_type != 'PARAMMAP':
+            out['class'] = self.class_()
+        return out, start
+
+    def _close_container(self, out, start, value):
+        """ Parse end of block from :meth:`_open_container`; return dict """
+        out['value'] = value
+        if out['type'] == 'param_functor':
+            for param in self.emc():
+                out[param['type']] = param
+        self._expect('}')
+        if self.spans:
+            out['span'] = SourceSpan(self.lexer.lexdata,
+                                     start,
+                                     self.prev.endlexpos)
+        return out
+
+    def pipe_service(self):
+        out, start = self._open_container()
+        return self._close_container(out, start, self.block_list())
+
+    def param_functor(self):
+        out, start = self._open_container()
+        return self._close_container(out, start, self.block_list())
+
+    def emc(self):
+        out = []
+        todo = dict(self.emc_methods)
+        while todo:
+            if self.type not in todo:
+                self._error()
+            out.append(getattr(self, todo.pop(self.type))())
+        return out
+
+    def _string_list_block(self, tok_type, out_type):
+        name = self._expect(tok_type)
+        self._expect('{')
+        args = self.string_list()
+        self._expect('}')
+        return dict(type=out_type,
+                    name=name,
+                    args=args)
+
+    @_spanned
+    def method(self):
+        return self._string_list_block('METHOD', 'method')
+
+    @_spanned
+    def connection(self):
+        return self._string_list_block('CONNECTION', 'connection')
+
+    @_spanned
+    def event(self):
+        return self._string_list_block('EVENT', 'event')
+
+    def _attr_value_block(self, tok_type, out_type, value_types):
+        """ Parse block with attr list and optional value of `value_types`
+        """
+        name = self._expect(tok_type)
+        self._expect('{')
+        attrs = self.attr_list()
+        value = None
+        if self.type in value_types:
+            value = self.tok.value
+            self._advance()
+        self._expect('}')
+        return dict(type=out_type,
+                    name=name,
+                    attrs=attrs,
+                    value=value)
+
+    @_spanned
+    def param_choice(self):
+        return self._attr_value_block('PARAMCHOICE', 'param_choice',
+                                      ('MULTI_STRING',))
+
+    def param_map(self):
+        out, start = self._open_container()
+        return self._close_container(out, start, self.block_list())
+
+    def block_list(self):
+        """ Parse one or more blocks
+
+        Blocks holding block lists, such as ``ParamMap``, nest to any depth,
+        so we keep the blocks we are inside on a stack, rather than
+        recursing, as the yacc parser does.
+        """
+        # (output dict, start, parent block list) for each open block
+        stack = []
+        blocks = []
+        while True:
+            if self.type in self.container_types:
+                out, start = self._open_container()
+                stack.append((out, start, blocks))
+                blocks = []
+                continue
+            blocks.append(self.block())
+            while self.type not in self.block_methods:
+                if not stack:
+                    return blocks
+                out, start, parent = stack.pop()
+                parent.append(self._close_container(out, start, blocks))
+                blocks = parent
+
+    @_spanned
+    def param_array(self):
+        name = self._expect('PARAMARRAY')
+        self._expect('{')
+        attrs = self.attr_list()
+        value = self.curly_lists()
+        self._expect('}')
+        return dict(type='param_array',
+                    name=name,
+                    attrs=attrs,
+                    value=value)
+
+    def curly_lists(self):
+        out = []
+        self._expect('{')
+        while True:
+            if self.type == '}':
+                out.append([])
+            else:
+                out.append(self._list_contents())
+            self._expect('}')
+            if self.type != '{':
+                return out
+            self._advance()
+
+    def block(self):
+        if self.type not in self.block_methods:
+            self._error()
+        return getattr(self, self.block_methods[self.type])()
+
+    @_spanned
+    def param_string(self):
+        return self._attr_value_block('PARAMSTRING', 'param_string',
+                                      ('MULTI_STRING',))
+
+    @_spanned
+    def param_double(self):
+        return self._attr_value_block('PARAMDOUBLE', 'param_double',
+                                      ('FLOAT',))
+
+    @_spanned
+    def param_long(self):
+        return self._attr_value_block('PARAMLONG', 'param_long',
+                                      ('INTEGER',))
+
+    @_spanned
+    def param_bool(self):
+        return self._attr_value_block('PARAMBOOL', 'param_bool',
+                                      ('TRUE', 'FALSE'))
+
+    def attr_list(self):
+        out = []
+        while self.type == 'TAG':
+            out.append(self.key_value())
+        return out
+
+    def key_value(self):
+        key = self._expect('TAG')
+        if self.type == '{':
+            return (key, self.curly_list())
+        if self.type in self.scalar_types:
+            return (key, self.scalar())
+        return (key, self.block())
+
+    def scalar(self):
+        if self.type not in self.scalar_types:
+            self._error()
+        value = self.tok.value
+        self._advance()
+        return value
+
+    @_spanned
+    def dependency(self):
+        name = self._expect('DEPENDENCY')
+        self._expect('{')
+        values = self.string_list()
+        dll = self.dll() if self.type == 'DLL' else None
+        context = self.context() if self.type == 'CONTEXT' else None
+        self._expect('}')
+        return dict(type='dependency',
+                    name=name,
+                    values=values,
+                    dll=dll,
+                    context=context)
+
+    def curly_list(self):
+        self._expect('{')
+        out = self._list_contents()
+        self._expect('}')
+        return out
+
+    def _list_contents(self):
+        """ Parse non-empty list of scalars of consistent type """
+        if self.type not in self.list_types:
+            self._error()
+        return self._scalar_list(self.list_types[self.type])
+
+    def _scalar_list(self, tok_types):
+        out = []
+        while True:
+            if self.type not in tok_types:
+                self._error()
+            out.append(self.tok.value)
+            self._advance()
+            if self.type not in tok_types:
+                return out
+
+    def string_list(self):
+        return self._scalar_list(('MULTI_STRING',))
+
+    def integer_list(self):
+        return self._scalar_list(('INTEGER',))
+
+    def float_list(self):
+        return self._scalar_list(('FLOAT',))
+
+    def bool_list(self):
+        return self._scalar_list(('TRUE', 'FALSE'))
+
+    @_spanned
+    def param_card_layout(self):
+        name = self._expect('PARAMCARDLAYOUT')
+        self._expect('{')
+        out = dict(type='param_card_layout',
+                   name=name,
+                   repr=self.repr(),
+                   controls=self.controls(),
+                   lines=self.lines())
+        self._expect('}')
+        return out
+
+    @_spanned
+    def eva_card_layout(self):
+        name = self._expect('EVACARDLAYOUT')
+        self._expect('{')
+        out = dict(type='eva_card_layout',
+                   name=name,
+                   repr=self._expect('MULTI_STRING'),
+                   n_controls=self._expect('INTEGER'),
+                   controls=self.eva_controls(),
+                   lines=self.lines())
+        self._expect('}')
+        return out
+
+    def controls(self):
+        return self._repeat(self.control, ('CONTROL',))
+
+    def eva_controls(self):
+        return self._repeat(self.eva_control, ('MULTI_STRING',))
+
+    def lines(self):
+        return self._repeat(self.line, ('LINE',))
+
+    @_spanned
+    def control(self):
+        self._expect('CONTROL')
+        self._expect('{')
+        out = dict(param=self.param(),
+                   pos=self.pos(),
+                   repr=self.repr() if self.type == 'REPR' else None)
+        self._expect('}')
+        return out
+
+    @_spanned
+    def eva_control(self):
+        return dict(param=self._expect('MULTI_STRING'),
+                    pos=[self._expect('INTEGER'), self._expect('INTEGER')],
+                    repr=self._expect('MULTI_STRING'))
+
+    def eva_string_table(self):
+        key = self._expect('EVASTRINGTABLE')
+        self._expect('{')
+        n = self._expect('INTEGER')
+        int_strings = self.int_strings()
+        self._expect('}')
+        return (key, (n, int_strings))
+
+    def int_strings(self):
+        return self._repeat(self.int_string, ('INTEGER',))
+
+    def int_string(self):
+        return (self._expect('INTEGER'), self._expect('MULTI_STRING'))
+
+    def _tagged_string(self, tok_type):
+        self._expect(tok_type)
+        return self._expect('MULTI_STRING')
+
+    def class_(self):
+        return self._tagged_string('CLASS')
+
+    def context(self):
+        return self._tagged_string('CONTEXT')
+
+    def dll(self):
+        return self._tagged_string('DLL')
+
+    def param(self):
+        return self._tagged_string('PARAM')
+
+    def repr(self):
+        return self._tagged_string('REPR')
+
+    def pos(self):
+        self._expect('POS')
+        return [self._expect('INTEGER'), self._expect('INTEGER')]
+
+    def line(self):
+        self._expect('LINE')
+        self._expect('{')
+        out = [self._expect('INTEGER') for i in range(4)]
+        self._expect('}')
+        return out
 
 
 DBL_QUOTE_RE = re.compile(r'(?<!")""(?!")')
@@ -581,9 +1818,458 @@ ASCCONV_RE = re.compile(
 
 def split_ascconv(in_str):
     """ Split input string into xprotocol and ASCCONV
+
+    Only finds the first ASCCONV section.  See :func:`iter_ascconv` to find
+    and parse all sections.
     """
     return ASCCONV_RE.match(in_str).groups()
 
 
+ASCCONV_MARKER_RE = re.compile(
+    r'### ASCCONV (?P<marker>BEGIN|END)\b[^\n]*?###')
+
+ASCCONV_LINE_RE = re.compile(
+    r'^[ \t]*(?P<key>[^\s=#][^\s=]*)[ \t]*=[ \t]*'
+    r'(?P<value>"[^\n]*"|[^\s#"]+)[ \t]*(?:#[^\n]*)?$',
+    flags=re.M)
+
+
+def ascconv_value(value_str):
+    """ Convert ASCCONV value string `value_str` to Python value
+
+    Parameters
+    ----------
+    value_str : str
+        Value from right hand side of an ASCCONV assignment.  Strings are in
+        double quotes.  Strings from ASCCONV sections in still-escaped
+        XProtocol strings have all quotes doubled, and we undo this escaping.
+
+    Returns
+    -------
+    value : int or float or str
+        Hexadecimal and decimal integers are ints, other numbers are floats.
+        Anything else that is not a quoted string is returned unchanged.
+    """
+    if value_str.startswith('"'):
+        n_quotes = len(value_str) - len(value_str.lstrip('"'))
+        if n_quotes * 2 >= len(value_str):  # Empty string
+            return ''
+        return value_str[n_quotes:-n_quotes].replace('"' * n_quotes, '"')
+    if value_str.startswith(('0x', '0X')):
+        return int(value_str, 16)
+    try:
+        return int(value_str)
+    except ValueError:
+        pass
+    try:
+        return float(value_str)
+    except ValueError:
+        return value_str
+
+
+def parse_ascconv(in_str, start=0, end=None):
+    """ Parse ASCCONV assignments in ``in_str[start:end]``
+
+    Parameters
+    ----------
+    in_str : str
+        String containing ASCCONV assignment lines of form ``key = value``.
+    start : int, optional
+        Offset in `in_str` to start parsing.  Should be at the start of a
+        line.
+    end : None or int, optional
+        Offset in `in_str` to stop parsing.  None means end of `in_str`.
+
+    Returns
+    -------
+    assignments : list
+        List of ``(key, value)`` tuples, in input order, with values
+        converted with :func:`ascconv_value`.  Lines that are not
+        assignments are ignored.
+    """
+    end = len(in_str) if end is None else end
+    return [(m.group('key'), ascconv_value(m.group('value')))
+            for m in ASCCONV_LINE_RE.finditer(in_str, start, end)]
+
+
+def iter_ascconv(in_str):
+    """ Generate all ASCCONV sections in `in_str` in one pass
+
+    Finds ASCCONV sections anywhere in the text, including sections in
+    still-escaped strings inside XProtocol text, such as the ``Protocol0``
+    strings of a multi-step protocol.  Unlike :func:`split_ascconv`, you do
+    not need to :func:`strip_twin_quote` the input first.
+
+    Parameters
+    ----------
+    in_str : str
+        Text to search for sections.
+
+    Yields
+    ------
+    section : dict
+        Dict with keys 'type' ('ascconv'); 'span', a :class:`SourceSpan` from
+        the start of the BEGIN marker to the end of the END marker; 'content',
+        a :class:`SourceSpan` for the text between the marker lines;
+        'escaped', True if the section is inside a double quoted string; and
+        'value', the list of ``(key, value)`` assignments from
+        :func:`parse_ascconv`.
+    """
+    begin = None
+    # Number of double quotes before `pos`, to detect sections in strings
+    n_quotes = 0
+    pos = 0
+    for match in ASCCONV_MARKER_RE.finditer(in_str):
+        n_quotes += in_str.count('"', pos, match.start())
+        pos = match.start()
+        if match.group('marker') == 'BEGIN':
+            begin = match
+            continue
+        if begin is None:  # END without BEGIN
+            continue
+        content_start = in_str.find('\n', begin.end(), pos) + 1
+        if content_start == 0:  # END on same line as BEGIN
+            content_start = pos
+        # END marker line starts at line start
+        content_end = in_str.rfind('\n', content_start, pos) + 1
+        if content_end == 0:
+            content_end = content_start
+        yield dict(type='ascconv',
+                   span=SourceSpan(in_str, begin.start(), match.end()),
+                   content=SourceSpan(in_str, content_start, content_end),
+                   escaped=n_quotes % 2 == 1,
+                   value=parse_ascconv(in_str, content_start, content_end))
+        begin = None
+
+
+ASCCONV_INDEX_RE = re.compile(r'\[(\d+)\]')
+
+# Siemens names for floating point values and arrays start with d or fl
+ASCCONV_FLOAT_NAME_RE = re.compile(r'(?:^|\.)a?(?:d|fl)[A-Z][^.]*$')
+
+
+def _ascconv_column(values, name, raw):
+    """ Convert ASCCONV values for entries called `name` to array in one go
+
+    If `raw` is True, `values` are value strings from the ASCCONV text,
+    otherwise they are values already converted to Python types.
+    """
+    if not raw:
+        column = np.array(values)
+    else:
+        column = np.array(values)
+        for dtype in (np.int64, np.float64):
+            try:
+                column = column.astype(dtype)
+                break
+            except ValueError:
+                pass
+        else:  # Hex integers, strings
+            column = np.array([ascconv_value(v) for v in values])
+    if column.dtype.kind in 'iu' and ASCCONV_FLOAT_NAME_RE.search(name):
+        # Floating point values written as integers
+        column = column.astype(np.float64)
+    return column
+
+
+def ascconv_arrays(ascconv):
+    """ Gather indexed ASCCONV entries into NumPy arrays
+
+    ASCCONV has families of entries like::
+
+        asCoilSelectMeas[0].aFFT_SCALE[0].flFactor = 3.77259
+        asCoilSelectMeas[0].aFFT_SCALE[0].bValid = 1
+        asCoilSelectMeas[0].aFFT_SCALE[1].flFactor = 3.83164
+
+    We group these by their key pattern with indices removed - here
+    ``asCoilSelectMeas[].aFFT_SCALE[]`` - and return a structured array for
+    each pattern, with one field per leaf name after the last index
+    (``flFactor``, ``bValid``).  Families with no leaf name, such as
+    ``sRXSPEC.alDwellTime[0]``, give plain arrays.  The array shape is one
+    more than the largest observed value for each index.
+
+    ASCCONV leaves out entries with default values, so entries not in the
+    input are zero, or empty strings.  Fields have integer, float or string
+    dtype depending on their values, except that entries named as floating
+    point in the Siemens convention (``dThickness``, ``aflAmplitude``) are
+    always float.
+
+    Parameters
+    ----------
+    ascconv : str or sequence
+        ASCCONV text, as from :func:`split_ascconv`, or a sequence of
+        ``(key, value)`` pairs, as from :func:`parse_ascconv`.
+
+    Returns
+    -------
+    arrays : dict
+        Dict with key patterns as keys and arrays as values.
+    """
+    if np is None:
+        raise ImportError('ascconv_arrays needs numpy')
+    raw = isinstance(ascconv, str)
+    if raw:
+        ascconv = [(m.group('key'), m.group('value'))
+                   for m in ASCCONV_LINE_RE.finditer(ascconv)]
+    # Map pattern to (dict of leaf name: (indices, values)) for indexed keys
+    families = {}
+    for key, value in ascconv:
+        last = key.rfind(']')
+        if last == -1:
+            continue
+        prefix = key[:last + 1]
+        pattern = ASCCONV_INDEX_RE.sub('[]', prefix)
+        leaves = families.setdefault(pattern, {})
+        leaf = key[last + 1:].lstrip('.')
+        indices, values = leaves.setdefault(leaf, ([], []))
+        indices.append(ASCCONV_INDEX_RE.findall(prefix))
+        values.append(value)
+    arrays = {}
+    for pattern, leaves in families.items():
+        columns = {}
+        all_indices = []
+        for leaf, (indices, values) in leaves.items():
+            indices = np.array(indices, dtype=np.intp)
+            name = leaf if leaf else pattern[:-2]
+            columns[leaf] = (tuple(indices.T),
+                             _ascconv_column(values, name, raw))
+            all_indices.append(indices)
+        shape = tuple(np.concatenate(all_indices).max(axis=0) + 1)
+        if list(columns) == ['']:
+            where, column = columns['']
+            arr = np.zeros(shape, dtype=column.dtype)
+            arr[where] = column
+        else:
+            arr = np.zeros(shape, dtype=[(leaf, column.dtype)
+                                         for leaf, (where, column)
+                                         in columns.items()])
+            for leaf, (where, column) in columns.items():
+                arr[leaf][where] = column
+        arrays[pattern] = arr
+    return arrays
+
+
+def split_segments(in_str, segment_size=2 ** 20):
+    """ Return (start, end) pairs cutting `in_str` into lexable segments
+
+    We cut just after a newline outside strings, so each segment starts at
+    the start of a line and at the start of a token.  An odd number of double
+    quotes before a position means the position is in a string; doubled
+    quotes in strings count twice, so do not change this.
+
+    Parameters
+    ----------
+    in_str : str
+        XProtocol text.
+    segment_size : int, optional
+        Approximate number of characters in each segment.  Segments can be
+        longer, for long strings or lines.
+
+    Returns
+    -------
+    segments : list
+        List of ``(start, end)`` pairs, covering all of `in_str` in order.
+    """
+    segments = []
+    start = 0
+    n_quotes = 0
+    counted = 0
+    n = len(in_str)
+    while start < n:
+        pos = start + segment_size
+        while pos < n:
+            pos = in_str.find('\n', pos)
+            if pos == -1:
+                pos = n
+                break
+            n_quotes += in_str.count('"', counted, pos)
+            counted = pos
+            pos += 1
+            if not n_quotes % 2:
+                break
+        end = min(pos, n)
+        segments.append((start, end))
+        start = end
+    return segments
+
+
+def _lex_segment(options, text, lineno, offset):
+    """ Lex segment `text` of a larger input, for parallel lexing
+
+    Module level function, so we can send it to a process pool.  `options`
+    is a tuple of items for :func:`get_symbols`.  `lineno` and `offset` give
+    the line number and position of `text` in the whole input.
+
+    Returns list of ``(type, value, lineno, lexpos, endlexpos)`` tuples, and
+    None, or ``(message, lineno)`` for a lexing error after the tokens.  The
+    value is None for strings that will be lazy scalars.  In 'forgiving'
+    mode, tuples with type None record skips over illegal characters, in
+    order with the tokens.
+    """
+    symbols = get_symbols(**dict(options))
+    lexer = symbols.lexer.clone()
+    lexer.lineno = lineno
+    lexer.input(text)
+    lexer.skipped = skipped = []
+    tokens = []
+    append = tokens.append
+    try:
+        while True:
+            tok = lexer.token()
+            # Skips come before the token that follows them
+            for _, _, skip_lineno, start, end in skipped:
+                append((None, None, skip_lineno, start + offset,
+                        end + offset))
+            del skipped[:]
+            if tok is None:
+                break
+            value = tok.value
+            if isinstance(value, LazyScalar):
+                value = None
+            append((tok.type, value, tok.lineno, tok.lexpos + offset,
+                    lexer.lexpos + offset))
+    except SyntaxError as e:
+        return tokens, (e.msg, e.lineno)
+    return tokens, None
+
+
+# Characters that change the nesting of XProtocol text outside strings
+DOC_SCAN_RE = re.compile(r'["{}]')
+
+
+def split_documents(source, chunk_size=2 ** 16):
+    """ Generate text of each top-level document in `source`
+
+    Scans for the closing brace of each top-level ``<XProtocol> { ... }``,
+    skipping braces in strings.  Doubled double quotes inside strings close
+    and reopen the string, so need no special handling.  This is a scan of
+    the nesting only; the parser checks the documents.
+
+    Parameters
+    ----------
+    source : str or file-like
+        XProtocol text, or text file object to read it from.
+    chunk_size : int, optional
+        Number of characters to read from a file object at a time.
+
+    Yields
+    ------
+    text : str
+        Text of one document, including whitespace before it.  Any text
+        after the last closing brace, other than whitespace, comes as a last
+        document, so the parser can report it.
+    lineno : int
+        Line number in `source` of the start of `text`.
+    """
+    if isinstance(source, str):
+        chunks = iter([source])
+    else:
+        chunks = iter(lambda: source.read(chunk_size), '')
+    splitter = DocumentSplitter()
+    for chunk in chunks:
+        for document in splitter.feed(chunk):
+            yield document
+    for document in splitter.close():
+        yield document
+
+
+class DocumentSplitter(object):
+    """ Split XProtocol text, given in pieces, into top-level documents
+
+    Feed the text in pieces of any size with :meth:`feed`, then call
+    :meth:`close`.  See :func:`split_documents` for the documents.  We keep
+    the pieces of the unfinished document in a list, and join them once
+    when the document closes, so the time is linear in the input size,
+    however long the documents.
+    """
+
+    def __init__(self):
+        # Text of unfinished document from earlier pieces
+        self._parts = []
+        self._depth = 0
+        self._in_string = False
+        self.lineno = 1
+
+    def feed(self, chunk):
+        """ Return list of (text, lineno) of documents finished in `chunk`
+        """
+        documents = []
+        parts = self._parts
+        depth = self._depth
+        in_string = self._in_string
+        start = pos = 0
+        while True:
+            if in_string:
+                pos = chunk.find('"', pos) + 1
+                if pos == 0:
+                    break
+                in_string = False
+                continue
+            match = DOC_SCAN_RE.search(chunk, pos)
+            if match is None:
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                in_string = True
+            elif char == '{':
+                depth += 1
+            elif depth:
+                depth -= 1
+                if depth == 0:
+                    parts.append(chunk[start:pos])
+                    text = ''.join(parts)
+                    del parts[:]
+                    documents.append((text, self.lineno))
+                    self.lineno += text.count('\n')
+                    start = pos
+        if start < len(chunk):
+            parts.append(chunk[start:])
+        self._depth = depth
+        self._in_string = in_string
+        return documents
+
+    def close(self):
+        """ Return list of (text, lineno) for text after the last document
+
+        The list is empty if that text is only whitespace.  Otherwise the
+        parser can report the text as an error.
+        """
+        text = ''.join(self._parts)
+        del self._parts[:]
+        return [(text, self.lineno)] if text.strip() else []
+
+
 XPROTOCOL_SYMBOLS = XProtocolSymbols()
 parse = XPROTOCOL_SYMBOLS.parse
+iterparse = XPROTOCOL_SYMBOLS.iterparse
+
+_SYMBOLS_CACHE = {(): XPROTOCOL_SYMBOLS}
+
+
+def get_symbols(**options):
+    """ Return shared ``XProtocolSymbols`` made with keyword `options`
+
+    Making the symbols builds the lexer and parser tables, so long-running
+    code should make them once for each set of options.  The instances are
+    safe to share between threads.
+    """
+    key = tuple(sorted(options.items()))
+    try:
+        return _SYMBOLS_CACHE[key]
+    except KeyError:
+        pass
+    # Parallel builds are harmless; the first one stored wins
+    return _SYMBOLS_CACHE.setdefault(key, XProtocolSymbols(**options))
+
+
+def error_record(exc):
+    """ Return JSON-ready dict describing parse error `exc`
+
+    The dict has keys "type" (exception class name), "message" and "lineno"
+    (None if `exc` has no line number).  Command line, server, batch and
+    watcher outputs all report errors in this form.
+    """
+    return dict(type=type(exc).__name__,
+                message=str(exc),
+                lineno=getattr(exc, 'lineno', None))
@@ -0,0 +1,369 @@
+""" Path queries over XProtocol parse trees
+
+Queries look like XPath over the parameter dicts of a parse tree::
+
+    //ParamLong[name="Count"]/value
+    /XProtocol/ParamMap/*[@Label="Step"]
+    //ParamArray[@Default]/@Default/value
+
+A query is a sequence of steps, separated by ``/`` for children or ``//``
+for descendants.  A step is one of:
+
+* a node type, as the XProtocol tag name (``ParamLong``, ``ParamMap``,
+  ``XProtocol``, ``Dependency``, ...) selecting parameter dicts of that type;
+* ``*``, selecting parameter dicts of any type;
+* a lower case field name (``value``, ``name``, ``class``, ``args``, ...),
+  selecting that key of dicts;
+* ``@`` and an attribute name (``@Default``, ``@LimitRange``), selecting the
+  value of that attribute of parameters.
+
+The children of a dict are the parameter dicts directly inside it: the
+blocks of a map or protocol, the cards and dependencies of a protocol, and
+parameters in attributes such as ``<Default>``.
+
+Steps take any number of predicates in square brackets: ``[field]`` or
+``[@attr]`` to require a field or attribute, and ``[field=literal]``,
+``[@attr=literal]`` or ``!=`` to compare it with a literal.  As in XPath,
+comparisons are false for missing fields and attributes.  Literals are
+double quoted strings, integers, floats (with a decimal point or exponent),
+``true``, ``false`` or ``none``.  Comparisons keep ints, floats and bools
+distinct, as the parser does.
+
+Compile a query once with :func:`compile_query`, and run it on many trees.
+Queries starting with a descendant step with a ``name=`` predicate can use a
+:class:`NameIndex` of the tree to skip the search.
+"""
+from __future__ import print_function, absolute_import
+
+import functools
+import re
+
+import xpparse as xpp
+
+# XProtocol tag names for ``type`` values of parse dicts
+NODE_TYPES = {'XProtocol': 'xprotocol',
+              'ParamBool': 'param_bool',
+              'ParamLong': 'param_long',
+              'ParamDouble': 'param_double',
+              'ParamString': 'param_string',
+              'ParamArray': 'param_array',
+              'ParamMap': 'param_map',
+              'ParamChoice': 'param_choice',
+              'ParamFunctor': 'param_functor',
+              'ParamCardLayout': 'param_card_layout',
+              'EVACardLayout': 'eva_card_layout',
+              'PipeService': 'pipe_service',
+              'Connection': 'connection',
+              'Dependency': 'dependency',
+              'Event': 'event',
+              'Method': 'method'}
+
+QUERY_TOKEN_RE = re.compile(r'''
+    \s*(?:
+    (?P<axis>//?)
+    | (?P<name>@?[A-Za-z_][\w]*|\*)
+    | (?P<open>\[)
+    | (?P<close>\])
+    | (?P<op>!?=)
+    | (?P<string>"(?:[^"\\]|\\.)*")
+    | (?P<number>[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    )''', re.VERBOSE)
+
+MISSING = object()
+
+
+class QueryError(ValueError):
+    """ Error in the text of a query """
+
+
+def _children(obj):
+    """ Return list of parameter dicts directly inside `obj` """
+    found = []
+    _collect(obj, found, False)
+    return found
+
+
+def _descendants(obj):
+    """ Return list of parameter dicts inside `obj`, at any depth, in order
+    """
+    found = []
+    _collect(obj, found, True)
+    return found
+
+
+def _collect(obj, found, deep):
+    """ Append parameter dicts inside `obj` to list `found`
+
+    Go inside the dicts we find if `deep` is True.  Spans and other values
+    that are not dicts, lists or tuples do not contain parameters.
+    """
+    for value in (obj.values() if isinstance(obj, dict) else obj):
+        if isinstance(value, dict):
+            found.append(value)
+            if deep:
+                _collect(value, found, True)
+        elif isinstance(value, (list, tuple)):
+            _collect(value, found, deep)
+
+
+def _plain(value):
+    """ Return `value` without lazy decoding or span types """
+    if isinstance(value, xpp.LazyScalar):
+        return value.value
+    return value
+
+
+def _same(first, second):
+    """ True if scalar `first` equals `second`, keeping bools distinct """
+    first = _plain(first)
+    return (first == second and
+            isinstance(first, bool) == isinstance(second, bool) and
+            isinstance(first, float) == isinstance(second, float))
+
+
+def _attr(node, key):
+    """ Value of attribute `key` of dict `node`, or MISSING """
+    for attr_key, value in node.get('attrs', ()):
+        if attr_key == key:
+            return value
+    return MISSING
+
+
+def _field(node, key):
+    return node.get(key, MISSING)
+
+
+class _Step(object):
+    """ One step of a query """
+
+    def __init__(self, descendant, name, predicates):
+        self.descendant = descendant
+        self.name = name
+        self.predicates = predicates
+        if name == '*':
+            self.kind, self.node_type = 'node', None
+        elif name.startswith('@'):
+            self.kind, self.key = 'attr', name[1:]
+        elif name[0].isupper():
+            if name not in NODE_TYPES:
+                raise QueryError('Unknown node type "{0}"'.format(name))
+            self.kind, self.node_type = 'node', NODE_TYPES[name]
+        else:
+            self.kind, self.key = 'field', name
+        # Name to look up in an index, for a name= predicate
+        self.index_name = None
+        for getter, key, op, literal in predicates:
+            if getter is _field and key == 'name' and op == '=':
+                self.index_name = literal
+
+    def matches(self, node):
+        """ True if parameter dict `node` passes node test and predicates """
+        if (self.node_type is not None and
+                node.get('type') != self.node_type):
+            return False
+        return not self.predicates or self._check(node)
+
+    def _check(self, node):
+        for getter, key, op, literal in self.predicates:
+            value = getter(node, key)
+            if value is MISSING:
+                return False
+            if op is not None and _same(value, literal) != (op == '='):
+                return False
+        return True
+
+    def apply(self, contexts):
+        """ Return results of this step from list of `contexts` """
+        if self.kind == 'node':
+            walk = _descendants if self.descendant else _children
+            found = [node for context in contexts for node in walk(context)]
+            if self.descendant and len(contexts) > 1:
+                # Nested contexts may repeat nodes
+                found = _unique(found)
+            matches = self.matches
+            return [node for node in found if matches(node)]
+        if self.descendant:
+            sources = _unique(node for context in contexts
+                              for node in _descendants(context))
+        else:
+            sources = (c for c in contexts if isinstance(c, dict))
+        getter = _attr if self.kind == 'attr' else _field
+        results = []
+        for node in sources:
+            value = getter(node, self.key)
+            if value is MISSING:
+                continue
+            if self.predicates and not (isinstance(value, dict) and
+                                        self._check(value)):
+                continue
+            results.append(value)
+        return results
+
+
+def _unique(nodes):
+    seen = set()
+    for node in nodes:
+        if id(node) not in seen:
+            seen.add(id(node))
+            yield node
+
+
+def _parse_literal(match):
+    kind = match.lastgroup
+    text = match.group(kind)
+    if kind == 'string':
+        return re.sub(r'\\(.)', r'\1', text[1:-1])
+    if kind == 'number':
+        return (float(text) if any(c in text for c in '.eE')
+                else int(text))
+    if kind == 'name' and text in ('true', 'false', 'none'):
+        return {'true': True, 'false': False, 'none': None}[text]
+    raise QueryError('Expecting literal at "{0}"'.format(text))
+
+
+def _tokenize(query):
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = QUERY_TOKEN_RE.match(query, pos)
+        if match is None or match.end() == pos:
+            raise QueryError('Unexpected text "{0}" in query'
+                             .format(query[pos:]))
+        yield match
+        pos = match.end()
+
+
+class Query(object):
+    """ Compiled query; see module docstring for the syntax
+
+    Parameters
+    ----------
+    query : str
+        Query text.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.steps = self._parse(query)
+
+    def __repr__(self):
+        return 'Query({0!r})'.format(self.query)
+
+    def _parse(self, query):
+        tokens = list(_tokenize(query))
+        steps = []
+        i = 0
+        while i < len(tokens):
+            descendant = False
+            if tokens[i].lastgroup == 'axis':
+                descendant = tokens[i].group('axis') == '//'
+                i += 1
+            elif steps:
+                raise QueryError('Expecting / between steps')
+            if i == len(tokens) or tokens[i].lastgroup != 'name':
+                raise QueryError('Expecting step in query "{0}"'
+                                 .format(query))
+            name = tokens[i].group('name')
+            i += 1
+            predicates = []
+            while i < len(tokens) and tokens[i].lastgroup == 'open':
+                predicate, i = self._parse_predicate(tokens, i + 1)
+                predicates.append(predicate)
+            steps.append(_Step(descendant, name, predicates))
+        if not steps:
+            raise QueryError('Empty query')
+        return steps
+
+    def _parse_predicate(self, tokens, i):
+        try:
+            if tokens[i].lastgroup != 'name' or tokens[i].group() == '*':
+                raise QueryError('Expecting name in predicate')
+            key = tokens[i].group('name')
+            getter = _attr if key.startswith('@') else _field
+            key = key.lstrip('@')
+            op = literal = None
+            i += 1
+            if tokens[i].lastgroup == 'op':
+                op = tokens[i].group('op')
+                literal = _parse_literal(tokens[i + 1])
+                i += 2
+            if tokens[i].lastgroup != 'close':
+                raise QueryError('Expecting ]')
+        except IndexError:
+            raise QueryError('Unterminated predicate')
+        return (getter, key, op, literal), i + 1
+
+    def find_all(self, tree):
+        """ Return list of all results of query in `tree`
+
+        Parameters
+        ----------
+        tree : object or NameIndex
+            Parse tree, such as output from ``XProtocolSymbols.parse``, or a
+            :class:`NameIndex` for a parse tree.
+
+        Returns
+        -------
+        results : list
+            Results in tree order.
+        """
+        steps = self.steps
+        if isinstance(tree, NameIndex):
+            first = steps[0]
+            if (first.descendant and first.kind == 'node' and
+                    first.index_name is not None):
+                contexts = [node for node in tree.get(first.index_name)
+                            if first.matches(node)]
+                steps = steps[1:]
+            else:
+                contexts = [tree.tree]
+        else:
+            contexts = [tree]
+        for step in steps:
+            contexts = step.apply(contexts)
+            if not contexts:
+                break
+        return contexts
+
+    def find_first(self, tree, default=None):
+        """ Return first result of query in `tree`, or `default` """
+        results = self.find_all(tree)
+        return results[0] if results else default
+
+    __call__ = find_all
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(query):
+    """ Return compiled :class:`Query` for `query` text
+
+    Repeated compiles of the same text return the same query.
+    """
+    return Query(query)
+
+
+def find_all(tree, query):
+    """ Return all results of `query` text in parse tree `tree` """
+    return compile_query(query).find_all(tree)
+
+
+class NameIndex(object):
+    """ Parameter dicts of a parse tree by name
+
+    Parameters
+    ----------
+    tree : object
+        Parse tree, such as output from ``XProtocolSymbols.parse``.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.by_name = {}
+        for node in _descendants(tree):
+            name = node.get('name')
+            if name is not None:
+                self.by_name.setdefault(_plain(name), []).append(node)
+
+    def get(self, name):
+        """ Return list of parameter dicts called `name`, in tree order """
+        return self.by_name.get(name, [])
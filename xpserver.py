@@ -0,0 +1,215 @@
+""" Parse server on a Unix domain socket, and its client
+
+Scripts that parse one or two files spend most of their time importing
+``ply`` and building the parser tables.  The server keeps a pool of worker
+processes with warm parsers, so a request only costs the parse itself.
+
+Run the server with::
+
+    python xpserver.py /tmp/xpparse.sock --workers 4 --root /data
+
+and parse from other processes with ``xpclient.XProtocolClient``.
+
+Messages on the socket are frames: a 4-byte big-endian length, then that
+many bytes.  A request is a frame with a UTF-8 JSON header, such as
+``{"path": "/data/prot.txt"}`` or ``{"text": true}``, followed for text
+requests by a frame with the UTF-8 text.  The header can also give
+``"options"``, keyword arguments for ``XProtocolSymbols``, from those in
+``SERVER_OPTIONS``.  A response is a single frame: ``b'O'`` and the parse
+tree in the ``xpbinary`` format, or ``b'E'`` and a UTF-8 JSON error with
+keys "type", "message" and "lineno".  A connection can carry any number of
+requests.
+
+Only the server user can connect to the socket.  The server only reads
+files for ``"path"`` requests below the directories given with ``--root``;
+without any, it refuses ``"path"`` requests.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import errno
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+
+import xpparse as xpp
+import xpbinary as xpb
+from xpclient import send_frame, recv_frame
+
+
+# Options clients may give, with their allowed values.  Each distinct set of
+# options builds and keeps a parser in each worker, so we do not take any.
+SERVER_OPTIONS = {'error_mode': ('strict', 'forgiving'),
+                  'engine': ('lalr', 'rd'),
+                  'spans': (False, True),
+                  'lazy_strings': (False, True)}
+
+
+def check_options(options):
+    """ Raise ValueError unless `options` are allowed in ``SERVER_OPTIONS``
+    """
+    if not isinstance(options, dict):
+        raise ValueError('Options should be an object')
+    for key, value in options.items():
+        allowed = SERVER_OPTIONS.get(key, ())
+        # Check type too; 1 == True
+        if not any(type(value) is type(v) and value == v for v in allowed):
+            raise ValueError('Option {0}={1!r} not allowed'.format(key,
+                                                                   value))
+
+
+def _warm_up():
+    # Build default parser tables in new worker process
+    xpp.get_symbols()
+
+
+def parse_request(options, path=None, text=None):
+    """ Parse file at `path` or `text`; return response frame bytes
+
+    Runs in the worker processes.  Serializing in the worker means we only
+    send the compact binary result between processes.
+    """
+    try:
+        if path is not None:
+            with open(path, 'rt') as fobj:
+                text = fobj.read()
+        tree = xpp.get_symbols(**options).parse(text)
+        return b'O' + xpb.dumps(tree)
+    except Exception as e:
+        return b'E' + json.dumps(xpp.error_record(e)).encode('utf-8')
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            frame = recv_frame(self.request)
+            if frame is None:
+                return
+            header = json.loads(frame.decode('utf-8'))
+            text = None
+            if header.get('text'):
+                text = recv_frame(self.request).decode('utf-8')
+            options = header.get('options', {})
+            path = header.get('path')
+            try:
+                check_options(options)
+                if path is not None:
+                    path = self.server.check_path(path)
+            except (ValueError, OSError) as e:
+                send_frame(self.request, b'E' + json.dumps(
+                    xpp.error_record(e)).encode('utf-8'))
+                continue
+            future = self.server.executor.submit(parse_request, options,
+                                                 path, text)
+            send_frame(self.request, future.result())
+
+
+class XProtocolServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """ Server parsing requests from a Unix domain socket
+
+    Parameters
+    ----------
+    socket_path : str
+        Filename for the socket.  We remove a stale socket file, but raise
+        OSError if a server is listening on it, or it is not a socket.
+    workers : None or int, optional
+        Number of worker processes.  None means one per CPU.
+    roots : sequence, optional
+        Directories holding files clients may ask us to parse by path.
+        Empty means we refuse requests by path.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=None, roots=()):
+        _remove_stale_socket(socket_path)
+        self.socket_path = socket_path
+        self.roots = [os.path.realpath(root) for root in roots]
+        workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(workers, initializer=_warm_up)
+        # Start the workers now, not at the first request
+        for future in [self.executor.submit(_warm_up)
+                       for i in range(workers)]:
+            future.result()
+        socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # Only the server user may connect
+        os.chmod(self.socket_path, 0o600)
+
+    def check_path(self, path):
+        """ Return real path for `path`; raise PermissionError if not allowed
+        """
+        real_path = os.path.realpath(path)
+        for root in self.roots:
+            if os.path.commonpath([root, real_path]) == root:
+                return real_path
+        raise PermissionError('Parsing {0} by path not allowed'.format(path))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.executor.shutdown()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def _remove_stale_socket(socket_path):
+    """ Remove socket file at `socket_path` if no server is listening """
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST,
+                      '{0} exists and is not a socket'.format(socket_path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except ConnectionRefusedError:
+        os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise OSError(errno.EADDRINUSE,
+                  'Server already listening on {0}'.format(socket_path))
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    """ Run parse server until interrupted """
+    parser = argparse.ArgumentParser(
+        prog='xpserver', description='Serve XProtocol parses on a socket')
+    parser.add_argument('socket_path', help='filename for Unix socket')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes '
+                        '(default one per CPU)')
+    parser.add_argument('--root', action='append', default=[],
+                        help='directory of files clients may parse by path; '
+                        'give more than once for more directories')
+    args = parser.parse_args(argv)
+    server = XProtocolServer(args.socket_path, args.workers, args.root)
+    # Clean up the socket on kill, as for Ctrl-C
+    signal.signal(signal.SIGTERM, _terminate)
+    print('Serving on {0}'.format(args.socket_path), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
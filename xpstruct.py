@@ -0,0 +1,267 @@
+""" Structural index of XProtocol text with NumPy, before any parsing
+
+A first pass over the raw bytes, in the style of simdjson's stage 1.  We
+classify every byte at once with NumPy, and work out:
+
+* the string regions, from the parity of the running count of double
+  quotes.  A doubled double quote inside a string closes the string and
+  opens it again straight away, so needs no special handling;
+* the braces and tag starts (``<``) outside strings;
+* the nesting depth at each brace, from the running sum of +1 for ``{`` and
+  -1 for ``}``;
+* the matching closing brace for each opening brace;
+* the tag, if any, that starts each braced block.
+
+The result, a :class:`StructuralIndex`, gives the byte offsets of every
+braced block in the document, without calling the lexer.  Use it to find
+top-level documents and blocks, to pull out named blocks to parse on their
+own, and to cut the document at safe boundaries for parallel work.
+
+Needs NumPy.  Offsets are into the bytes; for text input, we encode with
+UTF-8 first.
+"""
+from __future__ import print_function, absolute_import
+
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import xpparse as xpp
+
+QUOTE, OPEN, CLOSE, LT, GT = (ord(c) for c in '"{}<>')
+
+# Whitespace bytes, as for the lexer's \s
+WHITESPACE = b' \t\n\r\f\v'
+
+if np is not None:
+    # Lookup table, faster than ``np.isin`` on large inputs
+    IS_SPACE = np.zeros(256, dtype=bool)
+    IS_SPACE[list(WHITESPACE)] = True
+
+# Number of bytes to look back from a brace for the end of its tag
+LOOK_BACK = 32
+
+TAG_RE = re.compile(br'<([A-Za-z_]\w*)(?:\."([^"]*)")?>')
+
+# Parser start symbols for tagged elements other than parameter blocks
+START_SYMBOLS = {'XProtocol': 'xprotocol',
+                 'ParamCardLayout': 'param_card_layout',
+                 'EVACardLayout': 'eva_card_layout',
+                 'Dependency': 'dependency'}
+
+
+def parse_element(text, tag, symbols=None):
+    """ Parse `text` of one element with tag `tag`, such as a block
+
+    Parameters
+    ----------
+    text : str
+        Text of the element, from its tag to its closing brace.
+    tag : str
+        Tag of the element, such as "ParamLong" or "Dependency".
+    symbols : None or ``XProtocolSymbols``, optional
+        Symbols to parse with.  None gives the default symbols.
+
+    Returns
+    -------
+    element : dict or None
+        Parse dict for the element, or None after an error in 'forgiving'
+        mode.
+    """
+    symbols = xpp.get_symbols() if symbols is None else symbols
+    lexer = symbols.lexer.clone()
+    lexer.lineno = 1
+    lexer.input(text)
+    parser = xpp.RecursiveDescentParser(lexer,
+                                        symbols.p_error,
+                                        symbols.token_func(lexer),
+                                        symbols.spans)
+    return parser.parse(START_SYMBOLS.get(tag, 'block'))
+
+
+class StructuralIndex(object):
+    """ Byte offsets of the braced blocks of XProtocol text
+
+    Parameters
+    ----------
+    data : bytes-like or str
+        XProtocol text.  We encode str with UTF-8.  We keep a reference to
+        bytes-like input, such as a ``mmap``, without copying it.
+
+    Attributes
+    ----------
+    opens : ndarray
+        Offsets of opening braces outside strings, in order.
+    closes : ndarray
+        Offset of the matching closing brace for each of `opens`.
+    depths : ndarray
+        Nesting depth of each block; top-level blocks have depth 0.
+    tag_starts : ndarray
+        Offset of the ``<`` of the tag starting each block, or -1 for blocks
+        without a tag, such as the lists in ``{ { 1 } { 2 } }``.
+    starts : ndarray
+        Offset of the start of each block; the tag start if there is a tag,
+        otherwise the opening brace.
+    ends : ndarray
+        Offset one past the closing brace of each block.
+    """
+
+    def __init__(self, data):
+        if np is None:
+            raise ImportError('StructuralIndex needs numpy')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.data = data
+        arr = np.frombuffer(data, dtype=np.uint8)
+        quotes = arr == QUOTE
+        # Odd count of quotes so far means we are in a string.  The opening
+        # quote is in the string, the closing quote is not; this does not
+        # matter, because we only look at braces and tag characters.
+        # uint8 sums wrap at 256, but keep their parity
+        in_string = (np.cumsum(quotes, dtype=np.uint8) & 1).view(bool)
+        if len(in_string) and in_string[-1]:
+            raise ValueError('Unterminated string in input')
+        outside = ~in_string
+        opens = np.flatnonzero((arr == OPEN) & outside)
+        closes = np.flatnonzero((arr == CLOSE) & outside)
+        self._match_braces(opens, closes)
+        self.tag_starts = self._find_tags(arr, outside)
+        self.starts = np.where(self.tag_starts >= 0,
+                               self.tag_starts,
+                               self.opens)
+        self.ends = self.closes + 1
+
+    def _match_braces(self, opens, closes):
+        """ Set `opens`, `closes` and `depths` from brace offsets """
+        if len(opens) != len(closes):
+            raise ValueError('Unbalanced braces: {0} open, {1} close'
+                             .format(len(opens), len(closes)))
+        positions = np.concatenate([opens, closes])
+        steps = np.concatenate([np.ones(len(opens), np.intp),
+                                -np.ones(len(closes), np.intp)])
+        order = np.argsort(positions, kind='stable')
+        positions, steps = positions[order], steps[order]
+        after = np.cumsum(steps)
+        if len(after) and after.min() < 0:
+            raise ValueError('Closing brace without opening brace')
+        # Depth of the block each brace belongs to
+        levels = np.where(steps > 0, after - 1, after)
+        # Within each level, braces go open, close, open, close ...
+        order = np.argsort(levels, kind='stable')
+        paired = positions[order].reshape(-1, 2)
+        block_levels = levels[order][::2]
+        by_open = np.argsort(paired[:, 0])
+        self.opens = paired[by_open, 0]
+        self.closes = paired[by_open, 1]
+        self.depths = block_levels[by_open]
+
+    def _find_tags(self, arr, outside):
+        """ Return offset of tag start for each block, or -1 """
+        opens = self.opens
+        n = len(opens)
+        if not n:
+            return np.zeros(0, dtype=np.intp)
+        # Last non-whitespace byte before each opening brace.  This is
+        # nearly always a few bytes back, so look over a short window first.
+        back = opens[:, None] - np.arange(1, LOOK_BACK + 1)
+        valid = back >= 0
+        non_space = valid & ~IS_SPACE[arr[np.maximum(back, 0)]]
+        hit = non_space.any(axis=1)
+        prev = np.where(hit, back[np.arange(n), np.argmax(non_space, axis=1)],
+                        -1)
+        # Longer runs of whitespace; search back to the previous brace
+        for i in np.flatnonzero(~hit & valid[:, -1]):
+            start = opens[i - 1] if i else 0
+            found = np.flatnonzero(~IS_SPACE[arr[start:opens[i]]])
+            if len(found):
+                prev[i] = start + found[-1]
+        tagged = (prev >= 0) & (arr[np.maximum(prev, 0)] == GT)
+        lts = np.flatnonzero((arr == LT) & outside)
+        tag_index = np.searchsorted(lts, prev) - 1
+        tagged &= tag_index >= 0
+        return np.where(tagged, lts[np.maximum(tag_index, 0)], -1)
+
+    def __len__(self):
+        return len(self.opens)
+
+    def tag(self, i):
+        """ Return (tag, name) for block `i`; name and tag can be None
+
+        Tag and name are str.  Name is None for tags without a name, and
+        both are None for blocks without a tag.
+        """
+        start = self.tag_starts[i]
+        if start < 0:
+            return None, None
+        match = TAG_RE.match(self.data, int(start))
+        if match is None:
+            return None, None
+        tag, name = match.groups()
+        return (tag.decode('ascii'),
+                None if name is None else name.decode('utf-8'))
+
+    def text(self, i):
+        """ Return bytes of block `i`, from tag start to closing brace """
+        return bytes(self.data[self.starts[i]:self.ends[i]])
+
+    def parse(self, i, symbols=None, encoding='utf-8'):
+        """ Parse and return dict for tagged block `i`
+
+        See :func:`parse_element` for `symbols`.
+        """
+        tag, name = self.tag(i)
+        if tag is None:
+            raise ValueError('Block {0} has no tag'.format(i))
+        return parse_element(self.text(i).decode(encoding), tag, symbols)
+
+    def blocks_at(self, depth):
+        """ Return indices of blocks at nesting `depth` """
+        return np.flatnonzero(self.depths == depth)
+
+    def children(self, i):
+        """ Return indices of blocks directly inside block `i` """
+        inside = np.arange(i + 1,
+                           np.searchsorted(self.opens, self.closes[i]))
+        return inside[self.depths[inside] == self.depths[i] + 1]
+
+    def documents(self):
+        """ Return list of (start, end) byte offsets of top-level blocks """
+        top = self.blocks_at(0)
+        return list(zip(self.starts[top].tolist(), self.ends[top].tolist()))
+
+    def find(self, name=None, tag=None, depth=None):
+        """ Return indices of tagged blocks matching all given values
+
+        Parameters
+        ----------
+        name : None or str, optional
+            Name of typed tag, as in ``<ParamLong."name">``.
+        tag : None or str, optional
+            Tag, as in ``ParamLong``.
+        depth : None or int, optional
+            Nesting depth.
+
+        Returns
+        -------
+        indices : ndarray
+            Block indices in document order.
+        """
+        candidates = np.flatnonzero(self.tag_starts >= 0)
+        if depth is not None:
+            candidates = candidates[self.depths[candidates] == depth]
+        if name is None and tag is None:
+            return candidates
+        # Search the raw bytes for the tag text, and keep matches that start
+        # blocks; matches in strings do not.
+        pattern = b'<' + (br'[A-Za-z_]\w*' if tag is None
+                          else re.escape(tag.encode('ascii')))
+        if name is None:
+            pattern += br'(?:\."[^"]*")?>'
+        else:
+            pattern += br'\."' + re.escape(name.encode('utf-8')) + b'">'
+        starts = np.array([m.start() for m in
+                           re.finditer(pattern, self.data)], dtype=np.intp)
+        return candidates[np.isin(self.tag_starts[candidates], starts)]
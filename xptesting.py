@@ -0,0 +1,55 @@
+""" Shared fixtures for tests and benchmarks
+"""
+from __future__ import print_function, absolute_import
+
+from contextlib import contextmanager
+from functools import lru_cache
+from os.path import join as pjoin, dirname
+import shutil
+import tempfile
+
+import xpparse as xpp
+
+DATA_PATH = dirname(__file__)
+EG_PROTO = pjoin(DATA_PATH, 'xprotocol_sample.txt')
+
+GOOD_STR = '<XProtocol> { <Name> "Good" <ParamLong."L"> { 3 } }'
+BAD_STR = '<XProtocol> { <Name> "Bad" <ParamLong."L"> { 3.0 } }'
+
+
+def write_file(path, text):
+    """ Write string `text` to file at `path` """
+    with open(path, 'wt') as fobj:
+        fobj.write(text)
+
+
+@contextmanager
+def temp_dir():
+    """ Context manager giving new temporary directory, deleted on exit """
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+@lru_cache(maxsize=None)
+def get_sample():
+    """ Return contents of sample file and the embedded protocol string
+
+    The sample is read and parsed on first call only.
+
+    Returns
+    -------
+    contents : str
+        Contents of the sample XProtocol file.
+    proto_str : str
+        Embedded ``Protocol0`` XProtocol, without the ASCCONV header.
+    """
+    with open(EG_PROTO, 'rt') as fobj:
+        contents = fobj.read()
+    for v in xpp.parse(contents)[0]['blocks'][0]['value']:
+        if v['name'].startswith('Protocol'):
+            break
+    proto_str, asc_hdr = xpp.split_ascconv(xpp.strip_twin_quote(v['value']))
+    return contents, proto_str
@@ -0,0 +1,547 @@
+""" Watch a spool directory, and parse XProtocol files as they arrive
+
+Scanners drop header exports into a spool directory.  Run::
+
+    python xpwatch.py spool/ cache/
+
+to parse each new or changed file under ``spool/`` in a pool of worker
+processes, a few seconds after it lands, without scanning the whole tree
+again.  On Linux we get changes from inotify, through ``ctypes``; elsewhere,
+or with ``--poll``, we look at the size and modification time of each file
+every so often.
+
+Scanners write files in pieces, so we wait until a file has kept the same
+size and modification time for `settle` seconds before we parse it.  We
+skip hidden files and names ending in ``.tmp`` or ``.part``, the usual names
+for files still being written.
+
+The cache directory holds:
+
+* ``trees/<path>.json``: the parse tree of each XProtocol document in
+  ``spool/<path>``, one per line, in the ``xpjson`` format;
+* ``catalog.json``: JSON with keys "version", now 1, and "files", an object
+  with a key for each spool file path, relative to the spool directory.
+  Values are objects with keys "size" and "mtime_ns", of the file when
+  parsed, or null if we could not read them; "output", the path of the
+  trees file relative to the cache directory, or null if there was an
+  error; "names", the ``<Name>`` of each document, or null for a document
+  without one; and "error", null, or an object with "type", "message" and
+  "lineno".
+
+At start-up, we parse files that are missing from the catalog or have
+changed since, so a restart picks up files that arrived while we were
+stopped.  We remove the trees and catalog entries of deleted files.  Moving
+a file or directory into, out of, or within the spool counts as deleting the
+files at their old paths and adding them at their new ones.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import json
+from multiprocessing import Pool
+import os
+from os.path import join as pjoin
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+
+import xpparse as xpp
+import xpjson as xpj
+
+CATALOG_VERSION = 1
+
+CATALOG_NAME = 'catalog.json'
+
+TREES_DIR = 'trees'
+
+# Names of files still being written, or not for us
+IGNORE_PATTERNS = ('.*', '*.tmp', '*.part')
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+# struct inotify_event, before the name: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    """ Return C library with inotify functions, or None """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def walk_files(root):
+    """ Return list of paths of all files under directory `root` """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        paths += [pjoin(dirpath, name) for name in filenames]
+    return paths
+
+
+class InotifyWatcher(object):
+    """ Report changed files under directory `root` with inotify
+
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self, root):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'No inotify on this system')
+        self._libc = libc
+        self.root = root
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not start inotify')
+        # Directory path for each watch descriptor
+        self._dirs = {}
+        self._add_tree(root)
+
+    def _add_tree(self, root):
+        """ Watch `root` and directories below; return paths of files """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath),
+                                              WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:  # Gone already
+                    continue
+                raise OSError(err, 'Could not watch ' + dirpath)
+            self._dirs[wd] = dirpath
+            paths += [pjoin(dirpath, name) for name in filenames]
+        return paths
+
+    def poll(self, timeout):
+        """ Return set of paths that may have changed, waiting `timeout` s
+
+        A directory moved away, or renamed, gives its old path with a
+        trailing separator, meaning any file below may have gone.  A
+        directory moved in, or renamed, gives the paths of its files.
+        """
+        changed = set()
+        ready = select.select([self.fd], [], [], timeout)[0]
+        while ready:
+            try:
+                buf = os.read(self.fd, 2 ** 16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf,
+                                                                    offset)
+                offset += EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Lost events; look at everything
+                    changed.update(self._add_tree(self.root))
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                directory = self._dirs.get(wd)
+                if directory is None or not name:
+                    continue
+                path = pjoin(directory, os.fsdecode(name))
+                if not mask & IN_ISDIR:
+                    changed.add(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files can land before we watch the new directory
+                    changed.update(self._add_tree(path))
+                elif mask & IN_MOVED_FROM:
+                    # All files below have gone from here
+                    self._forget_tree(path)
+                    changed.add(pjoin(path, ''))
+        return changed
+
+    def _forget_tree(self, root):
+        """ Stop watching directory `root` and directories below """
+        prefix = pjoin(root, '')
+        for wd, dirpath in list(self._dirs.items()):
+            if dirpath == root or dirpath.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._dirs[wd]
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(object):
+    """ Report changed files under directory `root` by comparing stats """
+
+    def __init__(self, root):
+        self.root = root
+        self._stats = self._scan()
+
+    def _scan(self):
+        stats = {}
+        for path in walk_files(self.root):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def poll(self, timeout):
+        """ Return set of paths that have changed, after `timeout` s """
+        time.sleep(timeout)
+        stats = self._scan()
+        old = self._stats
+        self._stats = stats
+        changed = set(path for path in stats if stats[path] != old.get(path))
+        return changed | (set(old) - set(stats))
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, use_inotify=None):
+    """ Return watcher for directory `root`
+
+    `use_inotify` of None means use inotify if we can, otherwise poll.
+    """
+    if use_inotify is None:
+        try:
+            return InotifyWatcher(root)
+        except OSError:
+            return PollingWatcher(root)
+    return InotifyWatcher(root) if use_inotify else PollingWatcher(root)
+
+
+def load_catalog(cache):
+    """ Return catalog dict from directory `cache`, or a new empty one """
+    try:
+        with open(pjoin(cache, CATALOG_NAME), 'rt') as fobj:
+            catalog = json.load(fobj)
+    except (OSError, ValueError):
+        catalog = None
+    if catalog is None or catalog.get('version') != CATALOG_VERSION:
+        catalog = dict(version=CATALOG_VERSION, files={})
+    return catalog
+
+
+def write_catalog(catalog, cache):
+    """ Write `catalog` to directory `cache` """
+    path = pjoin(cache, CATALOG_NAME)
+    # Write to a temporary file first, so readers never see half a catalog
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wt') as fobj:
+        json.dump(catalog, fobj)
+    os.replace(tmp_path, path)
+
+
+def _new_entry(exc=None):
+    """ Return catalog entry with no file stats or output, for error `exc`
+    """
+    return dict(size=None, mtime_ns=None, output=None, names=[],
+                error=None if exc is None else xpp.error_record(exc))
+
+
+def ingest(task):
+    """ Parse one spool file, write its trees; return (path, entry)
+
+    `task` is a tuple of (path, output path, output path relative to cache,
+    options for ``get_symbols``).  Runs in worker processes.  Errors go in
+    the entry, so one bad file cannot stop the daemon.
+    """
+    path, out_path, rel_out, options = task
+    entry = _new_entry()
+    tmp_path = out_path + '.tmp'
+    try:
+        # The file may have gone since it settled
+        stat = os.stat(path)
+        entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(path, 'rt') as fobj, open(tmp_path, 'wt') as out:
+            writer = xpj.JSONWriter(out)
+            for xprotocol in xpp.get_symbols(**options).iterparse(fobj):
+                writer.write(xprotocol)
+                # Documents need not have a <Name>
+                entry['names'].append(xprotocol.get('name'))
+        os.replace(tmp_path, out_path)
+        entry['output'] = rel_out
+    except Exception as e:
+        entry['names'] = []
+        entry['error'] = xpp.error_record(e)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return path, entry
+
+
+class Ingester(object):
+    """ Parse new and changed files in `spool` into cache directory `cache`
+
+    Parameters
+    ----------
+    spool : str
+        Directory to watch.
+    cache : str
+        Directory for the trees and catalog; see the module docstring.
+    workers : None or int, optional
+        Number of worker processes.  None means one per CPU.
+    settle : float, optional
+        Seconds a file must stay unchanged before we parse it.
+    poll_interval : float, optional
+        Longest wait for changes in one :meth:`step`, in seconds.  For
+        polling, also the time between scans of the spool directory.
+    use_inotify : None or bool, optional
+        If None, use inotify if we can, otherwise poll.
+    ignore : sequence, optional
+        Glob patterns for file names to skip.
+    log : None or file-like, optional
+        If not None, write a line for each file parsed or removed.
+    \\*\\*options : dict
+        Keyword arguments for ``XProtocolSymbols``, such as ``engine``.
+    """
+
+    def __init__(self, spool, cache, workers=None, settle=1.0,
+                 poll_interval=1.0, use_inotify=None,
+                 ignore=IGNORE_PATTERNS, log=None, **options):
+        self.spool = spool
+        self.cache = cache
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.ignore = ignore
+        self.log = log
+        self.options = options
+        os.makedirs(cache, exist_ok=True)
+        self.catalog = load_catalog(cache)
+        # path -> ((size, mtime_ns), time first seen with these stats)
+        self._pending = {}
+        # path -> AsyncResult of parse in pool
+        self._running = {}
+        self.watcher = make_watcher(spool, use_inotify)
+        self._pool = Pool(workers)
+        # Files that arrived or changed while we were not running
+        for path in walk_files(spool):
+            self._touch(path)
+        for rel in list(self.catalog['files']):
+            self._touch(pjoin(spool, rel))
+
+    def _rel(self, path):
+        return os.path.relpath(path, self.spool)
+
+    def _touch(self, path):
+        """ Note that `path` may have changed
+
+        A `path` ending in a separator is a directory that has gone; all
+        files we know of below it may have changed.
+        """
+        if path.endswith(os.sep):
+            rel_dir = self._rel(path)
+            below = [pjoin(self.spool, rel) for rel in self.catalog['files']
+                     if rel.startswith(pjoin(rel_dir, ''))]
+            below += [p for p in self._pending if p.startswith(path)]
+            for below_path in below:
+                self._touch(below_path)
+            return
+        name = os.path.basename(path)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore):
+            return
+        self._pending.setdefault(path, (None, None))
+
+    def _remove(self, path):
+        """ Drop trees and catalog entry for deleted file `path` """
+        entry = self.catalog['files'].pop(self._rel(path), None)
+        if entry is None:
+            return False
+        self._unlink_output(entry)
+        self._log('removed', path)
+        return True
+
+    def _unlink_output(self, entry):
+        """ Delete trees file of catalog `entry`, if any """
+        if entry['output'] is not None:
+            try:
+                os.unlink(pjoin(self.cache, entry['output']))
+            except OSError:
+                pass
+
+    def _log(self, what, path):
+        if self.log is not None:
+            print('{0}: {1}'.format(what, path), file=self.log)
+
+    def _submit_settled(self, now):
+        """ Start parses of pending files that have settled """
+        dirty = False
+        files = self.catalog['files']
+        for path, (key, since) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                dirty |= self._remove(path)
+                continue
+            new_key = (stat.st_size, stat.st_mtime_ns)
+            if new_key != key:
+                self._pending[path] = (new_key, now)
+                continue
+            if now - since < self.settle or path in self._running:
+                continue
+            del self._pending[path]
+            rel = self._rel(path)
+            entry = files.get(rel)
+            if (entry is not None and
+                    (entry['size'], entry['mtime_ns']) == new_key):
+                continue
+            rel_out = pjoin(TREES_DIR, rel + '.json')
+            self._running[path] = self._pool.apply_async(
+                ingest, ((path, pjoin(self.cache, rel_out), rel_out,
+                          self.options),))
+        return dirty
+
+    def _collect(self):
+        """ Store results of finished parses in the catalog """
+        dirty = False
+        for path, result in list(self._running.items()):
+            if not result.ready():
+                continue
+            del self._running[path]
+            try:
+                entry = result.get()[1]
+            except Exception as e:
+                # Failure outside the parse, such as a worker crash
+                entry = _new_entry(e)
+            if not os.path.exists(path):
+                # Deleted while we parsed it; there may be no catalog entry
+                # for the trees we just wrote
+                dirty |= self._remove(path)
+                self._unlink_output(entry)
+                continue
+            self.catalog['files'][self._rel(path)] = entry
+            self._log('error' if entry['error'] else 'parsed', path)
+            dirty = True
+        return dirty
+
+    @property
+    def busy(self):
+        """ True if files are waiting to settle or being parsed """
+        return bool(self._pending or self._running)
+
+    def step(self, timeout=None):
+        """ Wait up to `timeout` s for changes, then do any work due
+
+        `timeout` of None means `poll_interval`, or a shorter time if files
+        are waiting to settle or being parsed.
+        """
+        if timeout is None:
+            timeout = self.poll_interval
+            if self.busy:
+                timeout = min(timeout, self.settle / 2)
+        for path in self.watcher.poll(timeout):
+            self._touch(path)
+        dirty = self._collect()
+        dirty |= self._submit_settled(time.monotonic())
+        if dirty:
+            write_catalog(self.catalog, self.cache)
+
+    def run(self, stop=None, once=False):
+        """ Ingest files until `stop` is set
+
+        Parameters
+        ----------
+        stop : None or ``threading.Event``, optional
+            Set to stop.  None means run until interrupted.
+        once : bool, optional
+            If True, stop when there is no more work, for example after
+            parsing files that arrived while we were not running.
+        """
+        stop = threading.Event() if stop is None else stop
+        while not stop.is_set():
+            self.step()
+            if once and not self.busy:
+                break
+
+    def close(self):
+        """ Stop watching; wait for running parses and store their results
+        """
+        self.watcher.close()
+        self._pool.close()
+        self._pool.join()
+        if self._collect():
+            write_catalog(self.catalog, self.cache)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(argv=None):
+    """ Run ingestion daemon with arguments `argv`; return exit code """
+    parser = argparse.ArgumentParser(
+        prog='xpwatch',
+        description='Watch a spool directory, and parse new and changed '
+        'XProtocol files into a cache directory.')
+    parser.add_argument('spool', help='directory to watch')
+    parser.add_argument('cache', help='directory for trees and catalog')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of worker processes (default one per '
+                        'CPU)')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds a file must stay unchanged before '
+                        'parsing (default 1)')
+    parser.add_argument('--poll', action='store_true',
+                        help='poll for changes rather than using inotify')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between polls (default 1)')
+    parser.add_argument('--engine', choices=('lalr', 'rd'), default='lalr',
+                        help='parser engine (default lalr)')
+    parser.add_argument('--forgiving', action='store_true',
+                        help='skip parse errors rather than failing the '
+                        'file')
+    parser.add_argument('--once', action='store_true',
+                        help='parse files not yet in the catalog, then exit')
+    args = parser.parse_args(argv)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    ingester = Ingester(args.spool, args.cache,
+                        workers=args.workers,
+                        settle=args.settle,
+                        poll_interval=args.poll_interval,
+                        use_inotify=False if args.poll else None,
+                        log=sys.stderr,
+                        engine=args.engine,
+                        error_mode='forgiving' if args.forgiving
+                        else 'strict')
+    with ingester:
+        try:
+            ingester.run(stop, once=args.once)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+""" Write parse trees from ``xpparse`` back out as XProtocol text
+
+The writer streams its output to a file object in small pieces, so we never
+build the whole output string.  String values from the parser keep the
+escaping they had in the source - doubled double quotes stay doubled - and
+we write them back as they are, so ``parse(dumps(parse(text)))`` gives the
+same tree as ``parse(text)``.  This includes nested protocols and ASCCONV
+sections in string values, such as the ``Protocol0`` parameter of a
+multi-step protocol.
+"""
+from __future__ import print_function, absolute_import
+
+import io
+import math
+import re
+
+import xpparse as xpp
+
+# A run of double quotes of odd length cannot be in a valid XProtocol string
+ODD_QUOTES_RE = re.compile(r'(?<!")"(?:"")*(?!")')
+
+# Tag types for parse tree block types
+BLOCK_TAGS = {'param_bool': 'ParamBool',
+              'param_long': 'ParamLong',
+              'param_double': 'ParamDouble',
+              'param_string': 'ParamString',
+              'param_choice': 'ParamChoice',
+              'param_array': 'ParamArray',
+              'param_map': 'ParamMap',
+              'param_functor': 'ParamFunctor',
+              'pipe_service': 'PipeService'}
+
+
+def quote_string(value):
+    """ Return XProtocol string literal for string `value`
+
+    Strings from the parser are already escaped, and we only add the
+    surrounding quotes.  If `value` has a run of an odd number of double
+    quotes, it cannot be escaped text, so we take it as plain text and
+    double all its double quotes.
+    """
+    if ODD_QUOTES_RE.search(value):
+        value = value.replace('"', '""')
+    return '"' + value + '"'
+
+
+def format_scalar(value):
+    """ Return XProtocol text for scalar `value`
+
+    Parameters
+    ----------
+    value : bool or int or float or str or LazyScalar
+        Value to format.  We write lazy scalars as their source text.
+
+    Returns
+    -------
+    text : str
+        Text for `value`; floats always have a decimal point or exponent, so
+        they read back as floats.
+    """
+    if isinstance(value, xpp.LazyScalar):
+        return value.text
+    if isinstance(value, bool):
+        return '"true"' if value else '"false"'
+    if isinstance(value, int):
+        return int.__repr__(value)
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError('Cannot write non-finite float {0!r}'
+                             .format(value))
+        return float.__repr__(value)
+    if isinstance(value, str):
+        return quote_string(value)
+    raise TypeError('Cannot write value of type {0}'.format(type(value)))
+
+
+class XProtocolWriter(object):
+    """ Write parse trees as XProtocol text to a file object
+
+    Parameters
+    ----------
+    fobj : file-like
+        Text file object to write to.
+    indent : str, optional
+        Indent for each level of nesting.
+    buffer_lines : int, optional
+        Number of lines to collect before each write to `fobj`.
+    """
+
+    def __init__(self, fobj, indent='  ', buffer_lines=256):
+        self.fobj = fobj
+        self.indent = indent
+        self.buffer_lines = buffer_lines
+        self._lines = []
+
+    def flush(self):
+        """ Write any buffered lines to the file object """
+        if self._lines:
+            self.fobj.write(''.join(self._lines))
+            self._lines = []
+
+    def _line(self, depth, text):
+        self._lines.append(self.indent * depth + text + '\n')
+        if len(self._lines) >= self.buffer_lines:
+            self.flush()
+
+    def _open(self, depth, text):
+        """ Write `text` opening a braced block, then the open brace """
+        self._line(depth, text)
+        self._line(depth, '{')
+
+    def write(self, xprotocols):
+        """ Write list of XProtocol dicts, as returned from ``parse``
+
+        Also accepts a single XProtocol dict.
+        """
+        if isinstance(xprotocols, dict):
+            xprotocols = [xprotocols]
+        for xprotocol in xprotocols:
+            self.write_xprotocol(xprotocol)
+        self.flush()
+
+    def write_xprotocol(self, xprotocol, depth=0):
+        """ Write XProtocol dict `xprotocol` """
+        self._open(depth, '<XProtocol>')
+        depth += 1
+        if 'name' in xprotocol:
+            self._line(depth, '<Name> ' + format_scalar(xprotocol['name']))
+        if 'id' in xprotocol:
+            self._line(depth, '<ID> ' + format_scalar(xprotocol['id']))
+        if 'user_version' in xprotocol:
+            self._line(depth, '<Userversion> ' +
+                       format_scalar(xprotocol['user_version']))
+        if 'EVAStringTable' in xprotocol:
+            self._eva_string_table(xprotocol['EVAStringTable'], depth)
+        for block in xprotocol['blocks']:
+            self.write_block(block, depth)
+        for card in xprotocol['cards']:
+            if card['type'] == 'eva_card_layout':
+                self._eva_card_layout(card, depth)
+            else:
+                self._param_card_layout(card, depth)
+        for dependency in xprotocol['depends']:
+            self._dependency(dependency, depth)
+        self._line(depth - 1, '}')
+
+    def write_block(self, block, depth=0, prefix=''):
+        """ Write parameter dict `block`
+
+        Parameters
+        ----------
+        block : dict
+            Parameter dict from the parse tree, such as a ParamLong.
+        depth : int, optional
+            Nesting depth.
+        prefix : str, optional
+            Text to write before the opening tag, on the same line.
+        """
+        block_type = block['type']
+        self._open(depth, '{0}<{1}.{2}>'.format(prefix,
+                                                BLOCK_TAGS[block_type],
+                                                quote_string(block['name'])))
+        depth += 1
+        if block_type in ('param_functor', 'pipe_service'):
+            self._line(depth, '<Class> ' + format_scalar(block['class']))
+        for key, value in block.get('attrs', ()):
+            self._attr(key, value, depth)
+        value = block['value']
+        if block_type in ('param_map', 'param_functor', 'pipe_service'):
+            for sub_block in value:
+                self.write_block(sub_block, depth)
+        elif block_type == 'param_array':
+            for values in value:
+                self._line(depth, self._curly_list(values))
+        elif value is not None:
+            self._line(depth, format_scalar(value))
+        if block_type == 'param_functor':
+            for key, tag in (('event', 'Event'),
+                             ('method', 'Method'),
+                             ('connection', 'Connection')):
+                emc = block[key]
+                self._line(depth, '<{0}.{1}> {2}'.format(
+                    tag, quote_string(emc['name']),
+                    self._curly_list(emc['args'])))
+        self._line(depth - 1, '}')
+
+    def _curly_list(self, values):
+        if not values:
+            return '{ }'
+        return '{ ' + ' '.join(format_scalar(v) for v in values) + ' }'
+
+    def _attr(self, key, value, depth):
+        prefix = '<{0}> '.format(key)
+        if isinstance(value, dict):
+            self.write_block(value, depth, prefix)
+        elif isinstance(value, list):
+            self._line(depth, prefix + self._curly_list(value))
+        else:
+            self._line(depth, prefix + format_scalar(value))
+
+    def _eva_string_table(self, table, depth):
+        n_strings, int_strings = table
+        self._open(depth, '<EVAStringTable>')
+        self._line(depth + 1, format_scalar(n_strings))
+        for number, in_str in int_strings:
+            self._line(depth + 1, '{0} {1}'.format(format_scalar(number),
+                                                   format_scalar(in_str)))
+        self._line(depth, '}')
+
+    def _param_card_layout(self, card, depth):
+        self._open(depth, '<ParamCardLayout.{0}>'.format(
+            quote_string(card['name'])))
+        depth += 1
+        self._line(depth, '<Repr> ' + format_scalar(card['repr']))
+        for control in card['controls']:
+            parts = ['<Control> { <Param>', format_scalar(control['param']),
+                     '<Pos>'] + [format_scalar(v) for v in control['pos']]
+            if control['repr'] is not None:
+                parts += ['<Repr>', format_scalar(control['repr'])]
+            self._line(depth, ' '.join(parts + ['}']))
+        self._lines_of(card['lines'], depth)
+        self._line(depth - 1, '}')
+
+    def _eva_card_layout(self, card, depth):
+        self._open(depth, '<EVACardLayout.{0}>'.format(
+            quote_string(card['name'])))
+        depth += 1
+        self._line(depth, format_scalar(card['repr']))
+        self._line(depth, format_scalar(card['n_controls']))
+        for control in card['controls']:
+            self._line(depth, ' '.join(
+                [format_scalar(control['param'])] +
+                [format_scalar(v) for v in control['pos']] +
+                [format_scalar(control['repr'])]))
+        self._lines_of(card['lines'], depth)
+        self._line(depth - 1, '}')
+
+    def _lines_of(self, lines, depth):
+        for line in lines:
+            self._line(depth, '<Line> ' + self._curly_list(line))
+
+    def _dependency(self, dependency, depth):
+        parts = [format_scalar(v) for v in dependency['values']]
+        if dependency['dll'] is not None:
+            parts += ['<Dll>', format_scalar(dependency['dll'])]
+        if dependency['context'] is not None:
+            parts += ['<Context>', format_scalar(dependency['context'])]
+        self._line(depth, '<Dependency.{0}> {{ {1} }}'.format(
+            quote_string(dependency['name']), ' '.join(parts)))
+
+
+def write(xprotocols, fobj, indent='  '):
+    """ Write parse tree `xprotocols` as XProtocol text to `fobj`
+
+    Parameters
+    ----------
+    xprotocols : list or dict
+        List of XProtocol dicts, as returned from ``parse``, or a single
+        XProtocol dict.
+    fobj : file-like
+        Text file object to write to.
+    indent : str, optional
+        Indent for each level of nesting.
+    """
+    XProtocolWriter(fobj, indent).write(xprotocols)
+
+
+def dumps(xprotocols, indent='  '):
+    """ Return XProtocol text for parse tree `xprotocols`
+
+    See :func:`write` for parameters.
+    """
+    fobj = io.StringIO()
+    write(xprotocols, fobj, indent)
+    return fobj.getvalue()
+
+
+def write_ascconv(assignments, fobj, escaped=False):
+    """ Write ASCCONV section with `assignments` to `fobj`
+
+    Parameters
+    ----------
+    assignments : sequence
+        ``(key, value)`` pairs, as from ``xpparse.parse_ascconv``.  Values
+        can be int, float or str.
+    fobj : file-like
+        Text file object to write to.
+    escaped : bool, optional
+        If True, write the section for embedding in an XProtocol string, with
+        all double quotes doubled.
+    """
+    quotes = '""' if escaped else '"'
+    lines = ['### ASCCONV BEGIN ###\n']
+    for key, value in assignments:
+        if isinstance(value, str):
+            value = quotes + value.replace('"', quotes) + quotes
+        elif isinstance(value, float):
+            value = float.__repr__(value)
+        else:
+            value = int.__repr__(value)
+        lines.append('{0:<40} = {1}\n'.format(key, value))
+    lines.append('### ASCCONV END ###')
+    fobj.write(''.join(lines))